@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch mode: reads a manifest of move/flag decisions and processes it
+with the same pipeline as the 'Process' button in main.py, without Tk.
+
+The manifest is a CSV file with a header row, or a JSON Lines file with one
+object per line, using the same fields as the table columns:
+    name, flag, cat1, cat2, cat3, issue_message
+Missing fields are treated as empty. Names are resolved against --source-dir
+(absolute names are used as they are). Rows are streamed one at a time, so
+memory use does not depend on the size of the manifest.
+
+Usage:
+    python batch.py manifest.csv [--config config.ini] [--source-dir DIR] [--rules rules.ini] [--dry-run] [--profile]
+"""
+from pathlib import Path
+from contextlib import nullcontext
+import argparse
+import csv
+import json
+import os
+import time
+import processing
+import metrics
+import rules
+
+def entry_from_record(record: dict):
+    """Convert a manifest row into a TableEntry"""
+    if not record.get('name'):
+        raise ManifestError(f'Manifest row has no name: {record}')
+    return processing.TableEntry(*(str(record.get(field) or '').strip() for field in processing.ENTRY_FIELDS))
+
+def read_manifest(manifest_path: Path, manifest_format: str = None):
+    """Yields a TableEntry for each row of a CSV or JSON Lines manifest. The format
+    is guessed from the file extension if it isn't given"""
+    if manifest_format is None:
+        manifest_format = 'jsonl' if manifest_path.suffix.lower() in ('.jsonl', '.ndjson', '.json') else 'csv'
+
+    with manifest_path.open(newline='', encoding='utf-8') as manifest_file:
+        if manifest_format == 'csv':
+            for record in csv.DictReader(manifest_file):
+                yield entry_from_record(record)
+        else:
+            for line_number, line in enumerate(manifest_file, start=1):
+                if line.strip() == '':
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    raise ManifestError(f'Invalid JSON on line {line_number} of {manifest_path}')
+                yield entry_from_record(record)
+
+def classify_entries(entries, ruleset: rules.RuleSet, source_dir: Path):
+    """Fill in the flag and categories of entries that have neither, using the first matching rule"""
+    for e in entries:
+        if e.flag == '' and e.cat1 == '':
+            source = source_dir / e.name
+            rule = ruleset.match(source.name, ruleset.needs_type and source.is_dir(), source)
+            if rule is not None:
+                e = processing.TableEntry(e.name, *rules.apply_rule(list(e[1:]), rule))
+        yield e
+
+def run_batch(entries, processor: processing.Processor, source_dir: Path):
+    """Process every entry that has a flag or a category and return a summary dictionary"""
+    read = 0
+    ignored = 0
+    start = time.monotonic()
+    with processor:
+        processor.recover()
+        for e in entries:
+            read += 1
+            if not processing.needs_processing(e):
+                ignored += 1
+                continue
+            processor.process_entry(e, source_dir)
+    elapsed = time.monotonic() - start
+
+    processed = sum(processor.counts.values())
+    return {'rows': read,
+            'ignored': ignored,
+            **processor.counts,
+            'bytes': processor.bytes_moved,
+            'seconds': round(elapsed, 3),
+            'entries_per_second': round(processed / elapsed, 2) if elapsed > 0 else None,
+            'mb_per_second': round(processor.bytes_moved / elapsed / 1e6, 2) if elapsed > 0 else None}
+
+def print_summary(summary: dict):
+    print('Batch complete')
+    print(f"{summary['rows']} rows read, {summary['ignored']} without flag or category")
+    print(f"{summary['moved']} moved, {summary['flagged']} flagged, {summary['skipped']} skipped, " +
+          f"{summary['replayed']} already processed")
+    print(f"{summary['bytes'] / 1e6:.1f} MB in {summary['seconds']:.1f}s " +
+          f"({summary['entries_per_second']} entries/s, {summary['mb_per_second']} MB/s)")
+
+def parse_args(argv=None):
+    here = Path(__file__).parent
+    parser = argparse.ArgumentParser(description='Process a manifest of move/flag decisions without the user interface')
+    parser.add_argument('manifest', type=Path, help='CSV or JSON Lines file with the columns name, flag, cat1, cat2, cat3, issue_message')
+    parser.add_argument('--format', dest='manifest_format', choices=['csv', 'jsonl'], help='manifest format (default: guessed from the extension)')
+    parser.add_argument('--config', type=Path, default=here / 'config.ini', help='configuration file (default: config.ini next to this script)')
+    parser.add_argument('--source-dir', type=Path, default=Path.cwd(), help='directory that the names in the manifest are relative to (default: current directory)')
+    parser.add_argument('--change-log', type=Path, default=here / 'change.log')
+    parser.add_argument('--error-log', type=Path, default=here / 'error.log')
+    parser.add_argument('--dry-run', action='store_true', help='only print the plan for the manifest; nothing is moved or flagged')
+    parser.add_argument('--journal', type=Path, default=here / processing.JOURNAL_FILE_NAME, help='write-ahead journal used to resume interrupted runs')
+    parser.add_argument('--rules', type=Path, help='rules file used to fill in rows without a flag or category (see rules.py)')
+    parser.add_argument('--profile', nargs='?', type=Path, const=here / processing.PROFILE_FILE_NAME,
+                        help='run under cProfile and tracemalloc and write the profile to PROFILE (default: profile.prof next to this script)')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = processing.read_config(args.config)
+    settings, id_cache = processing.load_settings(args.config, config)
+    flags = processing.load_flags(args.config, config)
+
+    entries = read_manifest(args.manifest, args.manifest_format)
+    if args.rules is not None:
+        entries = classify_entries(entries, rules.load_rules(args.rules), args.source_dir.resolve())
+
+    if args.dry_run:
+        entries = [e for e in entries if processing.needs_processing(e)]
+        plan = processing.make_plan(entries, args.source_dir.resolve(), settings)
+        print(plan.summary())
+        return plan
+
+    processor = processing.Processor(settings, flags, args.change_log, args.error_log, id_cache=id_cache, journal_path=args.journal)
+    print(f'Processing {args.manifest} from {args.source_dir.resolve()}{os.sep}\n')
+    with metrics.profiled(args.profile) if args.profile is not None else nullcontext():
+        summary = run_batch(entries, processor, args.source_dir.resolve())
+    print_summary(summary)
+    return summary
+
+class ManifestError(Exception):
+    pass
+
+if __name__ == "__main__":
+    main()
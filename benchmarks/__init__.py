@@ -0,0 +1 @@
+"""Benchmark harness for Reorganize with Trello (run with: python -m benchmarks.run)"""
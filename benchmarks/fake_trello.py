@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Trello REST endpoints used by trello.py, with
+configurable latency and injected 429 (rate limit) responses
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import itertools
+import json
+import random
+import threading
+import time
+
+class FakeTrelloServer:
+    """Serves the Trello endpoints on 127.0.0.1 from a background thread.
+    - latency: seconds added to every response
+    - error_rate: fraction of requests that get a 429 response
+    - retry_after: value of the Retry-After header sent with each 429"""
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, retry_after: float = 0.05,
+                 board_name='Board', list_name='List', member_names=('member1', 'member2')):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.boards = [{'id': 'board1', 'name': board_name}]
+        self.lists = {'board1': [{'id': 'list1', 'name': list_name}]}
+        self.members = {name: {'id': 'id_' + name, 'username': name} for name in member_names}
+        self.cards = {}
+        self.checklists = {}
+        self.actions = []       #newest first, like Trello
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'rate_limited': 0}
+        self.random = random.Random(0)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}/1/'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def new_id(self, prefix):
+        with self.lock:
+            return f'{prefix}{next(self.ids)}'
+
+    def route(self, method, path, params):
+        """Returns (status, body) for a request"""
+        parts = [part for part in path.split('/') if part][1:]     #drop the API version
+        if method == 'GET' and parts == ['members', 'me', 'boards']:
+            return 200, self.boards
+        if method == 'GET' and len(parts) == 3 and parts[0] == 'boards' and parts[2] == 'lists':
+            return 200, self.lists.get(parts[1], [])
+        if method == 'GET' and len(parts) == 2 and parts[0] == 'members':
+            member = self.members.get(parts[1])
+            return (200, member) if member else (404, 'model not found')
+        if method == 'GET' and len(parts) == 3 and parts[0] == 'boards' and parts[2] == 'actions':
+            with self.lock:
+                actions = list(self.actions)
+            types = {action_type.split(':')[0] for action_type in params.get('filter', 'all').split(',')}
+            if 'before' in params:
+                actions = actions[[action['id'] for action in actions].index(params['before']) + 1:]
+            if params.get('since') in [action['id'] for action in actions]:
+                actions = actions[:[action['id'] for action in actions].index(params['since'])]
+            actions = [action for action in actions if 'all' in types or action['type'] in types]
+            return 200, actions[:int(params.get('limit', 50))]
+        if method == 'PUT' and len(parts) == 2 and parts[0] == 'cards':
+            card = self.cards.get(parts[1])
+            if card is None:
+                return 404, 'model not found'
+            old = {}
+            with self.lock:
+                for field in ('closed', 'idList'):
+                    if field in params:
+                        old[field] = card[field]
+                        card[field] = params[field] == 'true' if field == 'closed' else params[field]
+                action = {'id': f'action{next(self.ids)}', 'type': 'updateCard', 'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                          'data': {'card': dict(card), 'old': old}}
+                if 'idList' in old:
+                    action['data']['listAfter'] = {'id': card['idList']}
+                self.actions.insert(0, action)
+            return 200, card
+        if method == 'POST' and parts == ['cards']:
+            card = {'id': self.new_id('card'), 'name': params.get('name', ''), 'desc': params.get('desc', ''),
+                    'idList': params.get('idList', ''), 'closed': False}
+            with self.lock:
+                self.cards[card['id']] = card
+            return 200, card
+        if method == 'POST' and len(parts) == 3 and parts[0] == 'cards' and parts[2] == 'checklists':
+            if parts[1] not in self.cards:
+                return 404, 'model not found'
+            checklist = {'id': self.new_id('checklist'), 'idCard': parts[1], 'name': params.get('name', ''), 'checkItems': []}
+            with self.lock:
+                self.checklists[checklist['id']] = checklist
+            return 200, checklist
+        if method == 'POST' and len(parts) == 3 and parts[0] == 'checklists' and parts[2] == 'checkItems':
+            checklist = self.checklists.get(parts[1])
+            if checklist is None:
+                return 404, 'model not found'
+            item = {'id': self.new_id('item'), 'name': params.get('name', ''), 'state': 'incomplete'}
+            with self.lock:
+                checklist['checkItems'].append(item)
+            return 200, item
+        return 404, 'not found'
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def handle_request(self, method):
+                url = urlsplit(self.path)
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length).decode()
+                    params.update({k: v[-1] for k, v in parse_qs(body).items()})
+
+                with server.lock:
+                    server.stats['requests'] += 1
+                    rate_limited = server.random.random() < server.error_rate
+                    if rate_limited:
+                        server.stats['rate_limited'] += 1
+                if server.latency:
+                    time.sleep(server.latency)
+
+                headers = {}
+                if rate_limited:
+                    status, body = 429, {'error': 'API_TOKEN_LIMIT_EXCEEDED'}
+                    headers['Retry-After'] = str(server.retry_after)
+                else:
+                    status, body = server.route(method, url.path, params)
+                self.send_json(status, body, headers)
+
+            def send_json(self, status, body, headers):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_PUT(self):
+                self.handle_request('PUT')
+
+        return Handler
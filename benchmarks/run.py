@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the processing pipeline headlessly on synthetic source trees, with
+Trello calls going to a local fake server, and reports moves/s, MB/s, cards/s,
+per-entry latency percentiles and peak RSS. Results are saved as JSON so that
+runs can be compared over time.
+
+Usage (from the repository root):
+    python -m benchmarks.run [--scale 1.0] [--latency 0.05] [--error-rate 0.1]
+                             [--reorg-dir /other/filesystem] [--force-copy]
+"""
+from pathlib import Path
+from contextlib import redirect_stdout
+import argparse
+import io
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import processing
+import trello
+from benchmarks import synthetic
+from benchmarks.fake_trello import FakeTrelloServer
+
+try:
+    import resource     #not available on Windows
+except ImportError:
+    resource = None
+
+RESULTS_DIR = Path(__file__).parent / 'results'
+
+def make_scenarios(scale: float):
+    """Returns {name: (create_items(root), flag)}; flagged scenarios create cards instead of moving"""
+    return {
+        'small_files': (lambda root: synthetic.small_files(root, count=max(1, int(2000 * scale))), ''),
+        'large_files': (lambda root: synthetic.large_files(root, count=3, size=max(1, int(64 * 1024 * 1024 * scale))), ''),
+        'deep_trees': (lambda root: synthetic.deep_trees(root, count=max(1, int(20 * scale)), depth=8, files_per_dir=5), ''),
+        'flags': (lambda root: synthetic.small_files(root, count=max(1, int(200 * scale)), size=128), 'd'),
+    }
+
+def percentile(values, p: float):
+    """Nearest-rank percentile of values (p between 0 and 100)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if it can't be measured"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024**2 if sys.platform == 'darwin' else peak / 1024, 1)     #bytes on macOS, KB elsewhere
+
+def run_scenario(name, create_items, flag, workdir: Path, reorg_dir: Path, server, force_copy: bool, verbose: bool, card_grouping: str = 'none'):
+    """Create the scenario's source tree, process it, and return its metrics"""
+    source_dir = workdir / 'src' / name
+    source_dir.mkdir(parents=True)
+    names = create_items(source_dir)
+    entries = [processing.TableEntry(n, flag, 'bench', name, '', 'benchmark' if flag else '') for n in names]
+
+    settings = {'REORG_DIRECTORY': str(reorg_dir), 'API_KEY': 'key', 'OATH_TOKEN': 'token',
+                'LIST_ID': 'list1', 'MEMBER_IDS': '', 'LOG_FLUSH': 'batch',
+                'CARD_GROUPING': card_grouping}
+    processor = processing.Processor(settings, {'d': 'Duplicate'}, workdir / 'change.log', workdir / 'error.log',
+                                     journal_path=workdir / f'journal_{name}.jsonl')
+
+    requests_before = server.stats['requests']
+    rate_limited_before = server.stats['rate_limited']
+    latencies = []
+    output = sys.stdout if verbose else io.StringIO()
+    start = time.perf_counter()
+    with redirect_stdout(output), processor:
+        plan = processing.make_plan(entries, source_dir, settings)
+        if force_copy:
+            for directory in plan.dirs_to_create:   #forced items skip the processor's folder creation
+                directory.mkdir(parents=True, exist_ok=True)
+        for e, item in zip(entries, plan.items):
+            if force_copy and item.action == 'move':
+                item = item._replace(same_device=False)     #exercise the copy engine even on one filesystem
+            entry_start = time.perf_counter()
+            processor.process_entry(e, source_dir, item)
+            latencies.append(time.perf_counter() - entry_start)
+    elapsed = time.perf_counter() - start
+
+    counts = processor.counts
+    with (workdir / processing.METRICS_FILE_NAME).open() as f:
+        phases = json.load(f)       #written by the processor when it was closed
+    return {'entries': len(entries),
+            **counts,
+            'move_methods': {method: count for method, (count, seconds) in processor.move_stats.items()},
+            'seconds': round(elapsed, 4),
+            'moves_per_second': round(counts['moved'] / elapsed, 2),
+            'mb_per_second': round(processor.bytes_moved / elapsed / 1e6, 2),
+            'cards_per_second': round(counts['flagged'] / elapsed, 2),
+            'latency_p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'latency_p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'http_requests': server.stats['requests'] - requests_before,
+            'http_429s': server.stats['rate_limited'] - rate_limited_before,
+            'peak_rss_mb': peak_rss_mb(),
+            'phases': phases['spans'],
+            'counters': phases['counters']}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the processing pipeline on synthetic data')
+    parser.add_argument('--scenarios', nargs='+', help='scenarios to run (default: all)')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for the number and size of generated items')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of latency added to each fake Trello response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of fake Trello requests answered with 429')
+    parser.add_argument('--workdir', type=Path, help='directory for the generated source trees (default: a temporary directory)')
+    parser.add_argument('--reorg-dir', type=Path, help='destination directory, e.g. on another filesystem (default: inside the workdir)')
+    parser.add_argument('--force-copy', action='store_true', help='copy instead of renaming even on the same filesystem')
+    parser.add_argument('--card-grouping', choices=processing.CARD_GROUPINGS, default='none', help='make one card per flag and/or folder')
+    parser.add_argument('--no-rate-limit', action='store_true', help="don't throttle requests to Trello's quotas")
+    parser.add_argument('--output', type=Path, help='where to save the JSON results (default: benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--verbose', action='store_true', help='show the console output of the pipeline')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = make_scenarios(args.scale)
+    selected = args.scenarios or list(scenarios)
+    unknown = set(selected) - set(scenarios)
+    if unknown:
+        raise SystemExit(f'Unknown scenario(s): {", ".join(sorted(unknown))}')
+
+    if args.no_rate_limit:
+        trello.KEY_RATE_LIMIT = trello.TOKEN_RATE_LIMIT = (10**9, 1.0)
+
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix='reorg_bench_'))
+    results = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'options': {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items()},
+               'scenarios': {}}
+    try:
+        with FakeTrelloServer(latency=args.latency, error_rate=args.error_rate) as server:
+            trello.BASE_URL = server.url
+            for name in selected:
+                reorg_dir = (args.reorg_dir or workdir / 'reorg') / name
+                print(f'Running {name}... ', end='', flush=True)
+                metrics = run_scenario(name, *scenarios[name], workdir, reorg_dir, server, args.force_copy, args.verbose, args.card_grouping)
+                results['scenarios'][name] = metrics
+                print(f"{metrics['seconds']:.2f}s, {metrics['moves_per_second']} moves/s, {metrics['mb_per_second']} MB/s, " +
+                      f"{metrics['cards_per_second']} cards/s, p50 {metrics['latency_p50_ms']} ms, p99 {metrics['latency_p99_ms']} ms")
+                if args.reorg_dir:
+                    shutil.rmtree(reorg_dir, ignore_errors=True)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open('w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results saved to {output}')
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Generators for synthetic source trees. Each function creates its items
+directly inside root and returns their names
+"""
+from pathlib import Path
+import os
+
+BLOCK = os.urandom(1024 * 1024)     #written repeatedly, so large files don't cost much CPU to generate
+
+def write_file(path: Path, size: int):
+    with path.open('wb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = BLOCK[:min(remaining, len(BLOCK))]
+            f.write(chunk)
+            remaining -= len(chunk)
+
+def small_files(root: Path, count: int, size: int = 4096):
+    """Many small files"""
+    names = []
+    for i in range(count):
+        name = f'small_{i:06d}.dat'
+        write_file(root / name, size)
+        names.append(name)
+    return names
+
+def large_files(root: Path, count: int, size: int):
+    """A few huge files"""
+    names = []
+    for i in range(count):
+        name = f'large_{i:03d}.bin'
+        write_file(root / name, size)
+        names.append(name)
+    return names
+
+def deep_trees(root: Path, count: int, depth: int, files_per_dir: int, size: int = 4096):
+    """Directories nested depth levels deep, with files_per_dir files at every level"""
+    names = []
+    for i in range(count):
+        name = f'tree_{i:04d}'
+        directory = root / name
+        for level in range(depth):
+            directory.mkdir()
+            for j in range(files_per_dir):
+                write_file(directory / f'file_{j}.dat', size)
+            directory = directory / f'level_{level + 1}'
+        names.append(name)
+    return names
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Hands flagged entries back once their cards are resolved on the board (archived,
+deleted, moved off the board or to one of the CARD_RESOLVED_LISTS). Only the
+board actions since the last poll are read, and the cards seen so far are kept
+in card_cache.db. Needs the card outbox (see outbox.py).
+
+Usage (polls once and writes a manifest for batch.py with the entries whose cards
+were resolved, by absolute path):
+    python card_sync.py [--config config.ini] > resolved.csv
+    python batch.py resolved.csv --config config.ini
+"""
+from pathlib import Path
+from datetime import datetime, timezone
+from contextlib import redirect_stdout
+import argparse
+import csv
+import sqlite3
+import sys
+import threading
+import time
+import metrics
+import outbox
+import processing
+import trello
+
+# Actions that can resolve a card (ref: https://developer.atlassian.com/cloud/trello/guides/rest-api/action-types/)
+RESOLVING_ACTIONS = 'updateCard:closed,updateCard:idList,deleteCard,moveCardFromBoard'
+SINCE_MARGIN = 3600.0       #seconds subtracted from the first cursor, in case the clocks disagree
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cards (
+    card_id TEXT PRIMARY KEY,
+    list_id TEXT,
+    closed INTEGER NOT NULL DEFAULT 0,
+    gone INTEGER NOT NULL DEFAULT 0,
+    action_date TEXT,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class CardCache:
+    """The list and state of the cards seen in the board's actions, and the sync cursor"""
+    def __init__(self, cache_path: Path):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def get_state(self, key: str):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def apply(self, actions, state: dict):
+        """Record the changes made by actions (oldest first) and the new state values
+        (e.g. the cursor) in a single transaction"""
+        now = time.time()
+        with self.lock, self.connection:
+            for action in actions:
+                data = action.get('data') or {}
+                card = data.get('card') or {}
+                if 'id' not in card:
+                    continue
+                self.connection.execute('INSERT OR IGNORE INTO cards (card_id, updated) VALUES (?, ?)', (card['id'], now))
+                changes = {'action_date': action.get('date')}
+                if action.get('type') in ('deleteCard', 'moveCardFromBoard'):
+                    changes['gone'] = 1
+                if 'closed' in (data.get('old') or {}):
+                    changes['closed'] = int(bool(card.get('closed')))
+                if 'idList' in (data.get('old') or {}):
+                    changes['list_id'] = (data.get('listAfter') or {}).get('id') or card.get('idList')
+                self.connection.execute(f"UPDATE cards SET {', '.join(f'{column} = ?' for column in changes)}, updated = ? WHERE card_id = ?",
+                                        (*changes.values(), now, card['id']))
+            self.connection.executemany('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', state.items())
+
+    def resolved(self, card_ids, resolved_list_ids=()):
+        """Returns the set of card_ids whose cards are archived, gone, or in one of the resolved lists"""
+        card_ids = list(card_ids)
+        resolved = set()
+        with self.lock:
+            for start in range(0, len(card_ids), 500):      #stay under SQLite's limit on parameters
+                chunk = card_ids[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT card_id, list_id, closed, gone FROM cards WHERE card_id IN ({', '.join('?' * len(chunk))})", chunk)
+                resolved.update(card_id for card_id, list_id, closed, gone in rows
+                                if closed or gone or list_id in resolved_list_ids)
+        return resolved
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class CardSync:
+    """Polls a board for cards that have been resolved, and marks the outbox issues
+    behind them as resolved"""
+    def __init__(self, outbox: outbox.Outbox, cache: CardCache, board_id: str, resolved_list_ids, api_key, oath_token):
+        self.outbox = outbox
+        self.cache = cache
+        self.board_id = board_id
+        self.resolved_list_ids = set(resolved_list_ids)
+        self.api_key = api_key
+        self.oath_token = oath_token
+
+    @metrics.timed('card_sync.poll')
+    def poll(self):
+        """Read the actions since the last poll, and return the open issues (see
+        Outbox.issues) whose cards have been resolved, after marking them resolved.
+        Raises TrelloError if the actions can't be read"""
+        issues = self.outbox.issues('open')
+        if not issues:
+            return []
+        since = self.cache.get_state('since')
+        if since is None:
+            since = datetime.fromtimestamp(min(issue['created'] for issue in issues) - SINCE_MARGIN, timezone.utc).isoformat()
+        etag = self.cache.get_state('etag')
+
+        # Newest first, so page backwards until the cursor is reached
+        actions, etag = trello.get_board_actions(self.board_id, RESOLVING_ACTIONS, since, self.api_key, self.oath_token, etag=etag)
+        if actions is None:
+            metrics.count('card_sync_not_modified')
+            actions = []
+        page = actions
+        while len(page) == trello.MAX_ACTIONS:
+            page, _ = trello.get_board_actions(self.board_id, RESOLVING_ACTIONS, since, self.api_key, self.oath_token,
+                                               before=page[-1]['id'])
+            actions += page
+        metrics.count('card_sync_actions', len(actions))
+
+        # The ETag only describes the response for this cursor, so it is dropped when the cursor moves
+        state = {'since': actions[0]['id'], 'etag': None} if actions else {'since': since, 'etag': etag}
+        self.cache.apply(reversed(actions), state)
+
+        resolved_cards = self.cache.resolved({issue['card_id'] for issue in issues}, self.resolved_list_ids)
+        resolved = [issue for issue in issues if issue['card_id'] in resolved_cards]
+        self.outbox.set_issue_status([issue['id'] for issue in resolved], 'resolved')
+        return resolved
+
+def resolved_entry(issue: dict):
+    """The table entry of a resolved issue, with its flag and issue message cleared"""
+    e = processing.TableEntry(*issue['entry'])
+    return e._replace(flag='', issue_message='')
+
+def resolve_list_ids(settings: dict, id_cache=None):
+    """Returns the IDs of the CARD_RESOLVED_LISTS (a comma-space delimited list of
+    list names on the board), using the ID cache where possible. Lists that can't
+    be found are left out"""
+    list_ids = []
+    for list_name in [name for name in settings.get('CARD_RESOLVED_LISTS', '').split(', ') if name != '']:
+        try:
+            list_ids.append(trello.cached_lookup(id_cache, f"list:{settings['BOARD_ID']}:{list_name}",
+                                                 lambda: trello.find_list(settings['BOARD_ID'], list_name,
+                                                                          settings['API_KEY'], settings['OATH_TOKEN'])))
+        except trello.TrelloError as e:
+            print(f'Warning! {e}. Cards moved to it will not count as resolved')
+    if id_cache is not None:
+        id_cache.save()
+    return list_ids
+
+def open_sync(settings: dict, id_cache, error_log_path: Path):
+    """Returns a CardSync for the outbox and card cache next to error_log_path"""
+    return CardSync(outbox.Outbox(error_log_path.with_name(processing.OUTBOX_FILE_NAME)),
+                    CardCache(error_log_path.with_name(processing.CARD_CACHE_FILE_NAME)),
+                    settings['BOARD_ID'], resolve_list_ids(settings, id_cache),
+                    settings['API_KEY'], settings['OATH_TOKEN'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find the flagged entries whose cards have been resolved, writing a manifest for batch.py')
+    parser.add_argument('--config', type=Path, default=Path(__file__).parent / 'config.ini', help='configuration file')
+    parser.add_argument('--logs', type=Path, default=Path(__file__).parent, help='folder with error.log and card_outbox.db')
+    args = parser.parse_args(argv)
+
+    with redirect_stdout(sys.stderr):      #standard output is for the manifest
+        settings, id_cache = processing.load_settings(args.config)
+        sync = open_sync(settings, id_cache, args.logs / 'error.log')
+    try:
+        sync.poll()
+        issues = sync.outbox.issues('resolved')
+        writer = csv.writer(sys.stdout)
+        writer.writerow(processing.ENTRY_FIELDS)
+        for issue in issues:
+            writer.writerow([issue['source'], *resolved_entry(issue)[1:]])
+        sync.outbox.set_issue_status([issue['id'] for issue in issues], 'cleared')
+        print(f'{len(issues)} resolved issue(s)', file=sys.stderr)
+    finally:
+        sync.outbox.close()
+        sync.cache.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Prefix index of the category folders under REORG_DIRECTORY, used to
+autocomplete the cat1, cat2 and cat3 columns.
+
+The folders at each level are kept in sorted arrays (one per parent folder),
+so the completions for a prefix are found with a binary search followed by a
+short scan. The index is filled by a background thread at startup, and new
+folders are added as items are moved into them.
+"""
+from pathlib import Path
+import bisect
+import os
+import threading
+
+MAX_DEPTH = 3       #cat1/cat2/cat3
+
+class CategoryIndex:
+    """Sorted folder names for each parent folder (a tuple of category names, () for cat1)"""
+    def __init__(self, reorg_directory: Path):
+        self.reorg_directory = reorg_directory
+        self.keys = {}          #maps parent to a sorted list of casefolded names
+        self.names = {}         #maps parent to the names, in the same order as keys
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def start(self):
+        """Build the index on a background thread"""
+        threading.Thread(target=self.build, daemon=True).start()
+        return self
+
+    def build(self):
+        """List the folders under reorg_directory, up to MAX_DEPTH levels deep"""
+        try:
+            pending = [()]
+            while pending:
+                parent = pending.pop()
+                try:
+                    with os.scandir(self.reorg_directory.joinpath(*parent)) as entries:
+                        names = [entry.name for entry in entries if entry.is_dir()]
+                except OSError:
+                    continue
+                for name in names:
+                    self.insert(parent, name)
+                    if len(parent) + 1 < MAX_DEPTH:
+                        pending.append(parent + (name,))
+        finally:
+            self.ready.set()
+
+    def insert(self, parent: tuple, name: str):
+        key = name.casefold()
+        with self.lock:
+            keys = self.keys.setdefault(parent, [])
+            names = self.names.setdefault(parent, [])
+            index = bisect.bisect_left(keys, key)
+            while index < len(keys) and keys[index] == key:
+                if names[index] == name:
+                    return      #already indexed
+                index += 1
+            keys.insert(index, key)
+            names.insert(index, name)
+
+    def add(self, folder: Path):
+        """Add a folder (and the folders above it) below reorg_directory, e.g. after
+        an item was moved into it. Folders outside reorg_directory are ignored"""
+        try:
+            parts = folder.relative_to(self.reorg_directory).parts
+        except ValueError:
+            return
+        for depth in range(min(len(parts), MAX_DEPTH)):
+            self.insert(parts[:depth], parts[depth])
+
+    def complete(self, parent: tuple, prefix: str, limit: int = 10):
+        """Returns up to limit folder names in parent that start with prefix
+        (ignoring case), in alphabetical order"""
+        key = prefix.casefold()
+        with self.lock:
+            keys = self.keys.get(tuple(parent))
+            if not keys:
+                return []
+            names = self.names[tuple(parent)]
+            index = bisect.bisect_left(keys, key)
+            matches = []
+            while index < len(keys) and len(matches) < limit and keys[index].startswith(key):
+                matches.append(names[index])
+                index += 1
+            return matches
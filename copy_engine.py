@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for copying files and directories across devices in large chunks,
+using kernel-side copying where the platform supports it.
+
+Each file is copied to a staging file '<name>.part' next to its destination,
+and a sidecar checkpoint '<name>.part.ckpt' records how many bytes have been
+safely written. If a copy is interrupted, the next attempt resumes from the
+checkpoint instead of starting over. Directories are staged the same way, in
+'<name>.part/', and renamed into place once every file has been copied.
+"""
+from pathlib import Path
+import errno
+import json
+import os
+import shutil
+import metrics
+
+CHUNK_SIZE = 64 * 1024 * 1024       #bytes copied per system call
+MTIME_TOLERANCE_NS = 2 * 10**9      #some filesystems (e.g. FAT, SMB) only store mtime to the nearest 2 seconds
+PART_SUFFIX = '.part'
+CHECKPOINT_SUFFIX = '.ckpt'
+
+def staging_path(destination: Path):
+    """Returns the path that destination is copied to before it is renamed into place"""
+    return destination.with_name(destination.name + PART_SUFFIX)
+
+def checkpoint_path(destination: Path):
+    """Returns the path of the sidecar checkpoint for destination"""
+    return destination.with_name(destination.name + PART_SUFFIX + CHECKPOINT_SUFFIX)
+
+def read_checkpoint(destination: Path, source_stat):
+    """Returns the number of bytes that were already copied to the staging file
+    for destination, or 0 if there is no checkpoint or it belongs to a different
+    version of the source"""
+    try:
+        with checkpoint_path(destination).open() as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    if (checkpoint.get('size') != source_stat.st_size or
+        checkpoint.get('mtime_ns') != source_stat.st_mtime_ns):
+        return 0
+    return int(checkpoint.get('offset', 0))
+
+def write_checkpoint(destination: Path, source_stat, offset: int):
+    """Atomically record that the first `offset` bytes of destination are on disk"""
+    ckpt = checkpoint_path(destination)
+    tmp = ckpt.with_name(ckpt.name + '.tmp')
+    with tmp.open('w') as f:
+        json.dump({'size': source_stat.st_size, 'mtime_ns': source_stat.st_mtime_ns, 'offset': offset}, f)
+    os.replace(tmp, ckpt)
+
+def copy_chunk(src_fd: int, dst_fd: int, offset: int, count: int):
+    """Copies up to `count` bytes starting at `offset` and returns the number of
+    bytes copied. Tries copy_file_range, then sendfile, then a plain read/write"""
+    if hasattr(os, 'copy_file_range'):
+        try:
+            return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            return os.sendfile(dst_fd, src_fd, offset, count)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                raise
+    data = os.pread(src_fd, count, offset) if hasattr(os, 'pread') else _read_at(src_fd, offset, count)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    return os.write(dst_fd, data)
+
+def _read_at(fd: int, offset: int, count: int):
+    """Fallback for platforms without os.pread (e.g. Windows)"""
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, count)
+
+def verify_copy(source_stat, destination: Path):
+    """Returns True if destination has the same size and (within tolerance) the
+    same mtime as the source"""
+    dest_stat = destination.stat()
+    return (dest_stat.st_size == source_stat.st_size and
+            abs(dest_stat.st_mtime_ns - source_stat.st_mtime_ns) <= MTIME_TOLERANCE_NS)
+
+def verify_tree(source: Path, destination: Path):
+    """Returns True if every item still in the directory source has a copy at the same
+    relative path in destination, with matching sizes and mtimes for files (see
+    verify_copy). Items that are only in destination are allowed, because deleting
+    the source may have been interrupted after some of it was removed"""
+    try:
+        for dirpath, dirnames, filenames in os.walk(source):
+            relative = Path(dirpath).relative_to(source)
+            for dirname in dirnames:
+                if not (destination / relative / dirname).is_dir():
+                    return False
+            for filename in filenames:
+                src = Path(dirpath) / filename
+                dst = destination / relative / filename
+                if src.is_symlink():
+                    if not dst.is_symlink():
+                        return False
+                elif not dst.is_file() or not verify_copy(src.stat(), dst):
+                    return False
+    except OSError:
+        return False
+    return True
+
+def copy_file(source: Path, destination: Path, progress=None, chunk_size: int = CHUNK_SIZE):
+    """Copies source to destination in chunks, resuming from a checkpoint if a
+    previous copy was interrupted, and preserving timestamps and permissions.
+    - progress, if given, is called as progress(source, bytes_in_chunk, bytes_copied, total_bytes)
+    Raises CopyError if the finished copy does not match the source"""
+    source_stat = source.stat()
+    total = source_stat.st_size
+    part = staging_path(destination)
+
+    # Resume from the checkpoint, but never past what the staging file actually holds
+    offset = 0
+    if part.exists():
+        offset = min(read_checkpoint(destination, source_stat), part.stat().st_size)
+
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    src_fd = os.open(source, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        dst_fd = os.open(part, flags, 0o666)
+        try:
+            os.ftruncate(dst_fd, offset)    #discard anything written after the last checkpoint
+            if offset and progress is not None:
+                progress(source, offset, offset, total)
+            while offset < total:
+                with metrics.span('copy.data'):
+                    copied = copy_chunk(src_fd, dst_fd, offset, min(chunk_size, total - offset))
+                if copied == 0:
+                    raise CopyError(f'Source ended early: {source}')
+                offset += copied
+                with metrics.span('copy.checkpoint'):
+                    os.fsync(dst_fd)            #data must be on disk before the checkpoint claims it is
+                    write_checkpoint(destination, source_stat, offset)
+                if progress is not None:
+                    progress(source, copied, offset, total)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    # Finish the file and verify it before it takes the destination name
+    with metrics.span('copy.verify'):
+        shutil.copystat(source, part)
+        if not verify_copy(source_stat, part):
+            raise CopyError(f'Copy does not match source: {destination}')
+    os.replace(part, destination)
+    metrics.count('files_touched')
+    checkpoint_path(destination).unlink(missing_ok=True)
+
+def copy_tree(source: Path, destination: Path, progress=None, chunk_size: int = CHUNK_SIZE):
+    """Copies the directory source to destination, resuming any files that were
+    only partially copied and skipping files that were already copied"""
+    destination.mkdir(parents=False, exist_ok=True)
+    for entry in os.scandir(source):
+        src = Path(entry.path)
+        dst = destination / entry.name
+        if entry.is_symlink():
+            if not os.path.lexists(dst):
+                os.symlink(os.readlink(src), dst)
+        elif entry.is_dir():
+            copy_tree(src, dst, progress, chunk_size)
+        elif dst.exists() and verify_copy(entry.stat(), dst):
+            if progress is not None:
+                size = entry.stat().st_size
+                progress(src, size, size, size)
+        else:
+            copy_file(src, dst, progress, chunk_size)
+    shutil.copystat(source, destination)   #after the files, so that copying them doesn't change the directory's mtime
+
+def move(source: Path, destination: Path, progress=None, chunk_size: int = CHUNK_SIZE):
+    """Moves source to destination on another device. The source is only deleted
+    after every copied file has been verified at the destination"""
+    if source.is_dir() and not source.is_symlink():
+        part = staging_path(destination)
+        copy_tree(source, part, progress, chunk_size)
+        os.replace(part, destination)
+        shutil.rmtree(source)
+    elif source.is_symlink():
+        os.symlink(os.readlink(source), destination)
+        source.unlink()
+    else:
+        copy_file(source, destination, progress, chunk_size)
+        source.unlink()
+
+class CopyError(Exception):
+    pass
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Queue of source directories to work through one after another.
+
+Listing a large directory (especially on a network share) can take a while, so
+the next few queued directories are listed ahead of time, in parallel, on a
+small thread pool. By the time one directory is finished, the next one has
+usually been listed already, and can be shown straight away.
+"""
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import itertools
+
+class DirectoryQueue:
+    """Directories waiting to be worked on, in the order they were added.
+    - list_directory(directory) returns the listing of a directory. It is called on
+      the thread pool, for the first prefetch directories in the queue
+    Not thread-safe: use from a single thread (e.g. the Tk main thread)"""
+    def __init__(self, list_directory, workers: int = 4, prefetch: int = 4):
+        self.list_directory = list_directory
+        self.prefetch = prefetch
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan')
+        self.waiting = deque()      #[directory, future], where future is None until listing starts
+
+    def add(self, directories):
+        """Queue directories that aren't queued yet, and start listing them if they are near the front"""
+        queued = {directory for directory, future in self.waiting}
+        for directory in directories:
+            directory = Path(directory)
+            if directory not in queued:
+                self.waiting.append([directory, None])
+                queued.add(directory)
+        self.fill()
+
+    def fill(self):
+        """Start listing the first prefetch directories, if they aren't being listed already"""
+        for item in itertools.islice(self.waiting, self.prefetch):
+            if item[1] is None:
+                item[1] = self.executor.submit(self.list_directory, item[0])
+
+    def pop(self):
+        """Returns (directory, future) for the next directory, where future.result() is
+        its listing (or raises the error that listing it raised)"""
+        directory, future = self.waiting.popleft()
+        if future is None:
+            future = self.executor.submit(self.list_directory, directory)
+        self.fill()
+        return directory, future
+
+    def directories(self):
+        return [directory for directory, future in self.waiting]
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def shutdown(self):
+        for item in self.waiting:
+            if item[1] is not None:
+                item[1].cancel()
+        self.executor.shutdown(wait=False)
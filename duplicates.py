@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Finds files with identical contents, so that they can be flagged as duplicates.
+
+Hashing every file would read the whole tree, so candidates are narrowed down
+in stages: files are grouped by size, files of the same size are compared by a
+hash of their first and last HASH_CHUNK_SIZE bytes, and only the files that
+still collide are hashed in full. Hashing runs on a process pool.
+
+Hashes are cached in a SQLite file keyed by (device, inode, size, mtime_ns), so
+later runs only hash files that are new or have changed. Empty files and
+symlinks are ignored, and only one path of a file with several hard links is
+considered.
+
+Usage (writes a manifest for batch.py to standard output, flagging every copy
+but one in each group):
+    python duplicates.py [DIR] [--reorg-dir DIR] [--cache hash_cache.db] [--flag d]
+"""
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import csv
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+import sys
+
+HASH_CHUNK_SIZE = 64 * 1024     #bytes read from each end of a file for the partial hash
+READ_SIZE = 1024 * 1024         #bytes read at a time for the full hash
+MIN_POOL_FILES = 16             #smaller jobs are hashed in this process, without starting a pool
+
+# Identity of a file's contents as of its last modification
+FileInfo = namedtuple('FileInfo', 'path dev inode size mtime_ns')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    partial TEXT,
+    full TEXT,
+    PRIMARY KEY (dev, inode, size, mtime_ns)
+);
+"""
+
+class HashCache:
+    """Partial and full hashes of files, keyed by (dev, inode, size, mtime_ns).
+    A file that is modified gets a new key, so stale hashes are never used"""
+    def __init__(self, cache_path: Path):
+        self.connection = sqlite3.connect(cache_path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def get(self, info: FileInfo, column: str):
+        row = self.connection.execute(f'SELECT {column} FROM hashes WHERE dev = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+                                      (info.dev, info.inode, info.size, info.mtime_ns)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, hashes: dict, column: str):
+        """Store the hashes (a dictionary mapping FileInfo to hash) of one kind"""
+        with self.connection:
+            for info, digest in hashes.items():
+                key = (info.dev, info.inode, info.size, info.mtime_ns)
+                self.connection.execute('INSERT OR IGNORE INTO hashes (dev, inode, size, mtime_ns) VALUES (?, ?, ?, ?)', key)
+                self.connection.execute(f'UPDATE hashes SET {column} = ? WHERE dev = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+                                        (digest, *key))
+
+    def close(self):
+        self.connection.close()
+
+def partial_hash(path: str, size: int):
+    """Hash of the first and last HASH_CHUNK_SIZE bytes of a file (of all of it, if it is
+    small enough). Returns None if the file can't be read"""
+    digest = hashlib.blake2b(digest_size=20)
+    try:
+        with open(path, 'rb') as f:
+            digest.update(f.read(HASH_CHUNK_SIZE))
+            if size > 2 * HASH_CHUNK_SIZE:
+                f.seek(-HASH_CHUNK_SIZE, os.SEEK_END)
+            digest.update(f.read(HASH_CHUNK_SIZE))
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+def full_hash(path: str, size: int):
+    """Hash of a whole file, or None if it can't be read"""
+    digest = hashlib.blake2b(digest_size=20)
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+def list_files(roots):
+    """Yields a FileInfo for every non-empty regular file under the given directories"""
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if st.st_size > 0 and not os.path.islink(path):
+                    yield FileInfo(Path(path), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def group_by(infos, key):
+    """Returns the groups of infos with more than one member, by key(info)"""
+    groups = {}
+    for info in infos:
+        groups.setdefault(key(info), []).append(info)
+    return [group for group in groups.values() if len(group) > 1]
+
+def hash_files(infos, hash_function, column: str, cache: HashCache = None, pool=None):
+    """Returns a dictionary mapping each FileInfo to its hash (files that couldn't be
+    read are left out), using the cached hashes where possible. Each inode is only
+    hashed once, so hard links aren't read twice"""
+    hashes = {}
+    todo = {}       #maps (dev, inode) to the FileInfo that will be hashed
+    for info in infos:
+        digest = cache.get(info, column) if cache is not None else None
+        if digest is not None:
+            hashes[info] = digest
+        else:
+            todo.setdefault((info.dev, info.inode), info)
+
+    jobs = list(todo.values())
+    args = ([str(info.path) for info in jobs], [info.size for info in jobs])
+    if pool is not None and len(jobs) >= MIN_POOL_FILES:
+        results = pool.map(hash_function, *args, chunksize=max(1, len(jobs) // 64))
+    else:
+        results = map(hash_function, *args)
+    computed = {info: digest for info, digest in zip(jobs, results) if digest is not None}
+    if cache is not None:
+        cache.put(computed, column)
+
+    for info in infos:
+        if info not in hashes:
+            digest = computed.get(todo[(info.dev, info.inode)])
+            if digest is not None:
+                hashes[info] = digest
+    return hashes
+
+def find_duplicates(roots, cache_path: Path = None, workers: int = None):
+    """Returns the groups of files under roots with identical contents, as lists of
+    Paths sorted by path. cache_path, if given, is the SQLite hash cache"""
+    files = {}
+    for info in list_files(roots):
+        files.setdefault((info.dev, info.inode), info)      #hard links to the same file aren't copies of it
+    files = files.values()
+    candidates = [info for group in group_by(files, lambda info: info.size) for info in group]
+    if not candidates:
+        return []
+
+    cache = HashCache(cache_path) if cache_path is not None else None
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))     #forking a threaded process (e.g. main.py) can deadlock
+    try:
+        partial = hash_files(candidates, partial_hash, 'partial', cache, pool)
+        colliding = group_by(partial, lambda info: (info.size, partial[info]))
+
+        # Files no bigger than both chunks were read completely by the partial hash
+        large = [info for group in colliding for info in group if info.size > 2 * HASH_CHUNK_SIZE]
+        full = hash_files(large, full_hash, 'full', cache, pool)
+        hashed = [info for group in colliding for info in group if info.size <= 2 * HASH_CHUNK_SIZE or info in full]
+        groups = group_by(hashed, lambda info: (info.size, full.get(info, partial[info])))
+    finally:
+        pool.shutdown()
+        if cache is not None:
+            cache.close()
+    return sorted((sorted(info.path for info in group) for group in groups), key=lambda group: group[0])
+
+def copies_to_flag(groups, keep_under: Path = None):
+    """Returns a dictionary mapping each file that is a redundant copy to the copy
+    that is kept. Copies under keep_under (e.g. REORG_DIRECTORY, which has already
+    been organized) are always kept; otherwise the first path in each group is"""
+    duplicates = {}
+    for group in groups:
+        kept = [path for path in group if keep_under is not None and is_under(path, keep_under)] or group[:1]
+        for path in group:
+            if path not in kept:
+                duplicates[path] = kept[0]
+    return duplicates
+
+def is_under(path: Path, directory: Path):
+    try:
+        path.relative_to(directory)
+    except ValueError:
+        return False
+    return True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find files with identical contents, writing a manifest for batch.py that flags every copy but one')
+    parser.add_argument('directory', type=Path, nargs='?', default=Path.cwd(), help='directory to search (default: current directory)')
+    parser.add_argument('--reorg-dir', type=Path, help='also compare with the files in this directory (which are never flagged)')
+    parser.add_argument('--cache', type=Path, help='hash cache file, so that unchanged files are not hashed again')
+    parser.add_argument('--flag', default='d', help='flag for the duplicates (default: d)')
+    parser.add_argument('--workers', type=int, help='hashing processes (default: one per CPU)')
+    args = parser.parse_args(argv)
+
+    directory = args.directory.resolve()
+    roots = [directory] + ([args.reorg_dir.resolve()] if args.reorg_dir is not None else [])
+    groups = find_duplicates(roots, args.cache, args.workers)
+    duplicates = copies_to_flag(groups, args.reorg_dir.resolve() if args.reorg_dir is not None else None)
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(('name', 'flag', 'cat1', 'cat2', 'cat3', 'issue_message'))
+    for path, original in sorted(duplicates.items()):
+        writer.writerow([path.relative_to(directory), args.flag, '', '', '', f'Duplicate of {original}'])
+    print(f'{len(duplicates)} duplicate(s) found in {len(groups)} group(s)', file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
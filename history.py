@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed history of every move and issue.
+
+change.log and error.log are plain text, so finding out where an item went
+means reading all of them. Every message written to the logs is therefore also
+recorded in a SQLite database, indexed by source, destination, item name, flag
+and time, so that lookups take milliseconds however long the history gets.
+Existing logs can be imported once with the import command.
+
+Usage:
+    python history.py where NAME_OR_PATH          where did an item (or the folder it was in) go?
+    python history.py find [--under DIR] [--flag F] [--kind move|flag] [--since AGE] [--until AGE]
+    python history.py import change.log error.log [--config config.ini]
+Add --db PATH to use another database than history.db next to this script.
+"""
+from pathlib import Path
+from datetime import datetime
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import rules
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S %z'     #the timestamps in the text logs
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    source TEXT NOT NULL,
+    destination TEXT,
+    flag TEXT NOT NULL DEFAULT '',
+    issue_message TEXT NOT NULL DEFAULT '',
+    bytes INTEGER,
+    method TEXT,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_source ON events (source);
+CREATE INDEX IF NOT EXISTS events_destination ON events (destination);
+CREATE INDEX IF NOT EXISTS events_name ON events (name);
+CREATE INDEX IF NOT EXISTS events_flag ON events (flag, time);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE TABLE IF NOT EXISTS imports (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    events INTEGER NOT NULL,
+    time REAL NOT NULL
+);
+"""
+
+# Messages of the text logs (see move_and_log.move_message and error_message)
+MOVE_PATTERN = re.compile(r'moved (?P<name>.+) in (?P<source>.+?[\\/]) to (?P<destination>.+[\\/])$')
+ISSUE_PATTERN = re.compile(r'(?P<issue>[^:]+): (?P<name>.+) in (?P<source>.+[\\/])$')
+
+class History:
+    """SQLite store of moves and issues; changes are committed by commit()"""
+    def __init__(self, history_path: Path):
+        self.history_path = history_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(history_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def add(self, message: str, timestamp: float = None, source=None, destination=None, flag: str = '',
+            issue_message: str = '', bytes: int = None, method: str = None, **ignore):
+        """Record a log message. Messages with a destination are moves, the others are issues"""
+        if source is None:
+            return
+        source = str(source)
+        with self.lock:
+            self.connection.execute(
+                'INSERT INTO events (time, kind, name, source, destination, flag, issue_message, bytes, method, message) ' +
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (timestamp if timestamp is not None else time.time(), 'flag' if destination is None else 'move',
+                 os.path.basename(source.rstrip('\\/')), source, str(destination) if destination is not None else None,
+                 flag or '', issue_message or '', bytes, method, message.rstrip('\n')))
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def query(self, sql: str, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def where(self, item: str, limit: int = 100):
+        """Moves of an item, given by path or by name, newest first. For a path, moves of
+        the folders it was in are included too, since the item went along with them"""
+        if os.sep in item or (os.altsep and os.altsep in item):
+            path = Path(item)
+            candidates = [str(path)] + [str(parent) for parent in path.parents if parent != Path(parent.anchor)]
+            placeholders = ', '.join('?' * len(candidates))
+            return self.query(f"SELECT * FROM events WHERE (kind = 'move' AND source IN ({placeholders})) OR source = ? " +
+                              'ORDER BY time DESC LIMIT ?', (*candidates, str(path), limit))
+        return self.query('SELECT * FROM events WHERE name = ? ORDER BY time DESC LIMIT ?', (item, limit))
+
+    def find(self, under: str = None, flag: str = None, kind: str = None, since: float = None, until: float = None, limit: int = 1000):
+        """Events matching every condition given, newest first. under is a folder that
+        the sources were in (at any depth); since and until are timestamps"""
+        conditions, parameters = [], []
+        if under is not None:
+            prefix = str(Path(under)).rstrip('\\/') + os.sep
+            conditions.append('source >= ? AND source < ?')     #a range, so that the index is used
+            parameters += [prefix, prefix[:-1] + chr(ord(os.sep) + 1)]
+        for column, value in (('flag', flag), ('kind', kind)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                parameters.append(value)
+        if since is not None:
+            conditions.append('time >= ?')
+            parameters.append(since)
+        if until is not None:
+            conditions.append('time < ?')
+            parameters.append(until)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return self.query(f'SELECT * FROM events{where} ORDER BY time DESC LIMIT ?', (*parameters, limit))
+
+    def import_log(self, log_path: Path, flags: dict = None):
+        """Record the messages of an existing change or error log (text, or the JSON Lines
+        written with LOG_JSON = yes). flags maps flag characters to issue types, to find
+        the flags of text messages. Returns the number of events imported, or None if
+        the file was imported before"""
+        size = log_path.stat().st_size
+        with self.lock:
+            if self.connection.execute('SELECT 1 FROM imports WHERE path = ?', (str(log_path.resolve()),)).fetchone():
+                return None
+        flag_for_issue = {issue: flag for flag, issue in (flags or {}).items()}
+        count = 0
+        with log_path.open(encoding='utf-8', errors='replace') as log_file:
+            for line in log_file:
+                event = parse_json_line(line) if '.jsonl' in log_path.suffixes else parse_text_line(line, flag_for_issue)
+                if event is not None:
+                    self.add(**event)
+                    count += 1
+        with self.lock:
+            self.connection.execute('INSERT INTO imports (path, size, events, time) VALUES (?, ?, ?, ?)',
+                                    (str(log_path.resolve()), size, count, time.time()))
+            self.connection.commit()
+        return count
+
+def parse_timestamp(text: str):
+    return datetime.strptime(text, TIMESTAMP_FORMAT).timestamp()
+
+def parse_text_line(line: str, flag_for_issue: dict):
+    """Returns the History.add arguments for a line of a text log, or None if it can't be parsed"""
+    timestamp, sep, message = line.rstrip('\n').partition(' --- ')
+    try:
+        timestamp = parse_timestamp(timestamp)
+    except ValueError:
+        return None
+    match = MOVE_PATTERN.match(message)
+    if match is not None:
+        name = match.group('name').strip('\\/')     #the parents end with the separator of the system that wrote the log
+        return {'message': message, 'timestamp': timestamp, 'source': match.group('source') + name,
+                'destination': match.group('destination') + name}
+    match = ISSUE_PATTERN.match(message)
+    if match is not None:
+        name = match.group('name').strip('\\/')
+        return {'message': message, 'timestamp': timestamp, 'source': match.group('source') + name,
+                'flag': flag_for_issue.get(match.group('issue'), '')}
+    return None
+
+def parse_json_line(line: str):
+    try:
+        record = json.loads(line)
+        timestamp = parse_timestamp(record.pop('timestamp'))
+    except (ValueError, KeyError):
+        return None
+    message = (f"moved {record.get('source')} to {record.get('destination')}" if record.get('destination')
+               else f"{record.get('flag')}: {record.get('source')}")
+    return {'message': message, 'timestamp': timestamp, **record}
+
+def format_event(event, item: str = None):
+    """One line describing an event, for display. If item is the path that was looked
+    up with History.where and the event moved a folder it was in, its new path is shown"""
+    when = time.strftime('%Y-%m-%d %H:%M', time.localtime(event['time']))
+    if event['kind'] == 'move':
+        if item is not None and str(item) != event['source'] and str(item).startswith(event['source']):
+            return f"{when}  moved with {event['source']} -> {event['destination'] + str(item)[len(event['source']):]}"
+        return f"{when}  moved {event['source']} -> {event['destination']}"
+    issue = f" ({event['issue_message']})" if event['issue_message'] else ''
+    return f"{when}  flagged '{event['flag']}' {event['source']}{issue}"
+
+def parse_age(text: str):
+    """Converts an age such as 30d into a timestamp that long ago"""
+    try:
+        return time.time() - rules.parse_age(text)
+    except rules.RulesError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Look up the history of moves and issues')
+    parser.add_argument('--db', type=Path, default=Path(__file__).parent / 'history.db', help='history database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    where = commands.add_parser('where', help='where did an item go?')
+    where.add_argument('item', help='path or name of the item')
+    find = commands.add_parser('find', help='list moves and issues')
+    find.add_argument('--under', help='only items that were inside this folder')
+    find.add_argument('--flag', help='only issues with this flag')
+    find.add_argument('--kind', choices=('move', 'flag'))
+    find.add_argument('--since', type=parse_age, help='only events newer than this age (e.g. 30d)')
+    find.add_argument('--until', type=parse_age, help='only events older than this age')
+    find.add_argument('--limit', type=int, default=1000)
+    importer = commands.add_parser('import', help='import existing change and error logs (once)')
+    importer.add_argument('logs', type=Path, nargs='+')
+    importer.add_argument('--config', type=Path, help='config file whose [Flags] are used to recognize the flags of issues')
+    args = parser.parse_args(argv)
+
+    history = History(args.db)
+    try:
+        if args.command == 'import':
+            flags = {}
+            if args.config is not None:
+                import processing       #here rather than at the top, since processing imports this module
+                config = processing.read_config(args.config)
+                flags = dict(config['Flags']) if config.has_section('Flags') else {}
+            for log_path in args.logs:
+                count = history.import_log(log_path, flags)
+                print(f'{log_path}: ' + ('already imported' if count is None else f'{count} event(s) imported'))
+            return
+        if args.command == 'where':
+            events, item = history.where(args.item), args.item
+        else:
+            events, item = history.find(args.under, args.flag, args.kind, args.since, args.until, args.limit), None
+        for event in events:
+            print(format_event(event, item))
+        print(f'{len(events)} event(s)', file=sys.stderr)
+    finally:
+        history.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Write-ahead journal for processing runs.
+
+Before an entry is moved or flagged, a 'begin' record describing it is
+appended to the journal, and once the entry has been fully processed a 'done'
+record follows. Every record is flushed and synced to disk before the work it
+describes starts, so after a crash the entries with a 'begin' but no 'done'
+are exactly the ones that were interrupted. Those can be finished (or rolled
+back) with recover_move(), and entries that are already done are skipped when
+a batch is run again. The journal is compacted each time it is opened, down to
+one line for each entry.
+"""
+from pathlib import Path
+import json
+import os
+import shutil
+import time
+import copy_engine
+import metrics
+
+TERMINAL_OPS = ('done', 'skipped', 'rolled_back', 'lost')
+
+def move_key(source: Path, destination: Path):
+    return f'move|{source}|{destination}'
+
+def flag_key(source: Path, flag: str):
+    return f'flag|{source}|{flag}'
+
+class Journal:
+    """Append-only JSON Lines journal. Only the last records of unfinished entries
+    are kept in memory, together with the keys of the finished ones"""
+    def __init__(self, journal_path: Path, fsync: bool = True):
+        self.journal_path = journal_path
+        self.fsync = fsync
+        self.records = {}       #maps the key of each unfinished entry to its last record
+        self.done = set()       #keys of the entries that are done
+        self.n_lines = 0        #lines in the journal file
+        if journal_path.exists():
+            self.load()
+            self.compact()
+        self.journal_file = journal_path.open(mode='a', encoding='utf-8')
+
+    def load(self):
+        with self.journal_path.open(encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:      #the last line may be cut short by a crash
+                    continue
+                self.n_lines += 1
+                self.apply(record)
+
+    def apply(self, record: dict):
+        key = record['key']
+        if record['op'] in TERMINAL_OPS:
+            self.records.pop(key, None)
+            if record['op'] == 'done':
+                self.done.add(key)
+            else:
+                self.done.discard(key)      #can be processed again
+        else:
+            self.done.discard(key)
+            self.records[key] = record
+
+    def compact(self):
+        """Rewrite the journal with one line for each entry that is done or unfinished.
+        Nothing is rewritten if there is nothing to drop"""
+        if self.n_lines <= len(self.records) + len(self.done):
+            return
+        tmp = self.journal_path.with_name(self.journal_path.name + '.tmp')
+        with tmp.open(mode='w', encoding='utf-8') as tmp_file:
+            for key in self.done:
+                tmp_file.write(json.dumps({'key': key, 'op': 'done'}) + '\n')
+            for record in self.records.values():
+                tmp_file.write(json.dumps(record) + '\n')
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp, self.journal_path)
+        self.n_lines = len(self.records) + len(self.done)
+
+    def record(self, key: str, op: str, **fields):
+        """Append a record and make sure it is on disk before returning"""
+        self.write({'key': key, 'op': op, 'time': time.time(), **fields})
+
+    def update(self, key: str, **fields):
+        """Add fields (e.g. the progress of a card) to the record of an unfinished entry"""
+        self.write({**self.records[key], 'time': time.time(), **fields})
+
+    def write(self, record: dict):
+        with metrics.span('journal.write'):
+            self.journal_file.write(json.dumps(record) + '\n')
+            self.journal_file.flush()
+            if self.fsync:
+                os.fsync(self.journal_file.fileno())
+        self.n_lines += 1
+        self.apply(record)
+
+    def last_op(self, key: str):
+        record = self.records.get(key)
+        if record is not None:
+            return record['op']
+        return 'done' if key in self.done else None
+
+    def is_done(self, key: str):
+        return key in self.done
+
+    def pending(self):
+        """Returns the 'begin' records of the entries that were interrupted"""
+        return list(self.records.values())
+
+    def close(self):
+        self.journal_file.close()
+
+def remove_staging(destination: Path):
+    """Delete the copy engine's staging file or directory and checkpoint for destination"""
+    part = copy_engine.staging_path(destination)
+    if part.is_dir():
+        shutil.rmtree(part)
+    elif part.exists():
+        part.unlink()
+    copy_engine.checkpoint_path(destination).unlink(missing_ok=True)
+
+def recover_move(source: Path, destination: Path, rollback: bool = False):
+    """Inspect the filesystem after an interrupted move and finish or roll it back.
+    Returns one of:
+    - 'completed': the move had finished; nothing was left to do
+    - 'finished': the copy had finished but the source was not (fully) deleted, so it was deleted now
+    - 'not_started': the source is intact and must be moved again (a partial copy will be resumed),
+      or the destination doesn't match the source, so neither was touched
+    - 'rolled_back': the source is intact and the partial copy at the destination was deleted
+    - 'lost': neither the source nor the destination exists"""
+    source_exists = os.path.lexists(source)
+    destination_exists = os.path.lexists(destination)
+
+    if destination_exists and not source_exists:
+        return 'completed'
+
+    if destination_exists and source_exists:
+        # The copy engine only gives the destination its final name after every
+        # file was verified, so all that is left is deleting the source. Unless the
+        # destination matches what is left of the source, it is unrelated to this
+        # move (e.g. it existed already), so both are left alone
+        if source.is_dir() and not source.is_symlink():
+            if not copy_engine.verify_tree(source, destination):
+                return 'not_started'
+            shutil.rmtree(source)
+        elif source.is_file() and not source.is_symlink() and not copy_engine.verify_copy(source.stat(), destination):
+            return 'not_started'
+        else:
+            source.unlink()
+        return 'finished'
+
+    if source_exists:
+        if rollback:
+            remove_staging(destination)
+            return 'rolled_back'
+        return 'not_started'
+
+    return 'lost'
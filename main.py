@@ -11,20 +11,110 @@ from pathlib import Path
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
-import trello
-import move_and_log
-from collections import namedtuple
+import sys
+from contextlib import nullcontext
+import processing
+import metrics
 import time
-import configparser
 import os
+import queue
+import threading
+import itertools
+import table_model
+import rules
+import categories
+import duplicates
+import directory_queue
+import history
+import card_sync
+
+PROGRESS_POLL_MS = 100     #how often the UI checks for progress events from the worker
+SCAN_CHUNK_SIZE = 500      #directory entries streamed into the table per after() callback
+SCAN_POLL_MS = 20          #how often the UI checks for entries from the directory scanner
+WINDOWED_THRESHOLD = 5000  #tables with more rows than this only materialize the visible rows
+CATEGORY_COLUMNS = (2, 3, 4)  #indexes of the cat1, cat2 and cat3 columns
+MAX_COMPLETIONS = 8        #category names suggested while a cell is edited
+DUPLICATE_FLAG = 'd'       #flag given to files whose contents duplicate another file
+FILTER_DELAY_MS = 150      #pause in typing before the filter is applied
+SORT_CHOICES = ('name', 'flag', 'cat1', 'cat2', 'cat3', 'issue', 'size', 'modified')    #columns by index, then the item's metadata
+
+def scan_names(current_dir: Path, chunk_size: int = SCAN_CHUNK_SIZE):
+    """Yields (dirs, files) tuples of item names in current_dir, chunk_size entries
+    at a time, in a single os.scandir pass. The entry type comes from the d_type
+    cached by scandir, so no extra stat call is made per entry"""
+    dirs, files = [], []
+    with os.scandir(current_dir) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+            except OSError:     #entry vanished or can't be read
+                continue
+            if len(dirs) + len(files) >= chunk_size:
+                yield dirs, files
+                dirs, files = [], []
+    if dirs or files:
+        yield dirs, files
 
 def list_names(current_dir: Path):
-    """Returns a list of the absolute paths of the items in current_dir,
+    """Returns a list of the names of the items in current_dir,
     with directories before files"""
-    dirs = [p.name for p in current_dir.iterdir() if p.is_dir()]
-    files = [p.name for p in current_dir.iterdir() if p.is_file()]
-    contents = dirs + files
-    return contents
+    dirs, files = list_dirs_and_files(current_dir)
+    return dirs + files
+
+def list_dirs_and_files(current_dir: Path):
+    """Returns (dirs, files), the names of the directories and files in current_dir"""
+    dirs, files = [], []
+    for d, f in scan_names(current_dir):
+        dirs.extend(d)
+        files.extend(f)
+    return dirs, files
+
+def scan_changed(directories, mtimes=None):
+    """Lists each of directories, given as (key, path) pairs, and returns a list of
+    (key, mtime_ns, dirs, files) tuples. If mtimes (a dictionary mapping keys to the
+    mtime_ns of the last listing) is given, directories whose modification time is
+    unchanged are skipped, since no item has been added, removed or renamed in them.
+    Directories that can't be read are left out. Runs on a background thread"""
+    changed = []
+    for key, path in directories:
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns      #before listing, so changes made during it are found next time
+            if mtimes is not None and mtimes.get(key) == mtime_ns:
+                continue
+            dirs, files = list_dirs_and_files(path)
+        except OSError:
+            continue
+        changed.append((key, mtime_ns, dirs, files))
+    return changed
+
+def scan_worker(current_dir: Path, out_queue: queue.Queue):
+    """Streams the contents of current_dir into out_queue as ('chunk', dirs, files)
+    events, followed by ('done',). Runs on a background thread"""
+    try:
+        with metrics.span('listing'):
+            for dirs, files in scan_names(current_dir):
+                out_queue.put(('chunk', dirs, files))
+    except OSError as e:
+        out_queue.put(('error', e))
+    finally:
+        out_queue.put(('done',))
+
+def stat_rows(paths):
+    """Returns a dictionary mapping each iid of paths, given as (iid, path) pairs, to the
+    (st_size, st_mtime) of its item, or None if it can't be read. Runs on a background thread"""
+    stats = {}
+    with metrics.span('table.stat'):
+        for iid, path in paths:
+            try:
+                stat = os.stat(path)     #relative to the current directory
+            except OSError:
+                stats[iid] = None
+            else:
+                stats[iid] = (stat.st_size, stat.st_mtime)
+    return stats
 
 class Table:
     def __init__(self, parent, row_names, column_names, column_widths, heading_names):
@@ -33,30 +123,319 @@ class Table:
         self.tree.grid(row=0, column=0, columnspan=2, sticky='n')
 
         # Initialize instance attributes
-        self.row_names = row_names
         self.column_names = column_names
         self.column_ids = ['#'+str(i) for i in range(len(column_names))]
         self.column_widths = column_widths
         self.heading_names = heading_names
+        self.scrollbar = None
+
+        # The model holds every row; the Treeview only displays it. In windowed mode
+        # only the rows in the visible scroll region exist in the Treeview
+        self.model = table_model.TableModel(len(column_names))
+        self.windowed = False
+        self.offset = 0
+
+        # Called with a directory row the first time it is expanded, to list its contents
+        self.on_expand = None
+
+        # Called as complete(row_id, col_index, prefix) to suggest category names while a cell is edited
+        self.complete = None
+
+        # Called as run_in_background(target, on_done, on_error) to stat the rows when they are first sorted by size or date
+        self.run_in_background = None
+        self.stats_pending = False
+
+        # Sort order (a column index, 'size' or 'modified', and whether it is reversed) and row filter
+        self.sort_column = None
+        self.sort_reverse = False
+        self.filter = None
 
         # Create columns and headings
         self.tree['columns']= tuple(self.column_names[1:])  #used for indexing, first name omitted because it is always set to #0
 
         for i in range(len(self.column_names)):
             self.tree.column(self.column_names[i], width=self.column_widths[i], anchor='w', stretch='no')
-            self.tree.heading(self.column_names[i], text=self.heading_names[i],anchor='center')
+            self.tree.heading(self.column_names[i], text=self.heading_names[i],anchor='center', command=lambda i=i: self.sort_by(i))
 
         self.tree.column(self.column_names[1], anchor='center') #center the text in the flag column
 
         # Add Data
-        self.default_values = tuple('' for name in range(1,len(column_names)))
-        for name in self.row_names:
-            self.tree.insert(parent='',index='end',text=name,values=self.default_values,tags=('clickable'))
+        self.append_rows([], row_names)
 
         # Add event handler to enable cell editing
         self.tree.bind("<Double-1>", self.make_popup)
         self.tree.bind("<Delete>", self.delete_rows)
 
+        # Directories are listed when they are first expanded
+        self.tree.bind("<<TreeviewOpen>>", self.on_open)
+        self.tree.bind("<<TreeviewClose>>", self.on_close)
+
+    def append_rows(self, dirs, files, parent_id=None):
+        """Add rows for the given directory and file names (inside the directory
+        row parent_id, if given), keeping directories before files. Switches to
+        windowed mode once the table gets large"""
+        parent = None
+        if parent_id is not None:
+            parent = self.model.get(parent_id)
+            if parent is None:      #the directory was processed while it was being listed
+                return
+        dir_rows = self.model.add(dirs, is_dir=True, parent=parent)
+        file_rows = self.model.add(files, is_dir=False, parent=parent)
+        if parent is not None and self.tree.exists(placeholder_id(parent_id)) and not self.windowed:
+            self.tree.delete(placeholder_id(parent_id))
+
+        if not self.windowed and self.model.visible_count() > WINDOWED_THRESHOLD:
+            # Drop the materialized rows and only show the visible ones from now on
+            self.windowed = True
+            self.clear_tree()
+
+        if self.windowed:
+            if parent is None or self.model.is_visible(parent):
+                self.render_window()
+        else:
+            siblings = self.model.children_of(parent)
+            n_dirs = sum(not row.hidden for row in siblings.dir_rows.values()) - sum(not row.hidden for row in dir_rows)     #insert new directories after the existing ones
+            for row in dir_rows:
+                self.insert_row(row, n_dirs)
+                n_dirs += 1
+            for row in file_rows:
+                self.insert_row(row, 'end')
+
+    def insert_row(self, row, index):
+        """Add a row to the Treeview, under its directory (or at the top level in windowed mode).
+        Directories that haven't been listed get a placeholder child, so that they can be expanded"""
+        if self.windowed:
+            parent, text = '', self.display_text(row)
+        else:
+            parent, text = (row.parent.iid if row.parent is not None else ''), row.cells[0]
+        self.tree.insert(parent=parent,index=index,iid=row.iid,text=text,values=row.cells[1:],tags=('clickable'))
+        if row.hidden:
+            self.tree.detach(row.iid)
+        if row.is_dir and (row.children is None or (self.windowed and len(row.children) > 0)):
+            self.tree.insert(parent=row.iid, index='end', iid=placeholder_id(row.iid), text='')
+
+    def display_text(self, row):
+        """Name of a row in windowed mode, where every row is at the top level of the
+        Treeview, indented by its depth and marked if it is an expanded directory"""
+        marker = '- ' if row.expanded else ''
+        return '    ' * row.depth + marker + row.cells[0]
+
+    def on_open(self, event):
+        """Expand a directory, listing its contents if this is the first time"""
+        row = self.model.get(self.tree.focus())
+        if row is None or not row.is_dir:
+            return
+        if self.windowed:
+            # Every row is at the top level, so opening a row toggles it
+            self.model.set_expanded(row, not row.expanded)
+        else:
+            self.model.set_expanded(row, True)
+        if row.children is None and self.on_expand is not None:
+            self.on_expand(row)
+        if self.windowed:
+            self.render_window()
+
+    def on_close(self, event):
+        row = self.model.get(self.tree.focus())
+        if row is not None and not self.windowed:
+            self.model.set_expanded(row, False)
+
+    def finish_listing(self, row_id):
+        """Called once a directory has been listed: an empty directory loses its expand button"""
+        row = self.model.get(row_id)
+        if row is None:
+            return
+        if row.children is None:
+            self.model.children_of(row)     #listed, but empty
+        if not self.windowed and self.tree.exists(placeholder_id(row_id)):
+            self.tree.delete(placeholder_id(row_id))
+        self.apply_sort()
+
+    def sort_key(self, column):
+        """Returns a function that computes the sort key of a row for column"""
+        if column == 0:
+            return lambda row: row.cells[0].casefold()
+        if column in ('size', 'modified'):
+            index = 0 if column == 'size' else 1
+            stats = self.model.stats        #see collect_stats
+            return lambda row: stats[row.iid][index] if stats.get(row.iid) is not None else None
+        return lambda row: row.cells[column].casefold() or None     #empty cells last (see TableModel.sort)
+
+    def sort_by(self, column):
+        """Sort by column (an index, 'size' or 'modified'); sorting by the same column
+        again reverses the order"""
+        self.sort_reverse = not self.sort_reverse if column == self.sort_column else False
+        self.sort_column = column
+        for i in range(len(self.column_names)):
+            arrow = (' \u25bc' if self.sort_reverse else ' \u25b2') if i == column else ''
+            self.tree.heading(self.column_names[i], text=self.heading_names[i] + arrow)
+        self.apply_sort()
+
+    def apply_sort(self):
+        """Put the rows back in the chosen order (e.g. after more of them were listed).
+        The sort keys of each row are computed once, and kept until its cell changes"""
+        if self.sort_column is None:
+            return
+        if self.sort_column in ('size', 'modified') and self.collect_stats():
+            return      #sorted once the stats are in
+        with metrics.span('table.sort'):
+            self.model.sort(self.sort_column, self.sort_key(self.sort_column), self.sort_reverse)
+            self.redisplay()
+
+    def collect_stats(self):
+        """Start statting the rows that have no size and date yet on a background thread,
+        and sort again when they are in. Returns False if every row has them already"""
+        if self.stats_pending:
+            return True
+        model = self.model
+        missing = [(row.iid, model.relative_path(row)) for row in model.rows.values() if row.iid not in model.stats]
+        if not missing or self.run_in_background is None:
+            return False
+        def done(stats):
+            self.stats_pending = False
+            if self.model is model:
+                model.set_stats(stats)
+            self.apply_sort()
+        def failed(error):
+            self.stats_pending = False
+            print(f'Error while reading sizes and dates: {error!r}\n')
+        self.stats_pending = True
+        self.run_in_background(lambda: stat_rows(missing), done, on_error=failed)
+        return True
+
+    def set_filter(self, text: str):
+        """Only display the rows that match text (see table_model.make_filter)"""
+        with metrics.span('table.filter'):
+            self.filter = table_model.make_filter(text, processing.ENTRY_FIELDS)
+            self.model.set_filter(self.filter)
+            self.redisplay()
+
+    def redisplay(self):
+        """Show the model's order and hidden rows in the Treeview, by moving and detaching
+        its existing items rather than recreating them"""
+        self.commit_popups()
+        if self.windowed:
+            self.render_window()
+            return
+        listed = [('', self.model.top)] + [(row.iid, row.children) for row in self.model.rows.values() if row.children is not None]
+        for parent_id, children in listed:
+            index = 0
+            for row in children:
+                if row.hidden:
+                    self.tree.detach(row.iid)
+                else:
+                    self.tree.move(row.iid, parent_id, index)
+                    index += 1
+
+    def reset(self):
+        """Remove every row (e.g. to show another directory), discarding open popups"""
+        for widget in self.tree.winfo_children():
+            if widget.winfo_class() == 'Entry':
+                widget.destroy()
+        self.clear_tree()
+        self.model = table_model.TableModel(len(self.column_names))
+        self.model.set_filter(self.filter)
+        self.windowed = False
+        self.offset = 0
+
+    def clear_tree(self):
+        children = self.tree.get_children()
+        if children:
+            self.tree.delete(*children)
+
+    def row_count(self):
+        return len(self.model)
+
+    def displayed_ids(self):
+        """IDs of the rows that can be scrolled to without changing the window, in display order"""
+        if self.windowed:
+            return self.tree.get_children()
+        return [row.iid for row in self.model.visible_rows()]
+
+    def get_cell(self, row_id, col_index: int):
+        return self.model.get(row_id).cells[col_index]
+
+    def set_cell(self, row_id, col_index: int, text: str):
+        """Write a cell to the model, and to the Treeview if the row is displayed"""
+        self.model.set_cell(row_id, col_index, text)
+        if self.tree.exists(row_id):
+            if col_index == 0:
+                self.tree.item(row_id, text=self.display_text(self.model.get(row_id)) if self.windowed else text)
+            else:
+                self.tree.set(row_id, self.column_names[col_index], text)
+
+    def commit_popups(self):
+        """Write the text of open popups to their cells and close them, e.g. because their rows are about to move"""
+        for widget in self.tree.winfo_children():
+            if widget.winfo_class() == 'Entry':
+                widget.insert_text_and_destroy()
+
+    def render_window(self):
+        """Replace the materialized rows with the ones at the current scroll offset"""
+        self.commit_popups()     #their rows are about to be removed
+
+        visible = int(self.tree['height'])
+        total = self.model.visible_count()
+        self.offset = max(0, min(self.offset, total - visible))
+        self.clear_tree()
+        for row in itertools.islice(self.model.rows_from(self.offset), visible):
+            self.insert_row(row, 'end')
+        if self.scrollbar is not None:
+            if total:
+                self.scrollbar.set(self.offset / total, min(1.0, (self.offset + visible) / total))
+            else:
+                self.scrollbar.set(0.0, 1.0)
+
+    def attach_scrollbar(self, scrollbar):
+        """Connect a vertical scrollbar, which scrolls the model in windowed mode
+        and the Treeview itself otherwise"""
+        self.scrollbar = scrollbar
+        scrollbar.configure(command=self.yview)
+        self.tree.configure(yscrollcommand=self.on_tree_scroll)
+        self.tree.bind("<MouseWheel>", self.on_mousewheel)
+        self.tree.bind("<Button-4>", self.on_mousewheel)
+        self.tree.bind("<Button-5>", self.on_mousewheel)
+
+    def on_tree_scroll(self, first, last):
+        if not self.windowed:
+            self.scrollbar.set(first, last)
+
+    def yview(self, *args):
+        """Scrollbar command, following the Tk yview protocol ('moveto', fraction) 
+        and ('scroll', n, 'units'|'pages')"""
+        if not self.windowed:
+            return self.tree.yview(*args)
+        visible = int(self.tree['height'])
+        if args[0] == 'moveto':
+            self.offset = int(float(args[1]) * self.model.visible_count())
+        elif args[0] == 'scroll':
+            step = visible if args[2] == 'pages' else 1
+            self.offset += int(args[1]) * step
+        self.render_window()
+
+    def on_mousewheel(self, event):
+        if not self.windowed:
+            return None     #let the Treeview scroll itself
+        if event.num == 4 or event.delta > 0:
+            self.yview('scroll', -3, 'units')
+        else:
+            self.yview('scroll', 3, 'units')
+        return 'break'
+
+    def get_rows(self):
+        """Returns a list of (row_id, path, values) for every row in the table, read from
+        the model, where path is relative to the current directory. The contents of each
+        directory come before the directory itself, so they can be processed first"""
+        return [(row.iid, str(self.model.relative_path(row)), row.cells[1:]) for row in self.model]
+
+    def delete_row(self, row_id):
+        """Remove a single row from the table"""
+        self.model.remove(row_id)
+        if self.tree.exists(row_id):
+            self.tree.delete(row_id)
+            if self.windowed:
+                self.render_window()
+
     def make_popup(self, event):
         """ Executed, when a row is double-clicked. Opens 
         read-only EntryPopup above the item's column, so it is possible
@@ -65,6 +444,8 @@ class Table:
         # What row and column was clicked on
         row_id = self.tree.identify_row(event.y)
         col_id = self.tree.identify_column(event.x)
+        if self.model.get(row_id) is None:     #e.g. the placeholder of a directory that is being listed
+            return
         col_index = int(col_id[1:])     #remove # and convert to int, to use for indexing 'values' below
         # print(col_id)
         # print(self.tree.column('flag'))
@@ -76,10 +457,7 @@ class Table:
         pady = height // 2
 
         # Get text from current cell
-        if col_index == 0:
-            text = self.tree.item(row_id, 'text')
-        else:
-            text = self.tree.item(row_id, 'values')[col_index-1]
+        text = self.get_cell(row_id, col_index)
         
         # Create entry popup
         self.entryPopup = EntryPopup(self.tree, self, row_id, col_index, text, name=('ep_'+row_id+'_'+col_id))
@@ -95,7 +473,12 @@ class Table:
         """deletes the currently selected rows"""
         current_items = self.tree.selection()   #TODO: should I use tree.focus() instead?
         for item in current_items:
-            self.tree.delete(item)
+            if self.model.get(item) is not None:
+                self.delete_row(item)
+
+def placeholder_id(row_id):
+    """ID of the empty child that gives an unlisted directory its expand button"""
+    return row_id + '_placeholder'
 
 class EntryPopup(tk.Entry):
     def __init__(self, parent, grandparent, row_id, col_index, text, **kw):
@@ -122,17 +505,74 @@ class EntryPopup(tk.Entry):
         self.bind("<Tab>", lambda event, inc=1: self.next_entry(event, inc))
         self.bind("<Shift-Tab>", lambda event, inc=-1: self.next_entry(event, inc))
 
+        # Suggest existing category folders as the user types. The list stays below the
+        # entry without taking the focus; Up/Down highlight a suggestion and Return or Tab accepts it
+        self.suggestions = None
+        if col_index in CATEGORY_COLUMNS and grandparent.complete is not None:
+            self.bind("<KeyRelease>", self.update_suggestions)
+            self.bind("<Down>", lambda *ignore: self.move_suggestion(1))
+            self.bind("<Up>", lambda *ignore: self.move_suggestion(-1))
+
     def insert_text_and_destroy(self, *ignore):
         """ Add the text in EntryPopup to the corresponding cell in parent"""
-        if self.col_index == 0:                        #value for col 0 is in 'text'
-            self.parent.item(self.row_id, text=self.get())
-        else:                                   #Note: there has to be a more elegant way of modifying current row's values than calling item() twice
-            current_item = self.parent.item(self.row_id)
-            values = current_item['values']
-            values[self.col_index-1] = self.get()
-            self.parent.item(self.row_id, values=values)
+        self.accept_suggestion()
+        if self.grandparent.model.get(self.row_id) is not None:    #the row may have been processed in the meantime
+            self.grandparent.set_cell(self.row_id, self.col_index, self.get())
         self.destroy()
 
+    def destroy(self):
+        if self.suggestions is not None:
+            self.suggestions.destroy()
+            self.suggestions = None
+        super().destroy()
+
+    def update_suggestions(self, event):
+        """Show the category names that start with the text typed so far"""
+        if event.keysym in ('Up', 'Down', 'Return', 'Tab', 'Escape') or not self.winfo_exists():
+            return
+        matches = self.grandparent.complete(self.row_id, self.col_index, self.get())
+        if not matches or matches == [self.get()]:
+            if self.suggestions is not None:
+                self.suggestions.place_forget()
+            return
+        if self.suggestions is None:
+            self.suggestions = tk.Listbox(self.parent, takefocus=0, exportselection=False, activestyle='none')
+            self.suggestions.bind("<ButtonPress-1>", self.click_suggestion)
+        self.suggestions.delete(0, 'end')
+        self.suggestions.insert('end', *matches)
+        self.suggestions.configure(height=len(matches))
+        self.suggestions.place(x=self.winfo_x(), y=self.winfo_y() + self.winfo_height(), width=self.winfo_width())
+        self.suggestions.lift()
+
+    def move_suggestion(self, inc: int):
+        """Highlight the next (inc=1) or previous (inc=-1) suggestion"""
+        if self.suggestions is None or not self.suggestions.winfo_ismapped():
+            return
+        selection = self.suggestions.curselection()
+        index = selection[0] + inc if selection else (0 if inc > 0 else self.suggestions.size() - 1)
+        index = max(0, min(index, self.suggestions.size() - 1))
+        self.suggestions.selection_clear(0, 'end')
+        self.suggestions.selection_set(index)
+        self.suggestions.see(index)
+        return 'break'
+
+    def accept_suggestion(self):
+        """Replace the text with the highlighted suggestion, if there is one"""
+        if self.suggestions is None or not self.suggestions.winfo_ismapped():
+            return
+        selection = self.suggestions.curselection()
+        if selection:
+            self.delete(0, 'end')
+            self.insert(0, self.suggestions.get(selection[0]))
+        self.suggestions.place_forget()
+
+    def click_suggestion(self, event):
+        """Accept a suggestion that was clicked (without moving the focus out of the entry)"""
+        self.suggestions.selection_clear(0, 'end')
+        self.suggestions.selection_set(self.suggestions.nearest(event.y))
+        self.insert_text_and_destroy()
+        return 'break'
+
     def select_all(self, *ignore):
         """ Set selection on the whole text """
         self.selection_range(0, 'end')
@@ -144,14 +584,21 @@ class EntryPopup(tk.Entry):
         """ Allow the user to move from one EntryPopup to the next across rows and columns.
         `inc` is the increment (+/- int) by which the column and row position is changed."""
         # Calculate IDs
-        row_ids = self.parent.get_children()
+        table = self.grandparent
+        row_ids = table.displayed_ids()
         row_index = row_ids.index(self.row_id)
-        col_ids = self.grandparent.column_ids
+        col_ids = table.column_ids
         col_index = self.col_index
 
         if ((col_index+inc) > len(col_ids)-1) or ((col_index+inc) < 0):
             col_index = (col_index+inc) % len(col_ids)
-            if ((row_index+inc) > len(row_ids)-1) or ((row_index+inc) < 0):
+            target = table.offset + row_index + inc      #index of the next row in the whole table
+            if table.windowed and ((row_index+inc) > len(row_ids)-1 or (row_index+inc) < 0) and 0 <= target < table.model.visible_count():
+                # Scroll the window instead of wrapping around to the first visible row
+                table.yview('scroll', inc, 'units')
+                row_ids = table.displayed_ids()
+                row_index = target - table.offset
+            elif ((row_index+inc) > len(row_ids)-1) or ((row_index+inc) < 0):
                 row_index = (row_index+inc) % len(row_ids)
             else:
                 row_index += inc
@@ -168,10 +615,7 @@ class EntryPopup(tk.Entry):
         pady = height // 2
 
         # Get text from current cell
-        if col_id =='#0':
-            text = self.parent.item(row_id, 'text')
-        else:
-            text = self.parent.item(row_id, 'values')[col_index-1]
+        text = table.get_cell(row_id, col_index)
         
         # Create new entry popup
         newpopup = EntryPopup(self.parent, self.grandparent, row_id, col_index, text, name=('ep_'+row_id+'_'+col_id))
@@ -186,7 +630,7 @@ class EntryPopup(tk.Entry):
 
 
 class MainApplication:
-    def __init__(self, parent, config_file_path, error_log_path, change_log_path, column_names, column_widths, heading_names):
+    def __init__(self, parent, config_file_path, error_log_path, change_log_path, column_names, column_widths, heading_names, directories=()):
         print('Initializing main application...')
         
         # Initialize key attributes
@@ -206,34 +650,75 @@ class MainApplication:
         self.heading_names = heading_names
 
         # Import configuration settings and flags
-        self.settings = self.load_settings(self.config_file_path)
-        self.flags = self.load_flags(self.config_file_path)
+        config = processing.read_config(self.config_file_path)
+        self.settings, self.id_cache = processing.load_settings(self.config_file_path, config)
+        self.flags = processing.load_flags(self.config_file_path, config)
+
+        # Index the existing category folders in the background, for autocompletion
+        self.categories = categories.CategoryIndex(Path(self.settings['REORG_DIRECTORY'])).start()
+
+        # Directories to work through after the current one; the next few are listed in advance
+        scan_workers = int(self.settings.get('SCAN_WORKERS', '') or 4)
+        self.directory_queue = directory_queue.DirectoryQueue(list_dirs_and_files, workers=scan_workers, prefetch=scan_workers)
+
+        # Hand flagged entries back once their cards are resolved on the board (the issues are kept in the outbox)
+        self.card_sync = None
+        self.sync_interval = float(self.settings.get('CARD_SYNC_INTERVAL', '') or 0)
+        if self.sync_interval > 0 and processing.is_truthy(self.settings.get('CARD_OUTBOX', 'yes')):
+            self.card_sync = card_sync.open_sync(self.settings, self.id_cache, self.error_log_path)
+
+        # Modification times of the listed folders when they were last refreshed, by row ID ('' for the current directory)
+        self.dir_mtimes = {}
+        self.refreshing = False
 
         # Create GUI
         self.create_gui()
+        self.queue_directories(directories)
+        if self.card_sync is not None:
+            self.sync_cards()
+
+        # Pick up items that others add to or remove from the listed folders
+        self.refresh_interval = float(self.settings.get('REFRESH_INTERVAL', '') or 0)
+        if self.refresh_interval > 0:
+            self.parent.after(int(self.refresh_interval * 1000), self.auto_refresh)
         print('Initialization complete\n')
 
 
     def create_gui(self):
-        """Create the user interface based on key parameters and data"""
+        """Create the user interface based on key parameters and data. Called once; other
+        directories are shown in the same widgets (see change_directory)"""
         # Set current working directory
         self.cwd = Path.cwd()
         print(f'Current directory: {self.cwd}{os.sep}') #TODO: make the cnsole output look better
 
-        # Determine row names from current directory
-        self.row_names = list_names(current_dir=self.cwd)
-
         # Create table frame
         self.tableframe = tk.Frame(self.parent)
         self.tableframe.grid(row=0, column=0, columnspan=2, sticky='n')
         
         # Create table (note that packing of table happens inside the class - could be brought outside if Table was a subclass of ttk.Treeview)
-        self.table = Table(self.tableframe, self.row_names, self.column_names, self.column_widths, self.heading_names)
+        self.table = Table(self.tableframe, [], self.column_names, self.column_widths, self.heading_names)
+        self.table.on_expand = lambda row: self.start_scan(row.iid)
+        self.table.complete = self.complete_category
+        self.table.run_in_background = self.run_in_background
 
         # Create scrollbar
-        self.scrollbar = ttk.Scrollbar(self.tableframe, orient='vertical', command=self.table.tree.yview)
+        self.scrollbar = ttk.Scrollbar(self.tableframe, orient='vertical')
         self.scrollbar.grid(row=0, column=2, sticky='ns')
-        self.table.tree.configure(yscrollcommand=self.scrollbar.set)
+        self.table.attach_scrollbar(self.scrollbar)
+
+        # Create filter and sort bar
+        self.viewframe = tk.Frame(self.tableframe)
+        self.viewframe.grid(row=1, column=0, columnspan=3, sticky='w')
+        tk.Label(self.viewframe, text='Filter:').grid(row=0, column=0)
+        self.filter_entry = tk.Entry(self.viewframe, width=40)
+        self.filter_entry.grid(row=0, column=1)
+        self.filter_entry.bind('<KeyRelease>', self.schedule_filter)
+        self.filter_job = None
+        tk.Label(self.viewframe, text='e.g. flag:v  *.tif  cat1:', fg='gray').grid(row=0, column=2, padx=5)
+        tk.Label(self.viewframe, text='Sort by:').grid(row=0, column=3)
+        self.sort_choice = ttk.Combobox(self.viewframe, values=SORT_CHOICES, state='readonly', width=10)
+        self.sort_choice.grid(row=0, column=4)
+        self.sort_choice.bind('<<ComboboxSelected>>', self.sort_by_choice)
 
         # Create info frame
         self.infoframe = tk.Frame(self.parent, width=750, height=100)
@@ -245,6 +730,11 @@ class MainApplication:
         self.cwdmessage = tk.Message(self.infoframe, text=str(self.cwd), width=750, justify='left')
         self.cwdmessage.grid(row=0, column=1, sticky='w')
 
+        self.queuelabel = tk.Label(self.infoframe, text='Queued Folders:\t', font='Calibri 10 bold')
+        self.queuelabel.grid(row=1, column=0, sticky='n')
+        self.queuemessage = tk.Message(self.infoframe, text='', width=750, justify='left')
+        self.queuemessage.grid(row=1, column=1, sticky='w')
+
         self.rdlabel = tk.Label(self.infoframe, text='Reorg Directory:\t', font='Calibri 10 bold')
         self.rdlabel.grid(row=2, column=0, sticky='n')
         self.rdmessage = tk.Message(self.infoframe, text=self.settings['REORG_DIRECTORY'], width=750, justify='left')
@@ -265,8 +755,196 @@ class MainApplication:
         self.process_button.grid(row=0, column=0)
         self.reload_button = tk.Button(self.buttonframe,text="Reload",command=self.reload_with_new_cwd)
         self.reload_button.grid(row=0, column=1)
+        self.refresh_button = tk.Button(self.buttonframe, text="Refresh", command=self.refresh)
+        self.refresh_button.grid(row=0, column=2)
+        self.queue_button = tk.Button(self.buttonframe, text="Queue Folders...", command=self.choose_directories)
+        self.queue_button.grid(row=0, column=3)
+        self.next_button = tk.Button(self.buttonframe, text="Next Folder", command=self.next_directory)
+        self.next_button.grid(row=0, column=4)
+        self.rules_button = tk.Button(self.buttonframe, text="Apply Rules...", command=self.apply_rules)
+        self.rules_button.grid(row=0, column=5)
+        self.duplicates_button = tk.Button(self.buttonframe, text="Find Duplicates", command=self.find_duplicates)
+        self.duplicates_button.grid(row=0, column=6)
+        self.history_button = tk.Button(self.buttonframe, text="History...", command=self.show_history)
+        self.history_button.grid(row=0, column=7)
+        self.cancel_button = tk.Button(self.buttonframe, text="Cancel", command=self.cancel_processing, state='disabled')
+        self.cancel_button.grid(row=0, column=8)
         self.exit_button = tk.Button(self.buttonframe, text="Exit", command=self.exit_app)
-        self.exit_button.grid(row=0, column=2)
+        self.exit_button.grid(row=0, column=9)
+        self.update_queue_message()
+
+        # Scan the current directory in the background and stream its entries into the table
+        self.start_scan()
+
+        # Create progress frame
+        self.progressframe = tk.Frame(self.parent)
+        self.progressframe.grid(row=3, column=0, columnspan=2, pady=5)
+        self.progressbar = ttk.Progressbar(self.progressframe, orient='horizontal', length=500, mode='determinate')
+        self.progressbar.grid(row=0, column=0)
+        self.progresslabel = tk.Label(self.progressframe, text='')
+        self.progresslabel.grid(row=1, column=0)
+
+    def start_scan(self, row_id=None):
+        """List the current directory (or, if row_id is given, the subdirectory in that
+        row) on a background thread, so that the window appears immediately even
+        for huge directories or slow network shares"""
+        if row_id is None:
+            directory = self.cwd
+            self.process_button.configure(state='disabled')     #until every entry is in the table
+        else:
+            directory = self.cwd / self.table.model.relative_path(self.table.model.get(row_id))
+        scan_queue = queue.Queue()
+        threading.Thread(target=scan_worker, args=(directory, scan_queue), daemon=True).start()
+        model = self.table.model
+        self.parent.after(SCAN_POLL_MS, lambda: self.poll_scan(scan_queue, directory, row_id, model))
+
+    def poll_scan(self, scan_queue, directory, row_id, model):
+        """Insert the scanned entries into the table, at most one chunk per call,
+        so the Tk event loop keeps running while large directories load"""
+        if self.table.model is not model:
+            return      #the table has moved on to another directory
+        try:
+            event = scan_queue.get_nowait()
+        except queue.Empty:
+            self.parent.after(SCAN_POLL_MS, lambda: self.poll_scan(scan_queue, directory, row_id, model))
+            return
+
+        if event[0] == 'chunk':
+            self.table.append_rows(event[1], event[2], parent_id=row_id)
+        elif event[0] == 'error':
+            print(f'Error while listing {directory}: {event[1]}')
+        elif event[0] == 'done':
+            if row_id is None:
+                print(f'{self.table.row_count()} items found\n')
+                self.process_button.configure(state='normal')
+                self.table.apply_sort()
+            else:
+                self.table.finish_listing(row_id)
+            self.restore_resolved_entries()
+            return
+        self.parent.after(1, lambda: self.poll_scan(scan_queue, directory, row_id, model))   #more chunks may be waiting
+
+    def queue_directories(self, directories):
+        """Add directories to the work queue; the first few start being listed right away"""
+        self.directory_queue.add(directory for directory in (Path(d).resolve() for d in directories) if directory != self.cwd)
+        self.update_queue_message()
+
+    def update_queue_message(self):
+        directories = self.directory_queue.directories()
+        if not directories:
+            text = 'none'
+        else:
+            text = ', '.join(directory.name or str(directory) for directory in directories[:5])
+            if len(directories) > 5:
+                text += f', ... ({len(directories)} folders)'
+        self.queuemessage.configure(text=text)
+
+    def choose_directories(self):
+        """Let the user pick a folder, then any number of the folders inside it, and queue them"""
+        chosen = filedialog.askdirectory(title='Choose the folder that contains the folders to queue', mustexist=True)
+        if not chosen:
+            return
+        parent_dir = Path(chosen)
+        try:
+            candidates = [parent_dir] + [parent_dir / name for name in sorted(list_dirs_and_files(parent_dir)[0], key=str.lower)]
+        except OSError as e:
+            print(f'Error while listing {parent_dir}: {e}\n')
+            return
+
+        dialog = tk.Toplevel(self.parent)
+        dialog.title('Queue folders')
+        dialog.transient(self.parent)
+        listbox = tk.Listbox(dialog, selectmode='extended', width=80, height=20)
+        listbox.insert('end', f'{parent_dir}{os.sep}', *(f'    {path.name}{os.sep}' for path in candidates[1:]))
+        listbox.grid(row=0, column=0, columnspan=2, sticky='nsew')
+        scrollbar = ttk.Scrollbar(dialog, orient='vertical', command=listbox.yview)
+        scrollbar.grid(row=0, column=2, sticky='ns')
+        listbox.configure(yscrollcommand=scrollbar.set)
+
+        def add():
+            selected = [candidates[index] for index in listbox.curselection()]
+            dialog.destroy()
+            self.queue_directories(selected)
+            print(f'{len(selected)} folder(s) queued\n')
+
+        tk.Button(dialog, text='Queue', command=add).grid(row=1, column=0, pady=5)
+        tk.Button(dialog, text='Cancel', command=dialog.destroy).grid(row=1, column=1, pady=5)
+
+    def next_directory(self):
+        """Show the next queued directory in the table, without rebuilding the window.
+        Its listing has usually been made in the background already"""
+        if not self.directory_queue:
+            print('No folders are queued\n')
+            return
+        directory, listing = self.directory_queue.pop()
+        try:
+            self.change_directory(directory)
+        except OSError as e:
+            print(f'Skipping {directory}: {e}\n')
+            self.update_queue_message()
+            self.next_directory()
+            return
+        self.update_queue_message()
+        self.poll_listing(listing, self.table.model)
+
+    def change_directory(self, directory: Path):
+        """Make directory the current directory and empty the table for it, reusing the
+        existing widgets. Raises OSError if the directory can't be entered"""
+        os.chdir(directory)
+        self.cwd = directory
+        print(f'Current directory: {self.cwd}{os.sep}')
+        self.cwdmessage.configure(text=str(self.cwd))
+        self.table.reset()
+        self.dir_mtimes = {}
+        self.process_button.configure(state='disabled')     #until every entry is in the table
+
+    def poll_listing(self, listing, model):
+        """Fill the table once a prefetched listing is ready"""
+        if self.table.model is not model:
+            return
+        if not listing.done():
+            self.progresslabel.configure(text='Listing folder...')
+            self.parent.after(SCAN_POLL_MS, lambda: self.poll_listing(listing, model))
+            return
+        self.progresslabel.configure(text='')
+        try:
+            dirs, files = listing.result()
+        except OSError as e:
+            print(f'Error while listing {self.cwd}: {e}')
+        else:
+            self.table.append_rows(dirs, files)
+        print(f'{self.table.row_count()} items found\n')
+        self.process_button.configure(state='normal')
+        self.table.apply_sort()
+        self.restore_resolved_entries()
+
+    def schedule_filter(self, event):
+        """Apply the filter once typing pauses, rather than on every key"""
+        if self.filter_job is not None:
+            self.parent.after_cancel(self.filter_job)
+        self.filter_job = self.parent.after(FILTER_DELAY_MS, self.apply_filter)
+
+    def apply_filter(self):
+        self.filter_job = None
+        self.table.set_filter(self.filter_entry.get())
+
+    def sort_by_choice(self, event):
+        """Sort by the column chosen in the 'Sort by' box (choosing it again reverses the order)"""
+        choice = self.sort_choice.get()
+        index = SORT_CHOICES.index(choice)
+        self.table.sort_by(index if index < len(self.column_names) else choice)
+
+    def complete_category(self, row_id, col_index: int, prefix: str):
+        """Existing category folders that start with prefix, for the cat1, cat2 or
+        cat3 cell being edited (cat2 and cat3 are looked up inside the row's cat1
+        and cat2 folders)"""
+        row = self.table.model.get(row_id)
+        if row is None or col_index not in CATEGORY_COLUMNS:
+            return []
+        cells = row.cells[CATEGORY_COLUMNS[0]:col_index]
+        if '' in cells:
+            return []       #the folders above this one aren't known yet
+        return self.categories.complete(tuple(cells), prefix, limit=MAX_COMPLETIONS)
 
     def exit_app(self):
         """Close the main window"""
@@ -275,18 +953,81 @@ class MainApplication:
 
     def reload_with_new_cwd(self):
         """Prompt user to choose a new working directory, move to it,
-        and re-initialize MainApplication"""
+        and list it in the existing table"""
         print("Reloading with new working directory: ", end="")
         
         new_cwd = Path(filedialog.askdirectory())
         
         if str(new_cwd) == '.':
             print('no directory chosen')
-        else:
-            os.chdir(str(new_cwd))
-            self.create_gui()
+            return
+        try:
+            self.change_directory(new_cwd)
+        except OSError as e:
+            print(f'Error: {e}\n')
+            return
+        self.start_scan()
+
+    def refresh(self, check_mtimes: bool = False):
+        """List the current directory and the folders opened in it again in the background,
+        and apply the differences to the table: rows are added for new items and removed
+        for items that are gone, while the other rows (and their cells) are left as they
+        are. With check_mtimes, only folders whose modification time has changed are listed"""
+        if self.refreshing or self.process_button['state'] == 'disabled':
+            return      #already refreshing, or listing, planning or processing
+        model = self.table.model
+        directories = [('', self.cwd)] + [(row.iid, self.cwd / model.relative_path(row))
+                                          for row in model.rows.values() if row.children is not None]
+        mtimes = dict(self.dir_mtimes) if check_mtimes else None
+        self.refreshing = True
+
+        def failed(err):
+            self.refreshing = False
+            print(f'Error while refreshing: {err!r}\n')
+
+        self.run_in_background(lambda: scan_changed(directories, mtimes),
+                               lambda changed: self.apply_refresh(model, changed), on_error=failed)
+
+    def apply_refresh(self, model, changed):
+        """Apply the listings made by refresh to the table"""
+        self.refreshing = False
+        if self.table.model is not model or self.process_button['state'] == 'disabled':
+            return      #the table has moved on, or is being processed
+        n_added = n_removed = 0
+        for key, mtime_ns, dirs, files in changed:
+            parent = model.get(key) if key else None
+            if key and (parent is None or parent.children is None):
+                continue        #the folder's row has been processed or removed since
+            self.dir_mtimes[key] = mtime_ns
+            names = {True: set(dirs), False: set(files)}
+            listed = {True: set(), False: set()}
+            gone = []
+            for row in model.children_of(parent):
+                if row.cells[0] in names[row.is_dir]:
+                    listed[row.is_dir].add(row.cells[0])
+                else:
+                    gone.append(row.iid)
+            if gone:
+                self.table.commit_popups()      #before their rows disappear
+            for row_id in gone:
+                self.table.delete_row(row_id)
+            new_dirs = [name for name in dirs if name not in listed[True]]
+            new_files = [name for name in files if name not in listed[False]]
+            self.table.append_rows(new_dirs, new_files, parent_id=key or None)
+            n_added += len(new_dirs) + len(new_files)
+            n_removed += len(gone)
+        if n_added or n_removed:
+            self.table.apply_sort()
+            print(f'Refreshed {self.cwd}{os.sep}: {n_added} item(s) added, {n_removed} removed\n')
+
+    def auto_refresh(self):
+        """Check the listed folders for changes every REFRESH_INTERVAL seconds"""
+        self.refresh(check_mtimes=True)
+        self.parent.after(int(self.refresh_interval * 1000), self.auto_refresh)
 
     def process_entries(self):
+        """Collect the table entries that need processing and hand them to a
+        background worker, so that the UI stays responsive during long moves"""
         print("Processing table entries...\n")
 
         # Close all EntryPopups that are still open
@@ -294,199 +1035,417 @@ class MainApplication:
         for p in popups:
             p.insert_text_and_destroy()
         
-        # Compose data structure            TODO: make this more elegant
-        data_field_names = self.heading_names[:1] + self.column_names[1:]
-        TableEntry = namedtuple("TableEntry", ' '.join(data_field_names))
-        row_ids = self.table.tree.get_children()
-        row_ids_for_processing = [
-            id 
-            for id 
-            in row_ids 
-            if (self.table.tree.item(id)['values'][0] != '' or      #flag exists
-                self.table.tree.item(id)['values'][1] != '')        #cat1 exists
-        ]
-        table_entries = []
-        for id in row_ids_for_processing:
-            table_entries.append(
-                TableEntry(self.table.tree.item(id)['text'], *self.table.tree.item(id)['values'])
-            )
-
-        # Move the files and write to log
-        for i in range(len(table_entries)):
-            e = table_entries[i]
-            
-            # Current time will be used in log messages  TODO: put this inside the log_message function
-            current_time = time.strftime('%Y-%m-%d %H:%M:%S %z', time.localtime(time.time()))
-            
-            #paths for movement
-            source = self.cwd / e.name
-            if e.cat3 != '':
-                destination = Path(self.settings['REORG_DIRECTORY']) / e.cat1 / e.cat2 / e.cat3 / source.name
-            elif e.cat2 !='':
-                destination = Path(self.settings['REORG_DIRECTORY']) / e.cat1 / e.cat2 / source.name
-            else:
-                destination = Path(self.settings['REORG_DIRECTORY']) / e.cat1 / source.name
-
-            # Print status to console
-            print(f"Attempting to move {source.name}...")
-
-            # If there is no  flag, attempt the move and skip it if there's a MoveError
-            if e.flag == '':
-                try:
-                    move_and_log.move(source=source,
-                                    destination=destination, 
-                                    shorten_index=-1,
-                                    sep=os.sep)
-                except move_and_log.MoveError:
-                    row_ids_for_processing.remove(row_ids_for_processing[i])
-                    print('Move has been skipped. Continuing...\n')
+        # Compose data structure
+        jobs = []
+        for id, text, values in self.table.get_rows():
+            e = processing.TableEntry(text, *values)
+            if processing.needs_processing(e):
+                jobs.append((id, e))
+
+        if not jobs:
+            print('No entries to process\n')
+            return
+
+        # Lock the buttons that would interfere with processing
+        self.process_button.configure(state='disabled')
+        self.reload_button.configure(state='disabled')
+        self.next_button.configure(state='disabled')
+
+        # Resolve every entry against one listing of each folder involved, and show the plan before anything moves
+        print('Planning...')
+        self.progresslabel.configure(text='Planning...')
+        self.run_in_background(lambda: processing.make_plan([e for id, e in jobs], self.cwd, self.settings),
+                               lambda plan: self.show_plan(jobs, plan))
+
+    def apply_rules(self):
+        """Classify every row without a flag or category using a rules file, and fill
+        in the matches after showing a preview"""
+        rules_file_path = filedialog.askopenfilename(title='Choose a rules file',
+                                                     initialdir=str(Path(self.config_file_path).parent),
+                                                     filetypes=[('Rules files', '*.ini'), ('All files', '*')])
+        if not rules_file_path:
+            return
+        try:
+            ruleset = rules.load_rules(Path(rules_file_path))
+        except rules.RulesError as e:
+            print(f'Error: {e}\n')
+            return
+
+        # Snapshot the rows on the Tk thread; matching (and any stat calls) happens in the background
+        model = self.table.model
+        rows = [row for row in model if row.cells[1] == '' and row.cells[2] == '']
+        items = [(row.cells[0], row.is_dir, self.cwd / model.relative_path(row)) for row in rows]
+        self.progresslabel.configure(text='Applying rules...')
+        self.run_in_background(lambda: [(rows[index], rule) for index, rule in ruleset.classify(items)],
+                               self.show_rule_preview)
+
+    def show_rule_preview(self, matches):
+        """Show which rows the rules matched, and fill them in if the user accepts"""
+        self.progresslabel.configure(text='')
+        summary = rules.preview((row.cells[0], rule) for row, rule in matches)
+        print(summary + '\n')
+        if not matches:
+            return
+        dialog = tk.Toplevel(self.parent)
+        dialog.title('Rule preview')
+        dialog.transient(self.parent)
+        text = tk.Text(dialog, width=90, height=20, wrap='none')
+        text.insert('1.0', summary)
+        text.configure(state='disabled')
+        text.grid(row=0, column=0, columnspan=2, sticky='nsew')
+
+        def apply():
+            dialog.destroy()
+            for row, rule in matches:
+                if self.table.model.get(row.iid) is None:       #processed in the meantime
                     continue
-                
-                else:                
-                    msg = move_and_log.move_message(source=source, 
-                                                    destination=destination, 
-                                                    sep=os.sep)
-                    move_and_log.log_message(log_file_path=self.change_log_path, 
-                                            time=current_time, 
-                                            message=msg)
-            
-            # Flag error and log
+                cells = rules.apply_rule(row.cells[1:], rule)
+                if cells is None:       #filled in by hand in the meantime
+                    continue
+                for col_index, (old, new) in enumerate(zip(row.cells[1:], cells), start=1):
+                    if old != new:
+                        self.table.set_cell(row.iid, col_index, new)
+            print(f'Rules applied to {len(matches)} items\n')
+
+        tk.Button(dialog, text='Apply', command=apply).grid(row=1, column=0, pady=5)
+        tk.Button(dialog, text='Cancel', command=dialog.destroy).grid(row=1, column=1, pady=5)
+
+    def find_duplicates(self):
+        """Flag the files whose contents duplicate another file in the current directory
+        (or, with DUPLICATES_IN_REORG = yes, in REORG_DIRECTORY, whose copies are kept)"""
+        roots = [self.cwd]
+        keep_under = None
+        reorg_directory = Path(self.settings['REORG_DIRECTORY'])
+        if processing.is_truthy(self.settings.get('DUPLICATES_IN_REORG', 'no')) and reorg_directory.is_dir():
+            roots.append(reorg_directory)
+            keep_under = reorg_directory
+        cache_path = self.error_log_path.with_name(processing.HASH_CACHE_FILE_NAME)
+        self.progresslabel.configure(text='Finding duplicates...')
+        self.run_in_background(lambda: duplicates.copies_to_flag(duplicates.find_duplicates(roots, cache_path), keep_under),
+                               self.flag_duplicates)
+
+    def flag_duplicates(self, copies):
+        """Fill in the duplicate flag (and, if it is empty, the issue message) of the rows
+        of redundant copies that have no flag or category yet"""
+        self.progresslabel.configure(text='')
+        model = self.table.model
+        rows = {self.cwd / model.relative_path(row): row for row in model if not row.is_dir}
+        n_flagged = n_unlisted = 0
+        for path, original in copies.items():
+            row = rows.get(path)
+            if row is None:
+                n_unlisted += 1
+                continue
+            if row.cells[1] != '' or row.cells[2] != '':
+                continue
+            self.table.set_cell(row.iid, 1, DUPLICATE_FLAG)
+            if row.cells[5] == '':
+                self.table.set_cell(row.iid, 5, f'Duplicate of {original}')
+            n_flagged += 1
+        print(f'{len(copies)} duplicate(s) found, {n_flagged} flagged')
+        if n_unlisted:
+            print(f'{n_unlisted} duplicate(s) are inside folders that have not been expanded yet')
+        print()
+
+    def sync_cards(self):
+        """Poll the board for resolved cards in the background, hand their entries back
+        to the table, and poll again after CARD_SYNC_INTERVAL seconds"""
+        def done(resolved):
+            if resolved:
+                print(f'{len(resolved)} issue card(s) resolved on the board\n')
+            self.restore_resolved_entries()
+            self.parent.after(int(self.sync_interval * 1000), self.sync_cards)
+
+        def failed(err):
+            print(f'Card sync failed: {err}\n')
+            self.parent.after(int(self.sync_interval * 1000), self.sync_cards)
+
+        self.run_in_background(self.card_sync.poll, done, on_error=failed)
+
+    def restore_resolved_entries(self):
+        """Clear the flags of the listed rows whose cards have been resolved, and fill in
+        the categories they were given, so that they are moved the next time entries are
+        processed. Rows that have been edited since are left alone, and issues whose
+        rows aren't listed yet wait until they are"""
+        if self.card_sync is None:
+            return
+        issues = self.card_sync.outbox.issues('resolved')
+        if not issues:
+            return
+        model = self.table.model
+        rows = {str(self.cwd / model.relative_path(row)): row for row in model}
+        cleared = []
+        for issue in issues:
+            row = rows.get(issue['source'])
+            if row is None:
+                continue
+            if row.cells[1] == '' and row.cells[2] == '':
+                e = card_sync.resolved_entry(issue)
+                for col_index, text in zip(CATEGORY_COLUMNS, (e.cat1, e.cat2, e.cat3)):
+                    self.table.set_cell(row.iid, col_index, text)
+            cleared.append(issue['id'])
+        self.card_sync.outbox.set_issue_status(cleared, 'cleared')
+        if cleared:
+            print(f'{len(cleared)} resolved issue(s) handed back to the table\n')
+
+    def show_history(self):
+        """Open a dialog that looks up where items went (by path or name) in the history
+        store, starting with the selected row"""
+        history_path = self.change_log_path.with_name(processing.HISTORY_FILE_NAME)
+        store = history.History(history_path)
+        dialog = tk.Toplevel(self.parent)
+        dialog.title('History')
+        dialog.transient(self.parent)
+
+        search = tk.Entry(dialog, width=80)
+        search.grid(row=0, column=0, sticky='ew')
+        text = tk.Text(dialog, width=100, height=20, wrap='none', state='disabled')
+        text.grid(row=1, column=0, columnspan=2, sticky='nsew')
+
+        def look_up(*ignore):
+            item = search.get().strip()
+            events = store.where(item) if item else []
+            text.configure(state='normal')
+            text.delete('1.0', 'end')
+            text.insert('1.0', '\n'.join(history.format_event(event, item) for event in events) or 'No moves or issues found')
+            text.configure(state='disabled')
+
+        def close():
+            store.close()
+            dialog.destroy()
+
+        tk.Button(dialog, text='Look Up', command=look_up).grid(row=0, column=1)
+        search.bind('<Return>', look_up)
+        dialog.protocol('WM_DELETE_WINDOW', close)
+
+        row = self.table.model.get(self.table.tree.focus())
+        if row is not None:
+            search.insert(0, str(self.cwd / self.table.model.relative_path(row)))
+            look_up()
+        search.focus_set()
+
+    def run_in_background(self, target, on_done, on_error=None):
+        """Call target() on a background thread, and then on_done(result) on the Tk main thread.
+        If target() raises, on_error(error) is called instead (by default, the error is printed
+        and the buttons are restored)"""
+        result_queue = queue.Queue(maxsize=1)
+        def run():
+            try:
+                result_queue.put((True, target()))
+            except Exception as err:
+                result_queue.put((False, err))
+
+        def poll():
+            try:
+                succeeded, result = result_queue.get_nowait()
+            except queue.Empty:
+                self.parent.after(PROGRESS_POLL_MS, poll)
+                return
+            if succeeded:
+                on_done(result)
+            elif on_error is not None:
+                on_error(result)
             else:
-                if source.is_dir():
-                    print(f"Issue found at {source}{os.sep}")
-                else:
-                    print(f"Issue found at {source}")
-
-                msg = move_and_log.error_message(table_entry=e,
-                                                 issues=self.flags,
-                                                 source=source,
-                                                 short_paths=False,
-                                                 sep=os.sep)
-                move_and_log.log_message(log_file_path=self.error_log_path, 
-                                         time=current_time, 
-                                         message=msg+'\n')
-
-                # Make an issue card
-                card_name = move_and_log.error_message(table_entry=e,
-                                                       issues=self.flags,
-                                                       source=source,
-                                                       short_paths=False,
-                                                       sep=os.sep,
-                                                       reorgpath=Path(self.settings['REORG_DIRECTORY']),
-                                                       shorten_index=-1)
-                trello.create_card(list_id=self.settings['LIST_ID'], 
-                                   card_name=card_name, 
-                                   card_description=e.issue_message,
-                                   member_ids=self.settings['MEMBER_IDS'], 
-                                   api_key=self.settings['API_KEY'], 
-                                   oath_token=self.settings['OATH_TOKEN'])
-
-        # Remove the rows that were processed from the table
-        for id in row_ids_for_processing:
-            self.table.tree.delete(id)
-        
-        # Exit window if all rows were processed
-        # Note: could also use len(row_ids) == len(row_ids_for_processing)
-        if self.table.tree.get_children() == ():
-            print('All entries have been processed')
-            self.reload_with_new_cwd()
-
-    def load_settings(self, config_file_path):
-        """Loads keys and options from an INI configuration file, checks to make
-        sure all IDs are present, and then returns the settings section of the 
-        file as a dictionary"""
-        print(f"Loading settings from {config_file_path}")
-        config = configparser.ConfigParser(comment_prefixes='/', 
-                                   allow_no_value=True,
-                                   delimiters='=')
-        config.optionxform = lambda option: option
-        config.read(config_file_path)
-
-        # Shorthand for the 'Settings' section
-        settings = config['Settings']
-
-        # Check that trello credentials are present, and if they aren't throw an error
-        if (settings['API_KEY'] == '' or settings['OATH_TOKEN'] == ''):
-            raise ConfigError(f'trello credential(s) missing in {config_file_path}')
-
-        # Check that required names are present, and if they aren't throw an error
-        if (settings['BOARD_NAME'] == '' or settings['LIST_NAME'] == ''):
-            raise ConfigError(f'name(s) missing in {config_file_path}')
-
-        # Check that all paths are present, and if they aren't throw an error
-        if settings['REORG_DIRECTORY'] == '':
-            raise ConfigError(f'path(s) missing in {config_file_path}')
-            
-        # Check that all IDs are present, and if they aren't...
-        if (settings['BOARD_ID'] == '' or
-            settings['LIST_ID'] == '' or
-            (settings['MEMBER_IDS'] == '' and settings['MEMBER_NAMES'] != '')):
-            
-            # Find the BOARD_ID...
-            print(f'Warning: ID(s) missing in {config_file_path}. Attempting to find IDs...\n')
+                print(f'Error: {result!r}\n')
+                self.progresslabel.configure(text='')
+                self.process_button.configure(state='normal')
+                self.reload_button.configure(state='normal')
+                self.next_button.configure(state='normal')
+
+        threading.Thread(target=run, daemon=True).start()
+        self.parent.after(PROGRESS_POLL_MS, poll)
+
+    def show_plan(self, jobs, plan):
+        """Show the plan in a dialog, and start processing if the user accepts it"""
+        print(plan.summary() + '\n')
+        self.progresslabel.configure(text='')
+        dialog = tk.Toplevel(self.parent)
+        dialog.title('Processing plan')
+        dialog.transient(self.parent)
+
+        text = tk.Text(dialog, width=90, height=20, wrap='none')
+        text.insert('1.0', plan.summary())
+        text.configure(state='disabled')
+        text.grid(row=0, column=0, columnspan=2, sticky='nsew')
+        scrollbar = ttk.Scrollbar(dialog, orient='vertical', command=text.yview)
+        scrollbar.grid(row=0, column=2, sticky='ns')
+        text.configure(yscrollcommand=scrollbar.set)
+
+        def proceed():
+            dialog.destroy()
+            self.start_processing([(id, e, item) for (id, e), item in zip(jobs, plan.items)])
+
+        def cancel():
+            dialog.destroy()
+            print('Processing cancelled\n')
+            self.process_button.configure(state='normal')
+            self.reload_button.configure(state='normal')
+            self.next_button.configure(state='normal')
+
+        tk.Button(dialog, text='Proceed', command=proceed).grid(row=1, column=0, pady=5)
+        tk.Button(dialog, text='Cancel', command=cancel).grid(row=1, column=1, pady=5)
+        dialog.protocol('WM_DELETE_WINDOW', cancel)
+
+    def start_processing(self, jobs):
+        """Hand (row_id, table_entry, plan_item) jobs to the background worker"""
+        # Reset progress tracking
+        self.progress_total = len(jobs)
+        self.progress_done = 0
+        self.progress_bytes = 0
+        self.progress_start = time.monotonic()
+        self.progressbar.configure(maximum=self.progress_total, value=0)
+        self.progresslabel.configure(text=f'0/{self.progress_total} items')
+
+        self.cancel_button.configure(state='normal')
+
+        # Set up the pipeline (the worker opens its log files and journal)
+        self.processor = processing.Processor(self.settings, self.flags, 
+                                              self.change_log_path, self.error_log_path,
+                                              id_cache=self.id_cache, progress=self.post_copy_progress,
+                                              journal_path=self.error_log_path.with_name(processing.JOURNAL_FILE_NAME),
+                                              on_moved=lambda source, destination: self.categories.add(destination.parent))
+
+        # Start the worker and begin polling for its progress events
+        self.cancel_event = threading.Event()
+        self.progress_queue = queue.Queue()
+        self.worker = threading.Thread(target=self.process_worker, 
+                                       args=(jobs,),
+                                       daemon=True)
+        self.worker.start()
+        self.parent.after(PROGRESS_POLL_MS, self.poll_progress)
+
+    def process_worker(self, jobs):
+        """Process (row_id, table_entry, plan_item) jobs in order, posting a progress event
+        to self.progress_queue after each one. Runs on a background thread, so it
+        must not touch any Tk widgets"""
+        cancelled = False
+        if processing.is_truthy(self.settings.get('PROFILE', 'no')):
+            profile = metrics.profiled(self.change_log_path.with_name(processing.PROFILE_FILE_NAME))
+        else:
+            profile = nullcontext()
+        try:
+            self.processor.open()
+            with profile:
+                # Finish anything that was interrupted by a crash during an earlier run
+                self.processor.recover()
+
+                for row_id, e, plan_item in jobs:
+                    # Stop cleanly between entries if the user asked to cancel
+                    if self.cancel_event.is_set():
+                        cancelled = True
+                        break
+                    # An unexpected error skips the entry (its row stays), like a failed move
+                    try:
+                        processed, nbytes = self.processor.process_entry(e, self.cwd, plan_item)
+                    except Exception as err:
+                        print(f'Error while processing {e.name}: {err!r}')
+                        print('Entry has been skipped. Continuing...\n')
+                        self.processor.counts['skipped'] += 1
+                        processed, nbytes = False, 0
+                    self.progress_queue.put(('entry', row_id, processed, nbytes))
+        except Exception as err:
+            self.progress_queue.put(('error', err))
+        finally:
             try:
-                settings['BOARD_ID'] = trello.find_board(settings['BOARD_NAME'], settings['API_KEY'], settings['OATH_TOKEN'])
-            except trello.TrelloError:
-                print(f"Error! Board not found: {settings['BOARD_NAME']}. Exiting app...")
-                raise SystemExit
-            
-            # Find the LIST_ID
+                self.processor.close()
+            except Exception as err:
+                self.progress_queue.put(('error', err))
+            self.progress_queue.put(('finished', cancelled))
+
+    def post_copy_progress(self, path, nbytes, copied, total):
+        """Forward a copy_engine chunk callback to the UI as a progress event"""
+        self.progress_queue.put(('bytes', nbytes))
+
+    def poll_progress(self):
+        """Drain the worker's progress events on the Tk main thread, updating the
+        progress bar and removing processed rows as they finish"""
+        finished = False
+        while True:
             try:
-                settings['LIST_ID'] = trello.find_list(settings['BOARD_ID'], settings['LIST_NAME'], settings['API_KEY'], settings['OATH_TOKEN'])
-            except trello.TrelloError:
-                print(f"Error! List not found: {settings['LIST_NAME']}. Exiting app...")
-                raise SystemExit
-            
-            # Find the MEMBER_IDS
-            member_names = settings['MEMBER_NAMES'].split(', ')
-            member_ids = trello.find_members(member_names, settings['API_KEY'], settings['OATH_TOKEN'])
-            settings['MEMBER_IDS'] = ', '.join(member_ids)
-            if len(member_ids) == len(member_names):
-                print ("All members found\n") 
+                event = self.progress_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if event[0] == 'entry':
+                _, row_id, processed, nbytes = event
+                self.progress_done += 1
+                self.progress_bytes += nbytes
+                if processed:
+                    self.table.delete_row(row_id)       #remove the row as soon as its entry is done
+            elif event[0] == 'bytes':
+                self.progress_bytes += event[1]
+            elif event[0] == 'error':
+                print(f'Error during processing: {event[1]!r}\n')
+            elif event[0] == 'finished':
+                finished = True
+                if event[1]:
+                    print('Processing cancelled\n')
+
+        self.update_progress_label()
+
+        if finished:
+            self.finish_processing()
+        else:
+            self.parent.after(PROGRESS_POLL_MS, self.poll_progress)
+
+    def update_progress_label(self):
+        """Show items/sec, bytes/sec and ETA for the current run"""
+        elapsed = max(time.monotonic() - self.progress_start, 1e-6)
+        items_per_sec = self.progress_done / elapsed
+        mb_per_sec = self.progress_bytes / elapsed / 1e6
+        remaining = self.progress_total - self.progress_done
+        if items_per_sec > 0:
+            eta = time.strftime('%H:%M:%S', time.gmtime(remaining / items_per_sec))
+        else:
+            eta = '--:--:--'
+        self.progressbar.configure(value=self.progress_done)
+        self.progresslabel.configure(text=(f'{self.progress_done}/{self.progress_total} items  |  ' +
+                                           f'{items_per_sec:.1f} items/s  |  {mb_per_sec:.1f} MB/s  |  ETA {eta}'))
+
+    def cancel_processing(self):
+        """Ask the worker to stop after the entry it is currently processing"""
+        print('Cancelling after the current entry...')
+        self.cancel_event.set()
+        self.cancel_button.configure(state='disabled')
+
+    def finish_processing(self):
+        """Restore the buttons after the worker is done"""
+        self.process_button.configure(state='normal')
+        self.reload_button.configure(state='normal')
+        self.next_button.configure(state='normal')
+        self.cancel_button.configure(state='disabled')
+
+        # Summarize how the moves were carried out
+        self.processor.print_move_summary()
+
+        # Move on to the next queued directory (or ask for one) if all rows were processed
+        if self.table.row_count() == 0:
+            print('All entries have been processed')
+            if self.directory_queue:
+                self.next_directory()
             else:
-                print("Warning! some members not found. Continuing...\n")
-
-            # Write them to the config file
-            with open(config_file_path, 'w') as config_file:
-                config.write(config_file)
-
-        print('Settings loaded successfully!')
-        print(f"Reorganization directory: {settings['REORG_DIRECTORY']}{os.sep}")
-        return dict(settings)
-
-    def load_flags(self, config_file_path):
-        """Loads keys and options from an INI configuration file, and then 
-        returns the flags section of the file as a dictionary"""
-        print(f"Loading flags from {config_file_path}")
-        config = configparser.ConfigParser(comment_prefixes='/', 
-                                   allow_no_value=True,
-                                   delimiters='=')
-        config.optionxform = lambda option: option
-        config.read(config_file_path)
-        
-        return dict(config['Flags'])
-
-class ConfigError(Exception):
-    pass
+                self.reload_with_new_cwd()
 
 if __name__ == "__main__":
     # Initialize main window
     root=tk.Tk()
     root.title('Reorganize with Trello')
-    root.geometry('795x500')
+    root.geometry('795x560')
 
     # Enable resizing of main window contents
     root.grid_rowconfigure(0, weight=1)
     root.grid_columnconfigure(0, weight=1)
 
     # Create GUI
-    MainApplication(parent=root, 
-                    config_file_path=Path(__file__).parent / 'testconfig.ini',
-                    error_log_path=Path(__file__).parent / 'error.log',
-                    change_log_path=Path(__file__).parent / 'change.log',
-                    column_names=['#0', 'flag', 'cat1', 'cat2', 'cat3', 'issue_message'],
-                    column_widths=[250, 35, 80, 80, 80, 250],
-                    heading_names=['name', 'flag', 'cat1', 'cat2 (opt.)', 'cat3 (opt.)', 'issue message (opt.)'])
+    app = MainApplication(parent=root, 
+                          config_file_path=Path(__file__).parent / 'testconfig.ini',
+                          error_log_path=Path(__file__).parent / 'error.log',
+                          change_log_path=Path(__file__).parent / 'change.log',
+                          column_names=['#0', 'flag', 'cat1', 'cat2', 'cat3', 'issue_message'],
+                          column_widths=[250, 35, 80, 80, 80, 250],
+                          heading_names=['name', 'flag', 'cat1', 'cat2 (opt.)', 'cat3 (opt.)', 'issue message (opt.)'],
+                          directories=sys.argv[1:])    #further folders to work through, e.g. python main.py dir1 dir2
 
     # Run application
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    app.directory_queue.shutdown()
\ No newline at end of file
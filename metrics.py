@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Timing spans and counters for processing runs, kept in one registry shared by
+every thread and exported by the processor at the end of each batch.
+"""
+from pathlib import Path
+from contextlib import contextmanager
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+METRIC_PREFIX = 'reorg_'
+
+class Metrics:
+    """Thread-safe totals for named spans and counters"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}         #maps span name to [count, total seconds, max seconds]
+            self.counters = {}      #maps counter name to its value
+            self.started = time.time()
+
+    @contextmanager
+    def span(self, name: str):
+        """Time the body of a with statement as one occurrence of span name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                self.spans[name] = [1, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = max(stats[2], seconds)
+
+    def count(self, name: str, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        """Returns the current totals as a dictionary"""
+        with self.lock:
+            return {'started': self.started,
+                    'seconds': round(time.time() - self.started, 6),
+                    'spans': {name: {'count': count, 'seconds': round(total, 6), 'max_seconds': round(longest, 6)}
+                              for name, (count, total, longest) in sorted(self.spans.items())},
+                    'counters': dict(sorted(self.counters.items()))}
+
+    def write_json(self, path: Path, **extra):
+        """Write the totals (and any extra fields) as a JSON summary"""
+        write_atomic(path, json.dumps({**self.snapshot(), **extra}, indent=2) + '\n')
+
+    def write_prometheus(self, path: Path):
+        """Write the totals in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = [f'# HELP {METRIC_PREFIX}span_seconds_total Time spent in each phase of the last batch',
+                 f'# TYPE {METRIC_PREFIX}span_seconds_total counter']
+        for name, stats in snapshot['spans'].items():
+            lines.append(f'{METRIC_PREFIX}span_seconds_total{{span="{name}"}} {stats["seconds"]}')
+        lines += [f'# HELP {METRIC_PREFIX}span_calls_total Number of times each phase ran in the last batch',
+                  f'# TYPE {METRIC_PREFIX}span_calls_total counter']
+        for name, stats in snapshot['spans'].items():
+            lines.append(f'{METRIC_PREFIX}span_calls_total{{span="{name}"}} {stats["count"]}')
+        for name, value in snapshot['counters'].items():
+            metric = METRIC_PREFIX + name.replace('.', '_') + '_total'
+            lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+        lines += [f'# TYPE {METRIC_PREFIX}batch_seconds gauge', f'{METRIC_PREFIX}batch_seconds {snapshot["seconds"]}',
+                  f'# TYPE {METRIC_PREFIX}batch_end_timestamp_seconds gauge', f'{METRIC_PREFIX}batch_end_timestamp_seconds {time.time():.3f}']
+        write_atomic(path, '\n'.join(lines) + '\n')
+
+def write_atomic(path: Path, text: str):
+    """Replace path with text, so that readers (e.g. node_exporter) never see a partial file"""
+    tmp = path.with_name(path.name + '.tmp')
+    with tmp.open(mode='w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+# Registry shared by the whole process
+registry = Metrics()
+
+def span(name: str):
+    return registry.span(name)
+
+def count(name: str, n=1):
+    registry.count(name, n)
+
+def timed(name: str):
+    """Decorator that times every call of a function as span name"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with registry.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextmanager
+def profiled(profile_path: Path, top: int = 30):
+    """Profile the body of a with statement (on this thread only) into profile_path,
+    with a report of the slowest functions and largest allocations next to it"""
+    profiler = cProfile.Profile()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        memory = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if not tracing:
+            tracemalloc.stop()
+
+        profiler.dump_stats(profile_path)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(top)
+        report.write(f'Traced memory: {current / 1e6:.1f} MB current, {peak / 1e6:.1f} MB peak\n')
+        report.write(f'Top {top} allocation sites:\n')
+        for stat in memory.statistics('lineno')[:top]:
+            report.write(f'{stat}\n')
+        Path(profile_path).with_suffix('.txt').write_text(report.getvalue(), encoding='utf-8')
+        print(f'Profile written to {profile_path}')
@@ -16,9 +16,17 @@ In order to work, the following must be in the cwd:
       
 """
 from pathlib import Path
+from collections import namedtuple
+import errno
+import functools
+import json
 import os
-from distutils.dir_util import copy_tree
-import shutil
+import time
+import copy_engine
+import metrics
+
+# Result of move(): method is 'rename' (same filesystem) or 'copy' (cross-device)
+MoveResult = namedtuple('MoveResult', 'method duration')
 
 # Functions
 def shorten_path(full_path: Path, shorten_index: int):    #ref: https://stackoverflow.com/questions/53255659/from-pathlib-parts-tuple-to-string-path
@@ -32,82 +40,127 @@ def path_from_common_parent(mainpath: Path, comparepath: Path, parent_index: int
     parents, selects the common parent specified by parent_index, and returns
     a new path from the selected parent to the end of the main path.
     
-    Note: raises ValueError if parent_index is out of range"""
-    parts_in_common = []
-    for part in mainpath.parts:
-        if part in comparepath.parts:
-            if mainpath.parts.index(part) == comparepath.parts.index(part):
-                parts_in_common.append(part)
-        else:
-            break
-    
-    base_part = parts_in_common[parent_index]
-    base_index = mainpath.parts.index(base_part)
+    Note: raises IndexError if parent_index is out of range"""
+    n_common = common_prefix_length(mainpath, comparepath)
+    base_index = range(n_common)[parent_index]
     return Path(*mainpath.parts[base_index:])
 
-def move(source: Path, destination: Path, shorten_index: int, sep: str):
+@functools.lru_cache(maxsize=4096)
+def common_prefix_length(mainpath: Path, comparepath: Path):
+    """Number of leading parts that two paths have in common. Cached, since a batch
+    keeps comparing the same few directories"""
+    n_common = 0
+    for main_part, compare_part in zip(mainpath.parts, comparepath.parts):
+        if main_part != compare_part:
+            break
+        n_common += 1
+    return n_common
+
+def display_name(path: Path, is_dir: bool, sep: str):
+    """Item name as shown in messages, with directories between separators"""
+    return f"{sep}{path.name}{sep}" if is_dir else path.name
+
+def move(source: Path, destination: Path, shorten_index: int, sep: str, progress=None, checked: bool = False, on_same_device: bool = None, is_dir: bool = None):
     """Moves specified item at source path to destination path,
     printing messages to the console as needed.
-    sep is the path delimiter that will be used in console output"""
+    sep is the path delimiter that will be used in console output
+    progress, if given, receives per-chunk callbacks from copy_engine for cross-device moves
+    If checked is True, the source and destination folder are known to exist (e.g. from
+    a planner.Plan), so only the destination is checked, to avoid overwriting anything.
+    on_same_device and is_dir, if not None, are used instead of checking the paths again"""
     s = sep
-    if source.is_dir():
-        name = f"{s}{source.name}{s}"
-    else:
-        name = f"{source.name}"
+    if is_dir is None:
+        is_dir = source.is_dir()
+    name = display_name(source, is_dir, s)
 
     # Create shortened paths
     try:
-        source_parent_for_print = f"{s}{path_from_common_parent(source.parent, destination, shorten_index)}{s}"
-        dest_parent_for_print = f"{s}{path_from_common_parent(destination.parent, source, shorten_index)}{s}"
+        source_parent_for_print = f"{s}{path_from_common_parent(source.parent, destination.parent, shorten_index)}{s}"
+        dest_parent_for_print = f"{s}{path_from_common_parent(destination.parent, source.parent, shorten_index)}{s}"
     except IndexError:
         source_parent_for_print = f"{source.parent}{s}"
         dest_parent_for_print = f"{destination.parent}{s}"
 
-    # Check if the named file/directory exists
-    if not source.exists():
-        print(f"Warning: {name} does not exist in {source_parent_for_print}")
-        raise MoveError('Source does not exist')
-    
-    # Check if there is a duplicate file/directory at the destination
-    if destination.exists():
-        print(f"Warning: {name} already exists in {dest_parent_for_print}")
-        raise MoveError('Source duplicated at destination')
+    with metrics.span('move.check'):
+        # Check if the named file/directory exists
+        if not checked and not source.exists():
+            print(f"Warning: {name} does not exist in {source_parent_for_print}")
+            raise MoveError('Source does not exist')
+
+        # Check if there is a duplicate file/directory at the destination
+        if destination.exists():
+            print(f"Warning: {name} already exists in {dest_parent_for_print}")
+            raise MoveError('Source duplicated at destination')
     
     # Create destination folder if necessary    TODO: modify print statement to include base reorg directory
-    if not destination.parent.exists():
+    if not checked and not destination.parent.exists():
         print(f"Warning: destination does not exist: {dest_parent_for_print}\nCreating destination... ", end="")
-        destination.parent.mkdir(parents=True, exist_ok=False) #all intermediate folders are also created
+        with metrics.span('move.mkdir'):
+            destination.parent.mkdir(parents=True, exist_ok=False) #all intermediate folders are also created
         print("Done")
     
-    # If name is a directory, move it with copy_tree 
-    if source.is_dir():
-        #destination.mkdir(parents=False, exist_ok=False)    
-        copy_tree(str(source), str(destination), preserve_times=True)
-        shutil.rmtree(source)
-    
-    # If name is a file, move it with shutil.move
+    # Move the item, renaming it in place if possible and copying it otherwise
+    start = time.perf_counter()
+    method = 'rename'
+    if on_same_device is None:
+        try:
+            on_same_device = same_device(source, destination.parent)
+        except FileNotFoundError:       #the source vanished after it was checked
+            print(f"Warning: {name} does not exist in {source_parent_for_print}")
+            raise MoveError('Source does not exist')
+    if on_same_device:
+        try:
+            with metrics.span('move.rename'):
+                os.rename(source, destination)
+        except FileNotFoundError:
+            print(f"Warning: {name} does not exist in {source_parent_for_print}")
+            raise MoveError('Source does not exist')
+        except OSError as e:
+            if e.errno != errno.EXDEV:   #st_dev can match across some mounts (e.g. bind mounts)
+                raise
+            method = 'copy'
     else:
-        shutil.move(source, destination)
+        method = 'copy'
 
-    print(f"{name} has been moved to {dest_parent_for_print}\n")
+    if method == 'copy':
+        try:
+            with metrics.span('move.copy'):
+                copy_engine.move(source, destination, progress=progress)
+        except copy_engine.CopyError as e:
+            print(f"Warning: {e}")
+            raise MoveError('Copy could not be verified')
+        except FileNotFoundError:
+            if os.path.lexists(source):
+                raise
+            print(f"Warning: {name} does not exist in {source_parent_for_print}")
+            raise MoveError('Source does not exist')
+    duration = time.perf_counter() - start
+
+    print(f"{name} has been moved to {dest_parent_for_print} ({method}, {duration:.3f}s)\n")
+    return MoveResult(method, duration)
 
-def move_message(source: Path, destination: Path, sep: str):
+def same_device(source: Path, destination_dir: Path):
+    """Returns True if source and destination_dir are on the same filesystem"""
+    return source.lstat().st_dev == destination_dir.stat().st_dev
+
+def move_message(source: Path, destination: Path, sep: str, is_dir: bool = None):
     """Compose a message describing the movement
     Note that table_entry must have the following attributes: name
-    sep is the path delimiter that will be used in the returned message"""
+    sep is the path delimiter that will be used in the returned message
+    is_dir, if not None, is used instead of checking the source again"""
     s = sep
-    if source.is_dir():
-        name = f"{s}{source.name}{s}"
-    else:
-        name = f"{source.name}"
+    if is_dir is None:
+        is_dir = source.is_dir()
+    name = display_name(source, is_dir, s)
     move_msg = f"moved {name} in {source.parent}{s} to {destination.parent}{s}\n"
     return move_msg
 
-def error_message(table_entry, issues: dict, source: Path, short_paths: bool, sep: str, **kwargs):
+def error_message(table_entry, issues: dict, source: Path, short_paths: bool, sep: str, is_dir: bool = None, **kwargs):
     """Compose a message describing the movement error
     If short_paths=True, then the source path will be shortened to base_dir
     - table_entry must have the following attributes: name, flag
     - sep is the path delimiter that will be used in the returned message
+    - is_dir, if not None, is used instead of checking the source again
     - if short_paths is True, the following keyword arguments must be provided:
       - reorgpath: Path
       - shorten_index: int"""
@@ -117,10 +170,9 @@ def error_message(table_entry, issues: dict, source: Path, short_paths: bool, se
     issue_type = issues.get(table_entry.flag, 'Issue') #returns 'Issue' if flag is not 'd' or 'u'
     
     # Add leading and trailing backslashes to directory names
-    if source.is_dir():
-        name = f"{s}{table_entry.name}{s}"
-    else:
-        name = source.name
+    if is_dir is None:
+        is_dir = source.is_dir()
+    name = display_name(source, is_dir, s)
 
     # If necessary, obtain short path parameters
     if short_paths:
@@ -142,10 +194,140 @@ def error_message(table_entry, issues: dict, source: Path, short_paths: bool, se
         error_msg = f"{issue_type}: {name} in {source.parent}{s}"
     return error_msg
 
+def item_size(path: Path, is_dir: bool = None):
+    """Returns the size in bytes of a file, or the total size of all files in a directory.
+    is_dir, if not None, is used instead of checking the path again"""
+    with metrics.span('move.size'):
+        return _item_size(path, is_dir)
+
+def _item_size(path: Path, is_dir: bool = None):
+    if is_dir is None:
+        is_dir = path.is_dir()
+    if not is_dir:
+        try:
+            return path.stat().st_size
+        except OSError:
+            return 0
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
 def log_message(log_file_path: Path, time, message):
     """Write a timestamped message to a logfile"""
-    with log_file_path.open(mode='a') as log_file:
+    with metrics.span('log.write'), log_file_path.open(mode='a') as log_file:
             log_file.write(time + ' --- ' + message)
 
+def timestamp(when: float = None):
+    """Returns the current local time (or the time when) in the format used in the log files"""
+    return time.strftime('%Y-%m-%d %H:%M:%S %z', time.localtime(when if when is not None else time.time()))
+
+class LogWriter:
+    """Keeps a log file open for a whole batch and buffers the messages written
+    to it, optionally writing a JSON Lines record next to each message.
+    - flush_every: flush after every n messages (1 = every entry, 0 = only at the end of the batch)
+    - fsync: also force flushed messages onto the disk
+    - json_path: if given, a JSON Lines file that receives one record per message
+    - history: if given, a history.History that records every message (committed when flushed)
+    - max_bytes: if not 0, a log file that grows past this size is renamed to <name>.1
+      (and older ones to <name>.2 and so on, keeping backups of them) and started afresh"""
+    def __init__(self, log_file_path: Path, flush_every: int = 1, fsync: bool = False, json_path: Path = None,
+                 history=None, max_bytes: int = 0, backups: int = 5):
+        self.log_file_path = log_file_path
+        self.json_path = json_path
+        self.flush_every = flush_every
+        self.fsync = fsync
+        self.history = history
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.pending = 0        #messages written since the last flush
+        self.log_file = log_file_path.open(mode='a', buffering=1024*1024)
+        self.json_file = json_path.open(mode='a', buffering=1024*1024) if json_path is not None else None
+        self.sizes = {log_file_path: self.log_file.tell(), json_path: self.json_file.tell() if self.json_file is not None else 0}
+
+    def write(self, message: str, **record):
+        """Write a timestamped message to the log file. Keyword arguments (e.g. source,
+        destination, flag, bytes, duration) are added to the JSON record"""
+        with metrics.span('log.write'):
+            when = time.time()
+            now = timestamp(when)
+            line = now + ' --- ' + message
+            self.log_file.write(line)
+            self.sizes[self.log_file_path] += len(line)
+            if self.json_file is not None:
+                json_line = json.dumps({'timestamp': now, **{k: (str(v) if isinstance(v, Path) else v) for k, v in record.items()}}) + '\n'
+                self.json_file.write(json_line)
+                self.sizes[self.json_path] += len(json_line)
+            if self.history is not None:
+                self.history.add(message, timestamp=when, **record)
+        
+        self.pending += 1
+        if self.flush_every and self.pending >= self.flush_every:
+            self.flush()
+        if self.max_bytes and max(self.sizes.values()) > self.max_bytes:
+            self.rotate()
+
+    def flush(self):
+        with metrics.span('log.flush'):
+            for f in (self.log_file, self.json_file):
+                if f is not None:
+                    f.flush()
+                    if self.fsync:
+                        os.fsync(f.fileno())
+            if self.history is not None:
+                self.history.commit()
+        self.pending = 0
+
+    def rotate(self):
+        """Start new files for the logs that have grown past max_bytes"""
+        self.flush()
+        if self.sizes[self.log_file_path] > self.max_bytes:
+            self.log_file.close()
+            rotate_file(self.log_file_path, self.backups)
+            self.log_file = self.log_file_path.open(mode='a', buffering=1024*1024)
+            self.sizes[self.log_file_path] = 0
+        if self.json_file is not None and self.sizes[self.json_path] > self.max_bytes:
+            self.json_file.close()
+            rotate_file(self.json_path, self.backups)
+            self.json_file = self.json_path.open(mode='a', buffering=1024*1024)
+            self.sizes[self.json_path] = 0
+
+    def close(self):
+        self.flush()
+        self.log_file.close()
+        if self.json_file is not None:
+            self.json_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def rotate_file(path: Path, backups: int):
+    """Rename path to path.1, shifting older copies up to path.<backups> (the oldest is deleted)"""
+    for index in range(backups - 1, 0, -1):
+        older = path.with_name(f'{path.name}.{index}')
+        if older.exists():
+            os.replace(older, path.with_name(f'{path.name}.{index + 1}'))
+    if backups > 0:
+        os.replace(path, path.with_name(f'{path.name}.1'))
+    else:
+        path.unlink()
+
+def parse_flush_policy(policy: str):
+    """Converts a LOG_FLUSH setting ('entry', 'batch', or a number n) into the
+    flush_every argument of LogWriter"""
+    policy = policy.strip().lower()
+    if policy in ('', 'entry'):
+        return 1
+    if policy == 'batch':
+        return 0
+    return max(1, int(policy))
+
 class MoveError(Exception):
     pass
\ No newline at end of file
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Durable outbox for Trello cards. Cards are saved in SQLite and sent by a small
+pool of background workers while items keep being moved; cards that fail are
+retried later, or by the next run.
+"""
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sqlite3
+import threading
+import time
+import metrics
+
+MAX_RETRY_DELAY = 300.0     #seconds between attempts to send a card, at most
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cards (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    list_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL,
+    member_ids TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    card_id TEXT,
+    checklist TEXT,
+    checklist_ids TEXT,
+    items_sent INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cards_pending ON cards (status, next_attempt);
+CREATE INDEX IF NOT EXISTS cards_key ON cards (key, status);
+CREATE TABLE IF NOT EXISTS issues (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    outbox_id INTEGER NOT NULL REFERENCES cards (id),
+    source TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'open',
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS issues_status ON issues (status, outbox_id);
+CREATE INDEX IF NOT EXISTS issues_source ON issues (source);
+"""
+
+class Outbox:
+    """SQLite table of cards waiting to be sent, and the issues behind them"""
+    def __init__(self, outbox_path: Path):
+        self.outbox_path = outbox_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(outbox_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')     #a queued card must survive a crash
+        self.connection.executescript(SCHEMA)
+
+        # Outboxes written before cards could have checklists lack these columns
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(cards)')}
+        for column, definition in (('checklist', 'TEXT'), ('checklist_ids', 'TEXT'), ('items_sent', 'INTEGER NOT NULL DEFAULT 0')):
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE cards ADD COLUMN {column} {definition}')
+
+    def put(self, key: str, list_id: str, name: str, description: str, member_ids: str, checklist: list = None, issues: list = None):
+        """Queue a card and its issues, (source path, table entry) pairs, and return its
+        outbox ID. A card still pending for the same key is not queued twice"""
+        now = time.time()
+        with metrics.span('outbox.put'), self.lock:
+            row = self.connection.execute("SELECT id FROM cards WHERE key = ? AND status = 'pending'", (key,)).fetchone()
+            if row is not None:
+                return row[0]
+            self.connection.execute('BEGIN')       #the card and its issues are committed together
+            try:
+                id_ = self.connection.execute(
+                    'INSERT INTO cards (key, list_id, name, description, member_ids, checklist, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (key, list_id, name, description, member_ids, json.dumps(checklist) if checklist else None, now, now)).lastrowid
+                self.connection.executemany('INSERT INTO issues (outbox_id, source, entry, created, updated) VALUES (?, ?, ?, ?, ?)',
+                                            [(id_, str(source), json.dumps(list(entry)), now, now) for source, entry in issues or ()])
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+            return id_
+
+    def due(self, limit: int, exclude=()):
+        """Returns up to limit pending cards whose retry delay has passed, oldest first,
+        as dictionaries with the card's columns (checklist and checklist_ids decoded)"""
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT id, list_id, name, description, member_ids, attempts, card_id, checklist, checklist_ids, items_sent " +
+                "FROM cards WHERE status = 'pending' AND next_attempt <= ? ORDER BY id LIMIT ?",
+                (time.time(), limit + len(exclude)))
+            names = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        cards = []
+        for row in rows:
+            card = dict(zip(names, row))
+            if card['id'] in exclude:
+                continue
+            card['checklist'] = json.loads(card['checklist']) if card['checklist'] else []
+            card['checklist_ids'] = json.loads(card['checklist_ids']) if card['checklist_ids'] else []
+            cards.append(card)
+        return cards[:limit]
+
+    def save_progress(self, id_: int, **changes):
+        """Record the progress of sending a card (its card_id, checklist_ids or items_sent)"""
+        values = {column: (json.dumps(value) if column == 'checklist_ids' else value) for column, value in changes.items()}
+        self.update(id_, ', '.join(f'{column} = ?' for column in values), *values.values())
+
+    def mark_sent(self, id_: int, card_id: str):
+        self.update(id_, "status = 'sent', card_id = ?, attempts = attempts + 1", card_id)
+
+    def mark_failed(self, id_: int, error: str):
+        """The card was rejected and will not be sent again"""
+        self.update(id_, "status = 'failed', last_error = ?, attempts = attempts + 1", error)
+
+    def retry_later(self, id_: int, error: str, delay: float):
+        self.update(id_, "last_error = ?, attempts = attempts + 1, next_attempt = ?", error, time.time() + delay)
+
+    def update(self, id_: int, assignments: str, *values):
+        with self.lock:
+            self.connection.execute(f'UPDATE cards SET {assignments}, updated = ? WHERE id = ?', (*values, time.time(), id_))
+
+    def retry_now(self):
+        """Make every pending card due again (e.g. at the start of a new run, when
+        the connection may have come back)"""
+        with self.lock:
+            self.connection.execute("UPDATE cards SET next_attempt = 0 WHERE status = 'pending'")
+
+    def issues(self, status: str = 'open'):
+        """Returns the issues with the given status whose cards have been sent, as
+        dictionaries with the keys id, card_id, source, entry (decoded) and created"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT issues.id, cards.card_id, issues.source, issues.entry, issues.created FROM issues ' +
+                "JOIN cards ON cards.id = issues.outbox_id WHERE issues.status = ? AND cards.status = 'sent' ORDER BY issues.id",
+                (status,)).fetchall()
+        return [{'id': id_, 'card_id': card_id, 'source': source, 'entry': json.loads(entry), 'created': created}
+                for id_, card_id, source, entry, created in rows]
+
+    def issue_status(self, source: str, flag: str):
+        """Returns the status of the latest issue for source with the given flag, or None if there is none"""
+        with self.lock:
+            rows = self.connection.execute('SELECT status, entry FROM issues WHERE source = ? ORDER BY id DESC', (source,)).fetchall()
+        for status, entry in rows:
+            if json.loads(entry)[1] == flag:
+                return status
+        return None
+
+    def set_issue_status(self, ids, status: str):
+        """Set the status of issues ('open', 'resolved' once their card is resolved, or
+        'cleared' once they have been handed back to be processed again)"""
+        with self.lock:
+            self.connection.executemany('UPDATE issues SET status = ?, updated = ? WHERE id = ?',
+                                        [(status, time.time(), id_) for id_ in ids])
+
+    def count(self, status: str = 'pending'):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM cards WHERE status = ?', (status,)).fetchone()[0]
+
+    def count_due(self):
+        """Number of pending cards whose retry delay has passed"""
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM cards WHERE status = 'pending' AND next_attempt <= ?",
+                                           (time.time(),)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class OutboxSender:
+    """Sends the cards in an outbox with send(card, save), at most workers at a time.
+    Cards for which is_permanent(error) is true are marked failed rather than retried"""
+    def __init__(self, outbox: Outbox, send, is_permanent=lambda error: False, workers: int = 4, poll_interval: float = 1.0):
+        self.outbox = outbox
+        self.send = send
+        self.is_permanent = is_permanent
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.slots = threading.BoundedSemaphore(workers)
+        self.in_flight = set()      #outbox IDs currently being sent
+        self.in_flight_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.executor = None
+        self.thread = None
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='outbox')
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def notify(self):
+        """Wake the sender up after a card was queued"""
+        self.wake.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            with self.in_flight_lock:
+                busy = set(self.in_flight)
+            cards = self.outbox.due(self.workers, exclude=busy)
+            if not cards:
+                self.wake.wait(self.poll_interval)
+                self.wake.clear()
+                continue
+            for card in cards:
+                self.slots.acquire()        #blocks while every worker is busy
+                with self.in_flight_lock:
+                    self.in_flight.add(card['id'])
+                self.executor.submit(self.deliver, card)
+
+    def deliver(self, card):
+        id_ = card['id']
+        try:
+            card_id = self.send(card, lambda **changes: self.outbox.save_progress(id_, **changes))
+        except Exception as error:
+            if self.is_permanent(error):
+                print(f'Card could not be created: {card["name"]} ({error})')
+                self.outbox.mark_failed(id_, str(error))
+                metrics.count('cards_failed')
+            else:
+                self.outbox.retry_later(id_, str(error), min(MAX_RETRY_DELAY, 2.0 ** card['attempts']))
+                metrics.count('card_retries')
+        else:
+            self.outbox.mark_sent(id_, card_id)
+            metrics.count('cards_created')
+        finally:
+            with self.in_flight_lock:
+                self.in_flight.discard(id_)
+            self.slots.release()
+            self.wake.set()
+
+    def idle(self):
+        """True if nothing is being sent and no card is due; cards waiting out a retry
+        delay are sent by run() once it has passed"""
+        with self.in_flight_lock:
+            if self.in_flight:
+                return False
+        return self.outbox.count_due() == 0
+
+    def stop(self, timeout: float = 0.0):
+        """Wait up to timeout seconds for the due cards to be sent (but not for cards
+        waiting out a retry delay), then stop once the requests in flight have
+        finished. Returns the number of cards still pending"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and not self.idle():
+            time.sleep(0.05)
+        self.stopping.set()
+        self.wake.set()
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+        return self.outbox.count('pending')
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Dry-run planning for processing runs.
+
+Instead of checking the source, the destination and the destination folder of
+every entry separately while items are being moved, the planner lists each
+directory involved (the current directory and every destination folder under
+REORG_DIRECTORY) once, and resolves all entries against that index. This finds
+every missing source, duplicate, and intra-batch collision before anything is
+moved, and the resulting plan is reused by the processor so that it doesn't
+have to check each path again.
+"""
+from pathlib import Path
+from collections import namedtuple
+import os
+import metrics
+
+# action is 'move', 'flag' or 'skip'; problem is None or one of the PROBLEMS keys;
+# is_dir is whether the source is a directory (None if it doesn't exist)
+PlanItem = namedtuple('PlanItem', 'entry source destination action problem same_device is_dir')
+
+PROBLEMS = {'missing_source': 'does not exist',
+            'duplicate': 'already exists at the destination',
+            'collision': 'has the same destination as another entry'}
+
+def path_key(path):
+    """Returns a key for comparing paths the way the filesystem would (e.g. case-insensitively on Windows)"""
+    return os.path.normcase(str(path))
+
+class DirectoryIndex:
+    """Names, types and device numbers of a set of directories, each listed once.
+    Serves as the metadata snapshot of a batch, so that each item is only looked
+    up once however many times it is checked or printed"""
+    def __init__(self):
+        self.dirs = {}      #maps path_key(directory) to (st_dev, {name key: is_dir}), or None if it doesn't exist
+
+    def scan(self, directory: Path):
+        """List directory if it hasn't been listed yet, and return its index entry"""
+        key = path_key(directory)
+        if key not in self.dirs:
+            try:
+                with metrics.span('listing'), os.scandir(directory) as entries:
+                    names = {path_key(entry.name): entry.is_dir() for entry in entries}
+                self.dirs[key] = (os.stat(directory).st_dev, names)
+            except (FileNotFoundError, NotADirectoryError):
+                self.dirs[key] = None
+        return self.dirs[key]
+
+    def exists(self, path: Path):
+        entry = self.scan(path.parent)
+        return entry is not None and path_key(path.name) in entry[1]
+
+    def is_dir(self, path: Path):
+        """True if path is a directory (following symlinks), False if it is not,
+        or None if it doesn't exist"""
+        entry = self.scan(path.parent)
+        return entry[1].get(path_key(path.name)) if entry is not None else None
+
+    def dir_exists(self, directory: Path):
+        return self.scan(directory) is not None
+
+    def device(self, directory: Path):
+        entry = self.scan(directory)
+        return entry[0] if entry is not None else None
+
+    def add(self, path: Path, is_dir: bool = False):
+        """Record that path now exists (e.g. after an item was moved there)"""
+        entry = self.dirs.get(path_key(path.parent))
+        if entry is not None:
+            entry[1][path_key(path.name)] = is_dir
+
+class Plan:
+    """The resolved actions for a batch of entries"""
+    def __init__(self, items, dirs_to_create, index):
+        self.items = items
+        self.dirs_to_create = dirs_to_create
+        self.index = index
+
+    def count(self, action):
+        return sum(1 for item in self.items if item.action == action)
+
+    def problems(self):
+        return [item for item in self.items if item.problem is not None]
+
+    def summary(self, sep: str = os.sep, max_problems: int = 1000):
+        """Returns a human-readable description of the plan"""
+        lines = [f'{self.count("move")} item(s) will be moved',
+                 f'{self.count("flag")} item(s) will be flagged',
+                 f'{self.count("skip")} item(s) will be skipped',
+                 f'{len(self.dirs_to_create)} folder(s) will be created']
+        problems = self.problems()
+        if problems:
+            lines.append('\nProblems:')
+            for item in problems[:max_problems]:
+                where = item.source.parent if item.problem == 'missing_source' else item.destination.parent
+                lines.append(f'{item.source.name} {PROBLEMS[item.problem]} ({where}{sep})')
+            if len(problems) > max_problems:
+                lines.append(f'... and {len(problems) - max_problems} more')
+        if self.dirs_to_create:
+            lines.append('\nNew folders:')
+            for directory in sorted(self.dirs_to_create, key=str)[:max_problems]:
+                lines.append(f'{directory}{sep}')
+        return '\n'.join(lines)
+
+@metrics.timed('plan')
+def make_plan(entries, cwd: Path, reorg_directory: Path, destination_for):
+    """Resolve every entry against a single listing of cwd and of each destination
+    folder. destination_for(entry, source, reorg_directory) returns the path an
+    entry will be moved to"""
+    index = DirectoryIndex()
+    cwd_dev = index.device(cwd)
+    items = []
+    dirs_to_create = set()
+    claimed = set()     #destinations already taken by an earlier entry in this batch
+
+    for e in entries:
+        source = cwd / e.name
+        is_dir = index.is_dir(source)
+        source_exists = is_dir is not None
+
+        # Flagged items are not moved, so only the source matters
+        if e.flag != '':
+            items.append(PlanItem(e, source, None, 'flag', None if source_exists else 'missing_source', None, is_dir))
+            continue
+
+        destination = destination_for(e, source, reorg_directory)
+        if not source_exists:
+            problem = 'missing_source'
+        elif index.exists(destination):
+            problem = 'duplicate'
+        elif path_key(destination) in claimed:
+            problem = 'collision'
+        else:
+            problem = None
+
+        if problem is not None:
+            items.append(PlanItem(e, source, destination, 'skip', problem, None, is_dir))
+            continue
+
+        claimed.add(path_key(destination))
+        if not index.dir_exists(destination.parent):
+            dirs_to_create.add(destination.parent)
+            same_device = None      #not known until the folder exists
+        else:
+            same_device = index.device(destination.parent) == cwd_dev
+        items.append(PlanItem(e, source, destination, 'move', None, same_device, is_dir))
+
+    return Plan(items, dirs_to_create, index)
@@ -0,0 +1,535 @@
+# -*- coding: utf-8 -*-
+"""
+Configuration loading and the per-entry processing pipeline (move, log, and
+create Trello cards), kept free of any user interface so that it can be driven
+both by the Tk application in main.py and headlessly by batch.py
+"""
+from pathlib import Path
+from collections import namedtuple
+import configparser
+import hashlib
+import os
+import trello
+import move_and_log
+import journal
+import planner
+import metrics
+import outbox
+import history
+import rules
+
+ID_CACHE_FILE_NAME = 'trello_cache.json'
+JOURNAL_FILE_NAME = 'journal.jsonl'
+METRICS_FILE_NAME = 'metrics.json'         #written next to the change log at the end of each batch
+PROMETHEUS_FILE_NAME = 'metrics.prom'
+PROFILE_FILE_NAME = 'profile.prof'
+OUTBOX_FILE_NAME = 'card_outbox.db'        #kept next to the error log
+CARD_CACHE_FILE_NAME = 'card_cache.db'     #state of the cards on the board, for syncing resolved issues back
+HASH_CACHE_FILE_NAME = 'hash_cache.db'     #content hashes for finding duplicates, kept next to the error log
+HISTORY_FILE_NAME = 'history.db'           #indexed copy of the logs, kept next to the change log
+CARD_GROUPINGS = ('none', 'flag', 'directory', 'both')
+MAX_DESCRIPTION_LENGTH = 16384             #Trello's limit on the length of a card description
+
+# Fields of a table entry, in the same order as the columns of the table
+ENTRY_FIELDS = ('name', 'flag', 'cat1', 'cat2', 'cat3', 'issue_message')
+TableEntry = namedtuple('TableEntry', ENTRY_FIELDS)
+
+def read_config(config_file_path):
+    """Parses an INI configuration file, preserving the case of its keys"""
+    config = configparser.ConfigParser(comment_prefixes='/',
+                               allow_no_value=True,
+                               delimiters='=')
+    config.optionxform = lambda option: option
+    config.read(config_file_path)
+    return config
+
+def load_settings(config_file_path, config=None):
+    """Loads keys and options from an INI configuration file, looks up any missing
+    Trello IDs, and returns (settings, id_cache)"""
+    print(f"Loading settings from {config_file_path}")
+    if config is None:
+        config = read_config(config_file_path)
+
+    # Shorthand for the 'Settings' section
+    settings = dict(config['Settings'])
+
+    # Check that trello credentials are present, and if they aren't throw an error
+    if (settings['API_KEY'] == '' or settings['OATH_TOKEN'] == ''):
+        raise ConfigError(f'trello credential(s) missing in {config_file_path}')
+
+    # Check that required names are present, and if they aren't throw an error
+    if (settings['BOARD_NAME'] == '' or settings['LIST_NAME'] == ''):
+        raise ConfigError(f'name(s) missing in {config_file_path}')
+
+    # Check that all paths are present, and if they aren't throw an error
+    if settings['REORG_DIRECTORY'] == '':
+        raise ConfigError(f'path(s) missing in {config_file_path}')
+
+    # Check that all IDs are present, and if they aren't...
+    id_cache = trello.IDCache(Path(config_file_path).with_name(ID_CACHE_FILE_NAME))
+    if (settings['BOARD_ID'] == '' or
+        settings['LIST_ID'] == '' or
+        (settings['MEMBER_IDS'] == '' and settings['MEMBER_NAMES'] != '')):
+
+        # Resolve them from the cache, or from Trello if they aren't cached
+        print(f'Warning: ID(s) missing in {config_file_path}. Attempting to find IDs...\n')
+        member_names = [name for name in settings['MEMBER_NAMES'].split(', ') if name != '']
+        try:
+            board_id, list_id, member_ids = trello.resolve_ids(settings['BOARD_NAME'],
+                                                               settings['LIST_NAME'],
+                                                               member_names,
+                                                               settings['API_KEY'],
+                                                               settings['OATH_TOKEN'],
+                                                               cache=id_cache)
+        except trello.TrelloError as e:
+            print(f"Error! {e}. Exiting app...")
+            raise SystemExit
+
+        # IDs given in the config file take precedence
+        settings['BOARD_ID'] = settings['BOARD_ID'] or board_id
+        settings['LIST_ID'] = settings['LIST_ID'] or list_id
+        settings['MEMBER_IDS'] = settings['MEMBER_IDS'] or ', '.join(member_ids)
+        if len(member_ids) == len(member_names):
+            print ("All members found\n")
+        else:
+            print("Warning! some members not found. Continuing...\n")
+
+    print('Settings loaded successfully!')
+    print(f"Reorganization directory: {settings['REORG_DIRECTORY']}{os.sep}")
+    return settings, id_cache
+
+def load_flags(config_file_path, config=None):
+    """Loads keys and options from an INI configuration file, and then
+    returns the flags section of the file as a dictionary"""
+    print(f"Loading flags from {config_file_path}")
+    if config is None:
+        config = read_config(config_file_path)
+
+    return dict(config['Flags'])
+
+def make_plan(entries, cwd: Path, settings: dict):
+    """Returns a planner.Plan for the entries, without moving anything"""
+    return planner.make_plan(entries, cwd, Path(settings['REORG_DIRECTORY']), destination_for)
+
+def is_truthy(value: str):
+    """Returns True for yes/true/1 setting values"""
+    return value.strip().lower() in ('yes', 'true', '1')
+
+def needs_processing(e: TableEntry):
+    """Only entries with a flag or a primary category are processed"""
+    return e.flag != '' or e.cat1 != ''
+
+def destination_for(e: TableEntry, source: Path, reorg_directory: Path):
+    """Returns the path that the entry's item will be moved to"""
+    if e.cat3 != '':
+        return reorg_directory / e.cat1 / e.cat2 / e.cat3 / source.name
+    elif e.cat2 !='':
+        return reorg_directory / e.cat1 / e.cat2 / source.name
+    else:
+        return reorg_directory / e.cat1 / source.name
+
+def item_list(items: list, max_length: int):
+    """Returns a Markdown list of items, cut short to fit in max_length characters"""
+    lines = []
+    length = 0
+    for index, item in enumerate(items):
+        line = f'- {item}'
+        remaining = len(items) - index
+        if length + len(line) + 40 > max_length and remaining > 1:     #leave room for the last line
+            lines.append(f'- ... and {remaining} more')
+            break
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines)[:max_length]
+
+class Processor:
+    """Moves or flags table entries one at a time, logging every result and making a
+    Trello card for each flagged entry (or group of them, see CARD_GROUPING).
+    progress and on_moved, if given, are called as items are copied and moved;
+    journal_path, if given, makes runs resumable. Use as a context manager"""
+    def __init__(self, settings: dict, flags: dict, change_log_path: Path, error_log_path: Path, id_cache=None, progress=None, journal_path: Path = None, on_moved=None):
+        self.settings = settings
+        self.flags = flags
+        self.change_log_path = change_log_path
+        self.error_log_path = error_log_path
+        self.id_cache = id_cache
+        self.progress = progress
+        self.on_moved = on_moved
+        self.journal_path = journal_path
+        self.journal = None
+        self.change_log = None
+        self.error_log = None
+        self.reorg_directory = Path(settings['REORG_DIRECTORY'])
+        self.export_metrics = is_truthy(settings.get('METRICS', 'yes'))
+        self.history = None
+        self.use_outbox = is_truthy(settings.get('CARD_OUTBOX', 'yes'))
+        self.grouping = settings.get('CARD_GROUPING', 'none').strip().lower() or 'none'
+        if self.grouping not in CARD_GROUPINGS:
+            raise ConfigError(f"CARD_GROUPING must be one of {', '.join(CARD_GROUPINGS)}")
+        self.use_checklists = is_truthy(settings.get('CARD_CHECKLIST', 'yes'))
+        self.groups = {}        #maps (flag, folder) to a list of (journal key, item name, issue message, (source, entry))
+        self.outbox = None
+        self.sender = None
+
+        # Statistics for the batch
+        self.move_stats = {}        #maps move method ('rename' or 'copy') to (count, total seconds)
+        self.counts = {'moved': 0, 'flagged': 0, 'skipped': 0, 'replayed': 0}
+        self.bytes_moved = 0
+        self.created_dirs = {}      #maps planned folders created during the batch to whether they are on the source device (None if unknown)
+
+    def open(self):
+        """Open the log files and the journal for the batch"""
+        if is_truthy(self.settings.get('HISTORY', 'yes')):
+            self.history = history.History(self.change_log_path.with_name(HISTORY_FILE_NAME))
+        self.change_log = self.open_log(self.change_log_path)
+        self.error_log = self.open_log(self.error_log_path)
+        if self.journal_path is not None:
+            self.journal = journal.Journal(self.journal_path)
+        if self.use_outbox:
+            self.outbox = outbox.Outbox(self.error_log_path.with_name(OUTBOX_FILE_NAME))
+            self.outbox.retry_now()
+            self.sender = outbox.OutboxSender(self.outbox, self.send_card, self.is_permanent_error,
+                                              workers=int(self.settings.get('CARD_WORKERS', '') or 4)).start()
+            pending = self.outbox.count('pending')
+            if pending:
+                print(f'Sending {pending} card(s) left in the outbox by an earlier run\n')
+        return self
+
+    def close(self):
+        """Close whatever open() managed to open, so that it is safe to call after open() failed"""
+        if self.error_log is not None:
+            self.send_groups()
+        for log in (self.change_log, self.error_log):
+            if log is not None:
+                log.close()
+        self.change_log = self.error_log = None
+        if self.history is not None:
+            self.history.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.sender is not None:
+            pending = self.sender.stop(timeout=float(self.settings.get('OUTBOX_DRAIN_TIMEOUT', '') or 30))
+            self.outbox.close()
+            if pending:
+                print(f'Warning: {pending} card(s) could not be sent yet. They will be sent the next time entries are processed\n')
+        if self.id_cache is not None:
+            self.id_cache.save()        #keep any IDs invalidated by rejected cards
+        if self.export_metrics:
+            self.write_metrics()
+
+    def send_card(self, card, save):
+        """Called by the outbox workers to create a queued card"""
+        return trello.post_card_with_checklist(card['list_id'], card['name'], card['description'], card['member_ids'],
+                                               card['checklist'], self.settings['API_KEY'], self.settings['OATH_TOKEN'],
+                                               state=card, save=save)
+
+    def make_card(self, keys: list, card_name: str, description: str, items: list = None, issues: list = None):
+        """Queue a card in the outbox (or, without one, create it now) for the entries with
+        the given journal keys and mark them done. Returns False if the card failed"""
+        if self.outbox is not None:
+            # Queue the card; the outbox workers send it while the next entries are processed
+            key = keys[0] if len(keys) == 1 else f'group|{keys[0]}|{len(keys)}'
+            outbox_id = self.outbox.put(key=key,
+                                        list_id=self.settings['LIST_ID'],
+                                        name=card_name,
+                                        description=description,
+                                        member_ids=self.settings['MEMBER_IDS'],
+                                        checklist=items,
+                                        issues=issues)
+            self.sender.notify()
+            print(f"Card queued: \'{card_name}\'\n")
+            done = {'outbox_id': outbox_id}
+            metrics.count('cards_queued')
+        else:
+            state, save = self.card_progress(keys[0], items)
+            card_id = trello.create_card(list_id=self.settings['LIST_ID'],
+                                         card_name=card_name,
+                                         card_description=description,
+                                         member_ids=self.settings['MEMBER_IDS'],
+                                         api_key=self.settings['API_KEY'],
+                                         oath_token=self.settings['OATH_TOKEN'],
+                                         cache=self.id_cache,
+                                         items=items,
+                                         state=state,
+                                         save=save)
+            metrics.count('cards_created' if card_id is not None else 'cards_failed')
+            if card_id is None:
+                return False
+            done = {'card_id': card_id}
+        if self.journal is not None:
+            for key in keys:
+                self.journal.record(key, 'done', **done)
+        return True
+
+    def card_progress(self, key: str, items: list):
+        """Returns (state, save) for post_card_with_checklist, keeping the card's progress
+        in the journal record of its first entry so that a failed card can be finished"""
+        if not items or self.journal is None:
+            return None, None
+        checklist = hashlib.blake2b('\n'.join(items).encode(), digest_size=16).hexdigest()
+        state = self.journal.records[key].get('card')
+        if state is None or state.get('checklist') != checklist:
+            state = {'checklist': checklist}
+        def save(**changes):
+            state.update(changes)
+            self.journal.update(key, card=state)
+        return state, save
+
+    def card_resolved(self, source: Path, flag: str):
+        """True if the card for the latest issue of source with flag has been resolved"""
+        return self.outbox is not None and self.outbox.issue_status(str(source), flag) in ('resolved', 'cleared')
+
+    def group_key(self, e: TableEntry, source: Path):
+        """Returns the (flag, folder) group of a flagged entry, with None for whatever isn't grouped on"""
+        return (e.flag if self.grouping in ('flag', 'both') else None,
+                source.parent if self.grouping in ('directory', 'both') else None)
+
+    def send_groups(self):
+        """Make one card for each group of flagged entries collected during the batch"""
+        groups, self.groups = self.groups, {}
+        for (flag, directory), members in groups.items():
+            keys = [key for key, item, issue_message, issue in members]
+            issues = [issue for key, item, issue_message, issue in members]
+            if len(members) == 1:
+                key, item, issue_message, issue = members[0]
+                self.make_card(keys, item, issue_message, issues=issues)
+                continue
+            card_name = f"{self.flags.get(flag, 'Issue') if flag is not None else 'Issues'}: {len(members)} items"
+            if directory is not None:
+                card_name += f' in {directory}{os.sep}'
+            items = [f'{item} - {issue_message}' if issue_message else item for key, item, issue_message, issue in members]
+            if self.use_checklists:
+                self.make_card(keys, card_name, f'{len(members)} flagged items, listed in the checklist', items, issues)
+            else:
+                self.make_card(keys, card_name, item_list(items, MAX_DESCRIPTION_LENGTH), issues=issues)
+            metrics.count('cards_grouped', len(members))
+
+    def is_permanent_error(self, error):
+        """Called by the outbox workers when a card fails; rejected IDs are probably stale,
+        so they are looked up again next time"""
+        permanent = trello.is_permanent_error(error)
+        if permanent and self.id_cache is not None and error.status_code in (400, 404):
+            self.id_cache.invalidate()
+        return permanent
+
+    def write_metrics(self):
+        """Export the batch's timings and counters, then start counting afresh for the next batch"""
+        metrics.registry.write_json(self.change_log_path.with_name(METRICS_FILE_NAME),
+                                    entries=self.counts,
+                                    move_methods={method: {'count': count, 'seconds': round(seconds, 6)}
+                                                  for method, (count, seconds) in self.move_stats.items()})
+        metrics.registry.write_prometheus(self.change_log_path.with_name(PROMETHEUS_FILE_NAME))
+        metrics.registry.reset()
+
+    def recover(self):
+        """Finish (or, with JOURNAL_RECOVERY = rollback, roll back) the entries
+        that were interrupted by a crash during an earlier run"""
+        if self.journal is None:
+            return
+        pending = self.journal.pending()
+        if not pending:
+            return
+        print(f'Recovering {len(pending)} interrupted entries from {self.journal_path}...\n')
+        rollback = self.settings.get('JOURNAL_RECOVERY', 'resume').strip().lower() == 'rollback'
+        
+        for record in pending:
+            e = TableEntry(*record['entry'])
+            cwd = Path(record['cwd'])
+            if record['kind'] == 'flag':
+                self.process_entry(e, cwd)      #the card may not have been created yet
+                continue
+
+            source, destination = Path(record['source']), Path(record['destination'])
+            outcome = journal.recover_move(source, destination, rollback=rollback)
+            print(f'{source}: {outcome.replace("_", " ")}')
+            if outcome in ('completed', 'finished'):
+                msg = move_and_log.move_message(source=source, destination=destination, sep=os.sep)
+                self.change_log.write(msg, source=source, destination=destination, flag='', recovered=True)
+                self.journal.record(record['key'], 'done', recovered=outcome)
+            elif outcome == 'not_started':
+                self.process_entry(e, cwd)
+            else:
+                self.journal.record(record['key'], outcome)
+        print()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open_log(self, log_file_path: Path):
+        """Open a LogWriter for log_file_path using the LOG_* settings"""
+        json_path = log_file_path.with_suffix('.jsonl') if is_truthy(self.settings.get('LOG_JSON', 'no')) else None
+        max_size = self.settings.get('LOG_MAX_SIZE', '').strip()
+        try:
+            max_bytes = rules.parse_size(max_size) if max_size else 0
+        except rules.RulesError as e:
+            raise ConfigError(f'LOG_MAX_SIZE: {e}')
+        return move_and_log.LogWriter(log_file_path,
+                                      flush_every=move_and_log.parse_flush_policy(self.settings.get('LOG_FLUSH', 'entry')),
+                                      fsync=is_truthy(self.settings.get('LOG_FSYNC', 'no')),
+                                      json_path=json_path,
+                                      history=self.history,
+                                      max_bytes=max_bytes,
+                                      backups=int(self.settings.get('LOG_BACKUPS', '') or 5))
+
+    def process_entry(self, e: TableEntry, cwd: Path, plan_item=None):
+        """Move or flag a single table entry and log the result. Returns a tuple
+        (processed, unreported_bytes), where processed is False if the move was
+        skipped and unreported_bytes is the number of bytes moved that were not
+        already passed to the progress callback.
+        plan_item, if given, is the entry's planner.PlanItem, whose checks are
+        reused instead of checking the paths again"""
+        #paths for movement
+        with metrics.span('resolve'):
+            source = cwd / e.name
+            if plan_item is not None and plan_item.destination is not None:
+                destination = plan_item.destination
+            else:
+                destination = destination_for(e, source, self.reorg_directory)
+            is_dir = plan_item.is_dir if plan_item is not None else source.is_dir()
+
+        # Print status to console
+        print(f"Attempting to move {source.name}...")
+
+        # If there is no  flag, attempt the move and skip it if there's a MoveError
+        if e.flag == '':
+            key = journal.move_key(source, destination)
+            if self.journal is not None and self.journal.is_done(key):
+                if plan_item is not None:
+                    source_exists = plan_item.problem != 'missing_source'
+                else:
+                    source_exists = os.path.lexists(source)
+                if not source_exists:
+                    print(f'{source.name} was already moved. Skipping...\n')
+                    self.counts['replayed'] += 1
+                    return True, 0
+
+            # The plan already knows whether the move can go ahead
+            if plan_item is not None and plan_item.action == 'skip':
+                print(f"Warning: {source.name} {planner.PROBLEMS[plan_item.problem]}")
+                print('Move has been skipped. Continuing...\n')
+                self.counts['skipped'] += 1
+                return False, 0
+            
+            if self.journal is not None:
+                self.journal.record(key, 'begin', kind='move', entry=list(e), cwd=str(cwd),
+                                    source=str(source), destination=str(destination))
+
+            # Create the planned destination folder once, and remember which device it is on
+            on_same_device = None
+            if plan_item is not None:
+                on_same_device = plan_item.same_device
+                if on_same_device is None:
+                    if destination.parent not in self.created_dirs:
+                        print(f"Creating destination: {destination.parent}{os.sep}")
+                        destination.parent.mkdir(parents=True, exist_ok=True)
+                        try:
+                            self.created_dirs[destination.parent] = move_and_log.same_device(source, destination.parent)
+                        except FileNotFoundError:
+                            self.created_dirs[destination.parent] = None    #the source vanished after planning; move() reports it
+                    on_same_device = self.created_dirs[destination.parent]
+
+            copied = [0]        #bytes reported by the copy engine for this entry
+            def progress(path, nbytes, done, total):
+                copied[0] += nbytes
+                if self.progress is not None:
+                    self.progress(path, nbytes, done, total)
+
+            try:
+                result = move_and_log.move(source=source,
+                                           destination=destination,
+                                           shorten_index=-1,
+                                           sep=os.sep,
+                                           progress=progress,
+                                           checked=plan_item is not None,
+                                           on_same_device=on_same_device,
+                                           is_dir=is_dir)
+            except move_and_log.MoveError:
+                print('Move has been skipped. Continuing...\n')
+                self.counts['skipped'] += 1
+                if self.journal is not None:
+                    self.journal.record(key, 'skipped')
+                return False, 0
+
+            # Keep track of how many moves took the rename fast path
+            count, seconds = self.move_stats.get(result.method, (0, 0.0))
+            self.move_stats[result.method] = (count + 1, seconds + result.duration)
+
+            # Bytes copied across devices were already reported chunk by chunk. A renamed
+            # folder isn't walked just to count its bytes, so its size is left unknown
+            if result.method == 'rename':
+                nbytes = None if is_dir else move_and_log.item_size(destination, is_dir=False)
+                unreported_bytes = nbytes or 0
+                metrics.count('files_touched')     #a rename touches one item, however large (copies count each file)
+            else:
+                nbytes = copied[0]
+                unreported_bytes = 0
+            self.counts['moved'] += 1
+            self.bytes_moved += nbytes or 0
+            metrics.count('bytes_moved', nbytes or 0)
+
+            msg = move_and_log.move_message(source=source,
+                                            destination=destination,
+                                            sep=os.sep,
+                                            is_dir=is_dir)
+            self.change_log.write(msg, source=source, destination=destination, flag='',
+                                  bytes=nbytes, duration=round(result.duration, 6), method=result.method)
+            if self.journal is not None:
+                self.journal.record(key, 'done')
+            if self.on_moved is not None:
+                self.on_moved(source, destination)
+            return True, unreported_bytes
+
+        # Skip flags that were already reported, so that re-running a batch doesn't duplicate cards.
+        # An entry flagged again after its card was resolved (see card_sync.py) gets a new card
+        key = journal.flag_key(source, e.flag)
+        if self.journal is not None:
+            if self.journal.is_done(key) and not self.card_resolved(source, e.flag):
+                print(f'{source.name} was already flagged. Skipping...\n')
+                self.counts['replayed'] += 1
+                return True, 0
+            if self.journal.last_op(key) != 'begin':      #an interrupted entry keeps its record (and its card's progress)
+                self.journal.record(key, 'begin', kind='flag', entry=list(e), cwd=str(cwd), source=str(source))
+
+        # Flag error and log
+        if is_dir:
+            print(f"Issue found at {source}{os.sep}")
+        else:
+            print(f"Issue found at {source}")
+
+        msg = move_and_log.error_message(table_entry=e,
+                                         issues=self.flags,
+                                         source=source,
+                                         short_paths=False,
+                                         sep=os.sep,
+                                         is_dir=is_dir)
+        self.error_log.write(msg+'\n', source=source, destination=None, flag=e.flag,
+                             bytes=0, duration=None, issue_message=e.issue_message)
+
+        # Make an issue card
+        card_name = move_and_log.error_message(table_entry=e,
+                                               issues=self.flags,
+                                               source=source,
+                                               short_paths=False,
+                                               sep=os.sep,
+                                               is_dir=is_dir,
+                                               reorgpath=self.reorg_directory,
+                                               shorten_index=-1)
+        if self.grouping != 'none':
+            # The entry stays 'begin' in the journal until its group's card is made
+            self.groups.setdefault(self.group_key(e, source), []).append((key, card_name, e.issue_message, (source, e)))
+            print(f'{source.name} added to its group card\n')
+        elif not self.make_card([key], card_name, e.issue_message, issues=[(source, e)]):
+            return False, 0     #the entry stays pending, so its card is tried again by the next run
+        self.counts['flagged'] += 1
+        return True, 0
+
+    def print_move_summary(self):
+        """Summarize how the moves were carried out"""
+        for method, (count, seconds) in sorted(self.move_stats.items()):
+            print(f'{count} item(s) moved by {method} in {seconds:.2f}s')
+
+class ConfigError(Exception):
+    pass
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Rules for filling in the flag and category columns automatically.
+
+A rules file is an INI file with one section per rule. Rules are tried in the
+order they appear, and the first one that matches an item sets its columns:
+
+    [old installers]
+    name = *setup*              ; glob on the item name (or regex = ...)
+    extension = .exe, .msi      ; any of these extensions
+    type = file                 ; file or dir
+    min_size = 10MB             ; files only; B, KB, MB, GB, TB (powers of 1024)
+    older_than = 365d           ; by modification time; s, m, h, d, w, y
+    ignore_case = yes
+    cat1 = Software
+    cat2 = Installers
+
+The conditions of a rule must all hold; the columns it can set are flag, cat1,
+cat2, cat3 and issue_message. Every name condition is compiled into a single
+combined regular expression when the rules are loaded, so classifying a row
+costs one match (plus a stat call only if the first rule whose name matches
+also has a size or age condition).
+
+Usage (writes a manifest for batch.py to standard output):
+    python rules.py rules.ini [DIR] [--all]
+"""
+from pathlib import Path
+from collections import namedtuple
+import argparse
+import configparser
+import csv
+import fnmatch
+import os
+import re
+import stat
+import sys
+import time
+
+# Columns that a rule can set, in table order
+RULE_FIELDS = ('flag', 'cat1', 'cat2', 'cat3', 'issue_message')
+CONDITION_KEYS = ('name', 'regex', 'extension', 'type', 'ignore_case',
+                  'min_size', 'max_size', 'older_than', 'newer_than')
+
+SIZE_UNITS = {'b': 1, 'kb': 1024, 'mb': 1024**2, 'gb': 1024**3, 'tb': 1024**4}
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400, 'y': 365 * 86400}
+
+# kind is None, 'file' or 'dir'; sizes are in bytes and ages in seconds (None if unset)
+Rule = namedtuple('Rule', 'name pattern kind min_size max_size min_age max_age values')
+
+def parse_size(text: str):
+    match = re.fullmatch(r'\s*([\d.]+)\s*([kmgt]?b?)\s*', text.lower())
+    if match is None:
+        raise RulesError(f'Invalid size: {text}')
+    unit = match.group(2) or 'b'
+    if not unit.endswith('b'):
+        unit += 'b'
+    return int(float(match.group(1)) * SIZE_UNITS[unit])
+
+def parse_age(text: str):
+    match = re.fullmatch(r'\s*([\d.]+)\s*([smhdwy]?)\s*', text.lower())
+    if match is None:
+        raise RulesError(f'Invalid age: {text}')
+    return float(match.group(1)) * AGE_UNITS[match.group(2) or 'd']
+
+def name_pattern(section: str, options: dict):
+    """Returns the regular expression for a rule's name conditions"""
+    parts = []
+    if options.get('name'):
+        parts.append(fnmatch.translate(options['name'])[:-2])   #strip the trailing \Z
+    if options.get('regex'):
+        regex = options['regex']
+        flags = re.match(r'\(\?([aiLmsux]+)\)', regex)
+        if flags is not None:       #global flags must come first, so they only apply to this regex
+            regex = f'(?{flags.group(1)}:{regex[flags.end():]})'
+        parts.append(regex)
+    pattern = ''.join(f'(?:(?={part}\\Z))' for part in parts) + '.*'     #every condition must match the whole name
+    if options.get('extension'):
+        extensions = [ext.strip().lstrip('.') for ext in options['extension'].split(',') if ext.strip()]
+        pattern = pattern[:-2] + '.*\\.(?:' + '|'.join(re.escape(ext) for ext in extensions) + ')'
+    if options.get('ignore_case', '').strip().lower() in ('yes', 'true', '1'):
+        pattern = f'(?i:{pattern})'
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        raise RulesError(f'Invalid regex in rule [{section}]: {e}')
+    return pattern
+
+def parse_rule(section: str, options: dict):
+    unknown = set(options) - set(CONDITION_KEYS) - set(RULE_FIELDS)
+    if unknown:
+        raise RulesError(f"Unknown key(s) in rule [{section}]: {', '.join(sorted(unknown))}")
+    values = {field: options[field] for field in RULE_FIELDS if options.get(field, '') != ''}
+    if not values:
+        raise RulesError(f'Rule [{section}] does not set a flag or category')
+    kind = options.get('type', '').strip().lower() or None
+    if kind not in (None, 'file', 'dir'):
+        raise RulesError(f'type must be file or dir in rule [{section}]')
+    optional = lambda key, parse: parse(options[key]) if options.get(key, '').strip() else None
+    return Rule(section, name_pattern(section, options), kind,
+                optional('min_size', parse_size), optional('max_size', parse_size),
+                optional('older_than', parse_age), optional('newer_than', parse_age), values)
+
+class RuleSet:
+    """Ordered rules, with the name conditions compiled into one regular expression"""
+    def __init__(self, rules: list):
+        self.rules = rules
+        self.patterns = [re.compile(rule.pattern + '\\Z', re.DOTALL) for rule in rules]      #for the rules the combined match doesn't pick
+        # One named group per rule: the first alternative that matches is the first rule
+        # (in file order) whose name conditions hold, so one match finds it. Rules with
+        # groups of their own (e.g. for backreferences) would change meaning in there,
+        # so they are only matched on their own
+        combined = [i for i, pattern in enumerate(self.patterns) if pattern.groups == 0]
+        self.combined = re.compile('|'.join(f'(?P<r{i}>{rules[i].pattern})\\Z' for i in combined), re.DOTALL) if combined else None
+        self.group_index = {f'r{i}': i for i in combined}
+        self.first_separate = min((i for i, pattern in enumerate(self.patterns) if pattern.groups > 0), default=len(rules))
+        self.needs_type = any(rule.kind is not None for rule in rules)     #whether callers must know if items are directories
+
+    def match(self, name: str, is_dir: bool, path: Path = None, now: float = None):
+        """Returns the first rule that matches an item, or None. path is only
+        stat'ed if a rule with a size or age condition is reached"""
+        found = self.combined.match(name) if self.combined is not None else None
+        matched = self.group_index[found.lastgroup] if found is not None else len(self.rules)
+        item_stat = None
+        for i in range(min(matched, self.first_separate), len(self.rules)):
+            rule = self.rules[i]
+            if i != matched and not self.patterns[i].match(name):
+                continue
+            if rule.kind is not None and (rule.kind == 'dir') != is_dir:
+                continue
+            if rule.min_size is None and rule.max_size is None and rule.min_age is None and rule.max_age is None:
+                return rule
+            if item_stat is None:
+                if path is None:
+                    continue
+                try:
+                    item_stat = path.stat()
+                except OSError:
+                    continue
+            if not matches_stat(rule, item_stat, now if now is not None else time.time()):
+                continue
+            return rule
+        return None
+
+    def classify(self, items, now: float = None):
+        """Yields (index, rule) for each (name, is_dir, path) item that a rule matches"""
+        now = now if now is not None else time.time()
+        for index, (name, is_dir, path) in enumerate(items):
+            rule = self.match(name, is_dir, path, now)
+            if rule is not None:
+                yield index, rule
+
+def matches_stat(rule: Rule, item_stat, now: float):
+    if rule.min_size is not None or rule.max_size is not None:
+        if stat.S_ISDIR(item_stat.st_mode):
+            return False        #directory sizes aren't the size of their contents
+        if rule.min_size is not None and item_stat.st_size < rule.min_size:
+            return False
+        if rule.max_size is not None and item_stat.st_size > rule.max_size:
+            return False
+    age = now - item_stat.st_mtime
+    if rule.min_age is not None and age < rule.min_age:
+        return False
+    if rule.max_age is not None and age > rule.max_age:
+        return False
+    return True
+
+def load_rules(rules_file_path: Path):
+    """Reads and compiles a rules file. Raises RulesError if it is invalid"""
+    config = configparser.ConfigParser(inline_comment_prefixes=(';',), interpolation=None)
+    config.optionxform = lambda option: option.lower()
+    try:
+        with open(rules_file_path, encoding='utf-8') as rules_file:
+            config.read_file(rules_file)
+    except (OSError, configparser.Error) as e:
+        raise RulesError(f'Could not read {rules_file_path}: {e}')
+    ruleset = [parse_rule(section, dict(config[section])) for section in config.sections()]
+    try:
+        return RuleSet(ruleset)
+    except re.error as e:
+        raise RulesError(f'Could not compile the rules in {rules_file_path}: {e}')
+
+def apply_rule(cells: list, rule: Rule):
+    """Returns the cells (flag, cat1, cat2, cat3, issue_message) with the rule's values
+    filled in, or None if the row was already filled in by hand"""
+    if cells[0] != '' or cells[1] != '':
+        return None
+    return [rule.values.get(field, cell) for field, cell in zip(RULE_FIELDS, cells)]
+
+def preview(matches):
+    """Returns a human-readable summary of (name, rule) matches"""
+    counts = {}
+    for name, rule in matches:
+        counts.setdefault(rule.name, []).append(name)
+    lines = [f'{sum(len(names) for names in counts.values())} item(s) matched']
+    for rule_name, names in counts.items():
+        examples = ', '.join(names[:5]) + (', ...' if len(names) > 5 else '')
+        lines.append(f'[{rule_name}] {len(names)} item(s): {examples}')
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Classify the items in a directory with a rules file, writing a manifest for batch.py')
+    parser.add_argument('rules', type=Path, help='rules file')
+    parser.add_argument('directory', type=Path, nargs='?', default=Path.cwd(), help='directory to classify (default: current directory)')
+    parser.add_argument('--all', action='store_true', help='also write rows for items that no rule matched')
+    args = parser.parse_args(argv)
+
+    ruleset = load_rules(args.rules)
+    with os.scandir(args.directory) as entries:
+        items = [(entry.name, entry.is_dir(), Path(entry.path)) for entry in entries]
+    matched = dict(ruleset.classify(items))
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(('name',) + RULE_FIELDS)
+    for index, (name, is_dir, path) in enumerate(items):
+        rule = matched.get(index)
+        if rule is not None:
+            writer.writerow([name] + [rule.values.get(field, '') for field in RULE_FIELDS])
+        elif args.all:
+            writer.writerow([name] + [''] * len(RULE_FIELDS))
+    print(preview((items[index][0], rule) for index, rule in matched.items()), file=sys.stderr)
+
+class RulesError(Exception):
+    pass
+
+if __name__ == "__main__":
+    main()
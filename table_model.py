@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory model of the rows in the main table. The model is the source of
+truth for every cell; the ttk.Treeview in main.py only displays it, so reading
+or extracting rows never has to go through Tcl.
+
+Directories are nodes whose children are only listed when the node is first
+expanded, so memory use grows with the folders that were opened rather than
+with the size of the whole tree. Once listed, the children stay in the model
+(also when the node is collapsed), so that their cells are kept and reopening
+a folder doesn't list it again.
+
+Rows can be sorted and filtered without being recreated: sorting reorders the
+rows of each directory by precomputed keys, and filtering marks the rows that
+don't match (and aren't above a row that does) as hidden.
+"""
+from pathlib import Path
+import fnmatch
+import functools
+import itertools
+import re
+
+class Row:
+    """A single table row. cells holds the text of every column, starting with the name.
+    For directories, children is None until the directory has been listed"""
+    __slots__ = ('iid', 'cells', 'is_dir', 'parent', 'depth', 'children', 'expanded', 'hidden')
+
+    def __init__(self, iid: str, cells: list, is_dir: bool, parent=None):
+        self.iid = iid
+        self.cells = cells
+        self.is_dir = is_dir
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.children = None
+        self.expanded = False
+        self.hidden = False     #filtered out
+
+class Children:
+    """The rows in one directory, with directories kept before files"""
+    __slots__ = ('dir_rows', 'file_rows')
+
+    def __init__(self):
+        self.dir_rows = {}      #maps iid to Row, in insertion order
+        self.file_rows = {}
+
+    def __len__(self):
+        return len(self.dir_rows) + len(self.file_rows)
+
+    def __iter__(self):
+        yield from self.dir_rows.values()
+        yield from self.file_rows.values()
+
+    def sort(self, keys: dict, reverse: bool = False):
+        """Reorder the rows by keys[iid], keeping directories before files, and the
+        rows whose key is None after the others in either direction"""
+        self.dir_rows = sorted_rows(self.dir_rows, keys, reverse)
+        self.file_rows = sorted_rows(self.file_rows, keys, reverse)
+
+def sorted_rows(rows: dict, keys: dict, reverse: bool):
+    present = [iid for iid in rows if keys[iid] is not None]
+    missing = [iid for iid in rows if keys[iid] is None]
+    return {iid: rows[iid] for iid in itertools.chain(sorted(present, key=keys.__getitem__, reverse=reverse), missing)}
+
+class TableModel:
+    """Tree of rows, whose top level is the current directory"""
+    def __init__(self, n_columns: int):
+        self.n_columns = n_columns
+        self.top = Children()
+        self.rows = {}          #maps iid to Row, for every row at any depth
+        self.n_visible = 0      #number of rows that are displayed (see visible_rows)
+        self.next_iid = 0
+        self.filter = None      #if set, only rows for which filter(row) is true (and the directories above them) are displayed
+        self.sort_keys = {}     #maps a sort column to a dictionary mapping iid to the row's precomputed key
+        self.folded_cells = {}  #maps iid to the row's casefolded cells, for filtering (see folded)
+        self.stats = {}         #maps iid to the item's (st_size, st_mtime), or None if it couldn't be read; only filled in for sorting by size or date
+
+    @property
+    def dir_rows(self):
+        return self.top.dir_rows
+
+    @property
+    def file_rows(self):
+        return self.top.file_rows
+
+    def new_iid(self):
+        self.next_iid += 1
+        return f'r{self.next_iid}'
+
+    def children_of(self, parent):
+        """Returns the Children of parent (a Row, or None for the top level), creating them if necessary"""
+        if parent is None:
+            return self.top
+        if parent.children is None:
+            parent.children = Children()
+        return parent.children
+
+    def add(self, names, is_dir: bool, parent=None):
+        """Add a row with empty cells for each name (inside the directory row parent,
+        if given) and return the new rows"""
+        children = self.children_of(parent)
+        rows = children.dir_rows if is_dir else children.file_rows
+        empty = [''] * (self.n_columns - 1)
+        separators = '\n' * len(empty)
+        folded_cells = self.folded_cells
+        new_rows = []
+        for name in names:
+            row = Row(self.new_iid(), [name, *empty], is_dir, parent)
+            folded = name.casefold()
+            folded_cells[row.iid] = ((folded, *empty), folded + separators)     #so that filtering doesn't have to
+            row.hidden = self.filter is not None and not self.filter(self.folded(row))
+            rows[row.iid] = row
+            self.rows[row.iid] = row
+            new_rows.append(row)
+        if parent is None or (parent.expanded and self.is_visible(parent)):
+            self.n_visible += sum(not row.hidden for row in new_rows)
+        return new_rows
+
+    def get(self, iid: str):
+        return self.rows.get(iid)
+
+    def remove(self, iid: str):
+        """Remove the row with the given iid, and everything inside it, and return
+        it (or None if there is no such row)"""
+        row = self.rows.get(iid)
+        if row is None:
+            return None
+        if self.is_visible(row):
+            self.n_visible -= 1 + self.count_open(row)
+        siblings = self.children_of(row.parent)
+        siblings.dir_rows.pop(iid, None)
+        siblings.file_rows.pop(iid, None)
+        for removed in itertools.chain(self.descendants(row), [row]):
+            del self.rows[removed.iid]
+            self.folded_cells.pop(removed.iid, None)
+            self.stats.pop(removed.iid, None)
+            for keys in self.sort_keys.values():
+                keys.pop(removed.iid, None)
+        return row
+
+    def set_cell(self, iid: str, col_index: int, text: str):
+        self.get(iid).cells[col_index] = text
+        self.folded_cells.pop(iid, None)
+        if col_index in self.sort_keys:
+            self.sort_keys[col_index].pop(iid, None)     #computed again the next time the column is sorted
+
+    def set_stats(self, stats: dict):
+        """Record the (st_size, st_mtime) of rows by iid, skipping rows removed since"""
+        for iid, stat in stats.items():
+            if iid in self.rows:
+                self.stats[iid] = stat
+                for keys in self.sort_keys.values():
+                    keys.pop(iid, None)     #computed again with the stats
+
+    def sort(self, column, key, reverse: bool = False):
+        """Sort the rows of every listed directory by key(row), which is only called
+        for rows whose key for column hasn't been computed yet. Rows whose key is
+        None (e.g. empty cells) are put last, also when reverse is true"""
+        keys = self.sort_keys.setdefault(column, {})
+        for row in self.rows.values():
+            if row.iid not in keys:
+                keys[row.iid] = key(row)
+        self.top.sort(keys, reverse)
+        for row in self.rows.values():
+            if row.children is not None:
+                row.children.sort(keys, reverse)
+
+    def folded(self, row):
+        """Returns (cells, text) for a row, where cells are its casefolded cells and text
+        is all of them on separate lines. Computed once, until a cell changes"""
+        folded = self.folded_cells.get(row.iid)
+        if folded is None:
+            cells = tuple(cell.casefold() for cell in row.cells)
+            folded = self.folded_cells[row.iid] = (cells, '\n'.join(cells))
+        return folded
+
+    def set_filter(self, predicate):
+        """Hide the rows for which predicate(folded cells) is false, except directories
+        with a listed row inside them that matches. A predicate of None shows every row"""
+        self.filter = predicate
+        if predicate is None:
+            for row in self.rows.values():
+                row.hidden = False
+        else:
+            folded = self.folded
+            for row in self.rows.values():
+                row.hidden = not predicate(folded(row))
+            for row in self.rows.values():
+                parent = row.parent
+                while not row.hidden and parent is not None and parent.hidden:
+                    parent.hidden = False
+                    row, parent = parent, parent.parent
+        self.n_visible = sum(1 for row in self.visible_rows())
+
+    def set_expanded(self, row, expanded: bool):
+        """Expand or collapse a directory row"""
+        if row.expanded == expanded:
+            return
+        visible = self.is_visible(row)
+        if visible and not expanded:
+            self.n_visible -= self.count_open(row)
+        row.expanded = expanded
+        if visible and expanded:
+            self.n_visible += self.count_open(row)
+
+    def is_visible(self, row):
+        """True if row isn't hidden, and every directory above row is expanded"""
+        if row.hidden:
+            return False
+        parent = row.parent
+        while parent is not None:
+            if not parent.expanded or parent.hidden:
+                return False
+            parent = parent.parent
+        return True
+
+    def count_open(self, row):
+        """Number of rows displayed inside row if it is visible"""
+        if not row.expanded or row.children is None:
+            return 0
+        return sum(1 + self.count_open(child) for child in row.children if not child.hidden)
+
+    def relative_path(self, row):
+        """Path of the row's item relative to the current directory"""
+        parts = []
+        while row is not None:
+            parts.append(row.cells[0])
+            row = row.parent
+        return Path(*reversed(parts))
+
+    def descendants(self, row):
+        """Every listed row inside row, children before their parents"""
+        if row.children is None:
+            return
+        for child in row.children:
+            yield from self.descendants(child)
+            yield child
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        """Every listed row, with the contents of each directory before the directory
+        itself (the order in which they can be moved without disturbing each other)"""
+        for row in self.top:
+            yield from self.descendants(row)
+            yield row
+
+    def visible_rows(self):
+        """The rows that are displayed, in display order: the top level and the
+        contents of every expanded directory, except hidden rows"""
+        stack = [iter(self.top)]
+        while stack:
+            row = next(stack[-1], None)
+            if row is None:
+                stack.pop()
+                continue
+            if row.hidden:
+                continue
+            yield row
+            if row.expanded and row.children is not None:
+                stack.append(iter(row.children))
+
+    def visible_count(self):
+        return self.n_visible
+
+    def rows_from(self, start: int):
+        """Iterate over the displayed rows, starting at index start"""
+        return itertools.islice(self.visible_rows(), start, None)
+
+def make_filter(text: str, fields):
+    """Returns a predicate for TableModel.set_filter that matches the rows containing
+    every term of text (ignoring case), or None if text has no terms. fields are the
+    names of the columns, in order. A term can be:
+    - plain text, found in any cell
+    - field:text, found in that column (any unambiguous start of a field name will do).
+      With nothing after the colon, the column must be empty
+    - either of the above with the wildcards * ? [], matching the whole cell (of the
+      first column, if no field is given), e.g. *.tif
+    The predicate is called with a row's folded cells (see TableModel.folded)"""
+    tests = []
+    for term in text.casefold().split():
+        field, sep, value = term.partition(':')
+        columns = [i for i, name in enumerate(fields) if sep and name.startswith(field)]
+        if len(columns) != 1:
+            tests.append(cell_test(term, None))
+        else:
+            tests.append(cell_test(value, columns[0]))
+    if not tests:
+        return None
+    return functools.reduce(lambda first, second: lambda folded: first(folded) and second(folded), tests)
+
+def cell_test(value: str, column):
+    """Predicate for a single filter term, on the given column (or any, if None; the
+    first one for wildcards)"""
+    if any(char in value for char in '*?['):
+        match = re.compile(fnmatch.translate(value)).match
+        column = column or 0
+        return lambda folded: match(folded[0][column]) is not None
+    if column is None:
+        return lambda folded: value in folded[1]
+    if value == '':
+        return lambda folded: folded[0][column] == ''
+    return lambda folded: value in folded[0][column]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures. The modules live at the top of the repository rather than in
+a package, so the repository is put on the import path here
+"""
+from pathlib import Path
+import sys
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import processing
+import trello
+from benchmarks.fake_trello import FakeTrelloServer
+
+@pytest.fixture
+def fake_trello(monkeypatch):
+    """A FakeTrelloServer that trello.py sends its requests to"""
+    with FakeTrelloServer(retry_after=0) as server:
+        monkeypatch.setattr(trello, 'BASE_URL', server.url)
+        yield server
+
+@pytest.fixture
+def settings(tmp_path):
+    """Settings for a Processor that moves items into tmp_path/reorg and sends cards
+    straight to the board (no outbox), without history or metrics"""
+    return {'REORG_DIRECTORY': str(tmp_path / 'reorg'),
+            'LIST_ID': 'list1',
+            'MEMBER_IDS': '',
+            'API_KEY': 'key',
+            'OATH_TOKEN': 'token',
+            'CARD_OUTBOX': 'no',
+            'HISTORY': 'no',
+            'METRICS': 'no'}
+
+@pytest.fixture
+def make_processor(tmp_path, settings):
+    """Returns a function that makes a Processor logging to tmp_path/logs, with a journal"""
+    logs = tmp_path / 'logs'
+    logs.mkdir()
+    def make(**changes):
+        return processing.Processor({**settings, **changes}, {'d': 'Duplicate'}, logs / 'change.log', logs / 'error.log',
+                                    journal_path=logs / 'journal.jsonl')
+    return make
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import json
+import pytest
+import batch
+import processing
+
+def test_read_csv_manifest(tmp_path):
+    manifest = tmp_path / 'manifest.csv'
+    manifest.write_text('name,flag,cat1\na.txt,, Docs \nb.txt,d,\n', encoding='utf-8')
+    entries = list(batch.read_manifest(manifest))
+    assert entries == [processing.TableEntry('a.txt', '', 'Docs', '', '', ''),
+                       processing.TableEntry('b.txt', 'd', '', '', '', '')]
+
+def test_read_jsonl_manifest(tmp_path):
+    manifest = tmp_path / 'manifest.jsonl'
+    manifest.write_text(json.dumps({'name': 'a.txt', 'cat1': 'Docs', 'cat2': 'Old'}) + '\n\n', encoding='utf-8')
+    assert list(batch.read_manifest(manifest)) == [processing.TableEntry('a.txt', '', 'Docs', 'Old', '', '')]
+
+def test_invalid_manifest_rows(tmp_path):
+    manifest = tmp_path / 'manifest.jsonl'
+    manifest.write_text('{"name": "a.txt"}\nnot json\n', encoding='utf-8')
+    with pytest.raises(batch.ManifestError):
+        list(batch.read_manifest(manifest))
+    with pytest.raises(batch.ManifestError):
+        batch.entry_from_record({'flag': 'd'})
+
+def test_run_batch(tmp_path, make_processor):
+    source_dir = tmp_path / 'source'
+    source_dir.mkdir()
+    (source_dir / 'a.txt').write_text('a')
+    (source_dir / 'b.txt').write_text('b')
+    entries = [processing.TableEntry('a.txt', '', 'Docs', '', '', ''),
+               processing.TableEntry('b.txt', '', '', '', '', '')]
+    summary = batch.run_batch(entries, make_processor(), source_dir)
+    assert (summary['rows'], summary['ignored'], summary['moved']) == (2, 1, 1)
+    assert (tmp_path / 'reorg' / 'Docs' / 'a.txt').read_text() == 'a'
+    assert (source_dir / 'b.txt').exists()
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import categories
+
+def test_build_and_complete(tmp_path):
+    for folder in ('Photos/2020', 'Photos/2021/Trips/deep', 'photocopies', 'Projects', 'Software'):
+        (tmp_path / folder).mkdir(parents=True)
+    (tmp_path / 'Photos' / 'notes.txt').write_text('not a folder')
+    index = categories.CategoryIndex(tmp_path).start()
+    assert index.ready.wait(5)
+    assert index.complete((), 'p') == ['photocopies', 'Photos', 'Projects']
+    assert index.complete((), 'PHO', limit=1) == ['photocopies']
+    assert index.complete(('Photos',), '') == ['2020', '2021']
+    assert index.complete(('Photos', '2021'), 't') == ['Trips']
+    assert index.complete(('Photos', '2021', 'Trips'), '') == []     #deeper than cat3
+    assert index.complete(('Missing',), '') == []
+
+def test_add(tmp_path):
+    index = categories.CategoryIndex(tmp_path)
+    index.add(tmp_path / 'Docs' / 'Letters' / 'Old' / 'More')
+    index.add(tmp_path / 'Docs')
+    index.add(tmp_path.parent / 'Elsewhere')
+    assert index.complete((), '') == ['Docs']
+    assert index.complete(('Docs', 'Letters'), '') == ['Old']
+    assert index.complete(('Docs', 'Letters', 'Old'), '') == []
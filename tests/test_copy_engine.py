@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+import copy_engine
+
+class Interrupted(Exception):
+    pass
+
+def interrupt_after(n_chunks):
+    calls = []
+    def progress(path, nbytes, copied, total):
+        calls.append(copied)
+        if len(calls) == n_chunks:
+            raise Interrupted
+    return progress
+
+def test_copy_file_resumes_from_checkpoint(tmp_path):
+    source = tmp_path / 'source.bin'
+    source.write_bytes(os.urandom(10_000))
+    destination = tmp_path / 'destination.bin'
+    with pytest.raises(Interrupted):
+        copy_engine.copy_file(source, destination, interrupt_after(2), chunk_size=3000)
+    assert not destination.exists()
+    assert copy_engine.read_checkpoint(destination, source.stat()) == 6000
+
+    # Bytes written after the last checkpoint are discarded
+    with copy_engine.staging_path(destination).open('ab') as part:
+        part.write(b'garbage')
+    reports = []
+    copy_engine.copy_file(source, destination, lambda path, nbytes, copied, total: reports.append((nbytes, copied)),
+                          chunk_size=3000)
+    assert reports == [(6000, 6000), (3000, 9000), (1000, 10_000)]
+    assert destination.read_bytes() == source.read_bytes()
+    assert not copy_engine.staging_path(destination).exists()
+    assert not copy_engine.checkpoint_path(destination).exists()
+
+def test_checkpoint_of_changed_source_is_ignored(tmp_path):
+    source = tmp_path / 'source.bin'
+    source.write_bytes(b'a' * 100)
+    destination = tmp_path / 'destination.bin'
+    with pytest.raises(Interrupted):
+        copy_engine.copy_file(source, destination, interrupt_after(1), chunk_size=50)
+    source.write_bytes(b'b' * 120)
+    assert copy_engine.read_checkpoint(destination, source.stat()) == 0
+    copy_engine.copy_file(source, destination, chunk_size=50)
+    assert destination.read_bytes() == b'b' * 120
+
+def test_move_tree_resumes_and_verifies(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'sub').mkdir(parents=True)
+    (source / 'a.bin').write_bytes(b'a' * 100)
+    (source / 'sub' / 'b.bin').write_bytes(b'b' * 100)
+    destination = tmp_path / 'destination'
+    with pytest.raises(Interrupted):
+        copy_engine.move(source, destination, interrupt_after(3), chunk_size=40)
+    assert source.exists() and not destination.exists()
+    copy_engine.move(source, destination, chunk_size=40)
+    assert not source.exists()
+    assert (destination / 'sub' / 'b.bin').read_bytes() == b'b' * 100
+
+def test_verify_tree(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'sub').mkdir(parents=True)
+    (source / 'sub' / 'b.bin').write_bytes(b'b')
+    destination = tmp_path / 'destination'
+    copy_engine.copy_tree(source, destination)
+    (destination / 'extra.bin').write_bytes(b'x')
+    assert copy_engine.verify_tree(source, destination)
+    (source / 'c.bin').write_bytes(b'c')
+    assert not copy_engine.verify_tree(source, destination)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os
+import duplicates
+
+def write(path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+def test_find_duplicates(tmp_path):
+    big = os.urandom(3 * duplicates.HASH_CHUNK_SIZE)
+    same_ends = big[:duplicates.HASH_CHUNK_SIZE] + os.urandom(duplicates.HASH_CHUNK_SIZE) + big[-duplicates.HASH_CHUNK_SIZE:]
+    a = write(tmp_path / 'a.txt', b'hello')
+    b = write(tmp_path / 'sub' / 'b.txt', b'hello')
+    write(tmp_path / 'c.txt', b'world')      #same size, different contents
+    write(tmp_path / 'empty1', b'')
+    write(tmp_path / 'empty2', b'')
+    big1 = write(tmp_path / 'big1.bin', big)
+    big2 = write(tmp_path / 'sub' / 'big2.bin', big)
+    write(tmp_path / 'big3.bin', same_ends)  #only the full hash tells it apart
+    os.symlink(a, tmp_path / 'link.txt')
+    cache = tmp_path / 'hash_cache.db'
+
+    expected = [[a, b], [big1, big2]]
+    assert duplicates.find_duplicates([tmp_path], cache, workers=1) == expected
+    assert duplicates.find_duplicates([tmp_path], cache, workers=1) == expected    #from the cache
+
+def test_changed_file_is_hashed_again(tmp_path):
+    a = write(tmp_path / 'a.txt', b'hello')
+    b = write(tmp_path / 'b.txt', b'hello')
+    cache = tmp_path / 'hash_cache.db'
+    assert duplicates.find_duplicates([tmp_path], cache, workers=1) == [[a, b]]
+    b.write_bytes(b'jello')
+    assert duplicates.find_duplicates([tmp_path], cache, workers=1) == []
+
+def test_hard_links_are_not_duplicates(tmp_path):
+    a = write(tmp_path / 'a.txt', b'hello')
+    os.link(a, tmp_path / 'b.txt')
+    assert duplicates.find_duplicates([tmp_path], workers=1) == []
+    write(tmp_path / 'c.txt', b'hello')
+    assert len(duplicates.find_duplicates([tmp_path], workers=1)[0]) == 2      #c.txt and one of the links
+
+def test_hashes_in_worker_processes(tmp_path):
+    paths = [write(tmp_path / f'{i}.txt', b'same') for i in range(duplicates.MIN_POOL_FILES)]
+    assert duplicates.find_duplicates([tmp_path], workers=2) == [sorted(paths)]
+
+def test_copies_to_flag(tmp_path):
+    reorg = tmp_path / 'reorg'
+    groups = [[tmp_path / 'a.txt', tmp_path / 'b.txt', reorg / 'a.txt'],
+              [tmp_path / 'c.txt', tmp_path / 'd.txt']]
+    assert duplicates.copies_to_flag(groups, keep_under=reorg) == {tmp_path / 'a.txt': reorg / 'a.txt',
+                                                                  tmp_path / 'b.txt': reorg / 'a.txt',
+                                                                  tmp_path / 'd.txt': tmp_path / 'c.txt'}
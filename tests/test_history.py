@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import history
+import move_and_log
+import processing
+
+FLAGS = {'d': 'Duplicate', 'u': 'Unknown'}
+
+def log_line(message: str, when: float = 1_700_000_000):
+    return f'{move_and_log.timestamp(when)} --- {message}'
+
+def test_parse_text_lines(tmp_path):
+    source = tmp_path / 'src' / 'folder'
+    destination = tmp_path / 'reorg' / 'Docs' / 'folder'
+    move = history.parse_text_line(log_line(move_and_log.move_message(source, destination, os.sep, is_dir=True)), {})
+    assert move['source'] == str(source)
+    assert move['destination'] == str(destination)
+    assert move['timestamp'] == 1_700_000_000
+
+    e = processing.TableEntry('a.txt', 'd', '', '', '', '')
+    message = move_and_log.error_message(e, FLAGS, tmp_path / 'a.txt', short_paths=False, sep=os.sep, is_dir=False)
+    issue = history.parse_text_line(log_line(message), {issue: flag for flag, issue in FLAGS.items()})
+    assert (issue['source'], issue['flag']) == (str(tmp_path / 'a.txt'), 'd')
+    assert 'destination' not in issue
+
+    assert history.parse_text_line('not a log line\n', {}) is None
+    assert history.parse_text_line(log_line('something else\n'), {}) is None
+
+def test_parse_json_line():
+    record = {'timestamp': move_and_log.timestamp(1_700_000_000), 'source': '/a/b.txt', 'destination': '/c/b.txt', 'bytes': 5}
+    event = history.parse_json_line(json.dumps(record))
+    assert event['timestamp'] == 1_700_000_000
+    assert (event['source'], event['destination'], event['bytes']) == ('/a/b.txt', '/c/b.txt', 5)
+    assert history.parse_json_line('{"source": "/a"}') is None
+    assert history.parse_json_line('{') is None
+
+def test_where_and_find(tmp_path):
+    store = history.History(tmp_path / 'history.db')
+    src, reorg = tmp_path / 'src', tmp_path / 'reorg'
+    store.add('moved folder', timestamp=100, source=src / 'folder', destination=reorg / 'Docs' / 'folder')
+    store.add('moved a.txt', timestamp=200, source=src / 'a.txt', destination=reorg / 'Docs' / 'a.txt')
+    store.add('Duplicate: b.txt', timestamp=300, source=src / 'other' / 'b.txt', flag='d', issue_message='copy')
+    store.add('no source')
+    store.commit()
+
+    inside = src / 'folder' / 'sub' / 'c.txt'
+    events = store.where(str(inside))
+    assert [event['source'] for event in events] == [str(src / 'folder')]
+    assert history.format_event(events[0], str(inside)).endswith(f"-> {reorg / 'Docs' / 'folder' / 'sub' / 'c.txt'}")
+    assert [event['time'] for event in store.where('a.txt')] == [200]
+
+    assert [event['time'] for event in store.find()] == [300, 200, 100]
+    assert [event['time'] for event in store.find(under=str(src / 'other'))] == [300]
+    assert [event['time'] for event in store.find(flag='d')] == [300]
+    assert [event['time'] for event in store.find(kind='move', since=150)] == [200]
+    assert [event['time'] for event in store.find(until=150)] == [100]
+    store.close()
+
+def test_import_log_once(tmp_path):
+    log_path = tmp_path / 'change.log'
+    source, destination = tmp_path / 'a.txt', tmp_path / 'Docs' / 'a.txt'
+    log_path.write_text(log_line(move_and_log.move_message(source, destination, os.sep, is_dir=False)) + 'garbage\n',
+                        encoding='utf-8')
+    store = history.History(tmp_path / 'history.db')
+    assert store.import_log(log_path) == 1
+    assert store.import_log(log_path) is None
+    assert store.where(str(source))[0]['destination'] == str(destination)
+    store.close()
+
+def test_main_import_reads_flags_with_read_config(tmp_path, capsys):
+    config = tmp_path / 'config.ini'
+    config.write_text('[Flags]\nd = Duplicate File\n/ comment\n', encoding='utf-8')
+    e = processing.TableEntry('a.txt', 'd', '', '', '', '')
+    message = move_and_log.error_message(e, {'d': 'Duplicate File'}, tmp_path / 'a.txt', short_paths=False, sep=os.sep, is_dir=False)
+    log_path = tmp_path / 'error.log'
+    log_path.write_text(log_line(message), encoding='utf-8')
+    history.main(['--db', str(tmp_path / 'history.db'), 'import', str(log_path), '--config', str(config)])
+    assert '1 event(s) imported' in capsys.readouterr().out
+    store = history.History(tmp_path / 'history.db')
+    assert store.find()[0]['flag'] == 'd'
+    store.close()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import json
+import shutil
+import batch
+import copy_engine
+import journal
+import outbox
+import processing
+
+def make_tree(root):
+    (root / 'sub').mkdir(parents=True)
+    (root / 'a.txt').write_text('a')
+    (root / 'sub' / 'b.txt').write_text('bb')
+    return root
+
+def test_records_survive_reopening(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    j = journal.Journal(path, fsync=False)
+    j.record('move|a|b', 'begin', kind='move')
+    j.close()
+    with path.open('a') as journal_file:
+        journal_file.write('{"key": "move|c|d", "op": "beg')      #cut short by a crash
+    j = journal.Journal(path)
+    assert [record['key'] for record in j.pending()] == ['move|a|b']
+    j.close()
+
+def test_compact_keeps_one_line_per_entry(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    j = journal.Journal(path, fsync=False)
+    for key, op in [('flag|a|d', 'begin'), ('flag|a|d', 'done'), ('move|b|c', 'begin'), ('move|b|c', 'skipped'),
+                    ('move|e|f', 'begin')]:
+        j.record(key, op)
+    assert list(j.records) == ['move|e|f']      #finished entries are only kept as keys
+    j.close()
+    j = journal.Journal(path)
+    assert list(j.records) == ['move|e|f']
+    assert j.is_done('flag|a|d') and j.last_op('move|b|c') is None
+    j.close()
+    assert [(record['key'], record['op']) for record in map(json.loads, path.read_text().splitlines())] == \
+        [('flag|a|d', 'done'), ('move|e|f', 'begin')]
+
+def test_compact_leaves_pending_journal_alone(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    j = journal.Journal(path, fsync=False)
+    j.record('move|a|b', 'begin')
+    j.close()
+    before = path.stat().st_mtime_ns, path.read_text()
+    journal.Journal(path).close()
+    assert (path.stat().st_mtime_ns, path.read_text()) == before
+
+def test_recover_completed_and_lost(tmp_path):
+    (tmp_path / 'dst').write_text('x')
+    assert journal.recover_move(tmp_path / 'src', tmp_path / 'dst') == 'completed'
+    assert journal.recover_move(tmp_path / 'gone', tmp_path / 'also_gone') == 'lost'
+
+def test_recover_finishes_verified_directory(tmp_path):
+    source = make_tree(tmp_path / 'src')
+    destination = tmp_path / 'dst'
+    shutil.copytree(source, destination)
+    (source / 'a.txt').unlink()     #deleting the source had started
+    assert journal.recover_move(source, destination) == 'finished'
+    assert not source.exists()
+    assert (destination / 'sub' / 'b.txt').read_text() == 'bb'
+
+def test_recover_keeps_source_directory_if_destination_differs(tmp_path):
+    source = make_tree(tmp_path / 'src')
+    destination = tmp_path / 'dst'
+    shutil.copytree(source, destination)
+    (destination / 'sub' / 'b.txt').write_text('changed')
+    assert journal.recover_move(source, destination) == 'not_started'
+    assert (source / 'sub' / 'b.txt').read_text() == 'bb'
+
+    shutil.rmtree(destination)
+    destination.mkdir()     #an unrelated folder that was already there
+    assert journal.recover_move(source, destination) == 'not_started'
+    assert (source / 'a.txt').exists()
+
+def test_recover_keeps_source_file_if_destination_differs(tmp_path):
+    source = tmp_path / 'src.txt'
+    source.write_text('source')
+    destination = tmp_path / 'dst.txt'
+    destination.write_text('something else')
+    assert journal.recover_move(source, destination) == 'not_started'
+    assert source.exists()
+
+    shutil.copy2(source, destination)
+    assert journal.recover_move(source, destination) == 'finished'
+    assert not source.exists()
+
+def test_recover_rolls_back_partial_copy(tmp_path):
+    source = tmp_path / 'src.txt'
+    source.write_text('source')
+    destination = tmp_path / 'dst.txt'
+    copy_engine.staging_path(destination).write_text('sou')
+    assert journal.recover_move(source, destination) == 'not_started'
+    assert journal.recover_move(source, destination, rollback=True) == 'rolled_back'
+    assert not copy_engine.staging_path(destination).exists()
+    assert source.read_text() == 'source'
+
+def test_processor_recovers_interrupted_move(tmp_path, make_processor):
+    source = tmp_path / 'a.txt'
+    source.write_text('a')
+    e = processing.TableEntry('a.txt', '', 'Docs', '', '', '')
+    destination = tmp_path / 'reorg' / 'Docs' / 'a.txt'
+    j = journal.Journal(tmp_path / 'logs' / 'journal.jsonl', fsync=False)
+    j.record(journal.move_key(source, destination), 'begin', kind='move', entry=list(e), cwd=str(tmp_path),
+             source=str(source), destination=str(destination))
+    j.close()
+    with make_processor() as processor:
+        processor.recover()
+        assert processor.journal.is_done(journal.move_key(source, destination))
+    assert destination.read_text() == 'a'
+
+def test_flagged_entry_is_not_reported_again_until_its_card_is_resolved(tmp_path, make_processor, fake_trello):
+    (tmp_path / 'a.txt').write_text('a')
+    e = processing.TableEntry('a.txt', 'd', '', '', '', 'Copy of b.txt')
+    for run in range(2):
+        with make_processor(CARD_OUTBOX='yes') as processor:
+            assert processor.process_entry(e, tmp_path) == (True, 0)
+            assert processor.process_entry(e, tmp_path) == (True, 0)
+            assert processor.counts['replayed'] == run + 1
+    assert len(fake_trello.cards) == 1
+    assert len((tmp_path / 'logs' / 'error.log').read_text().splitlines()) == 1
+
+    # Once card_sync has found its card resolved, the entry can be flagged again
+    box = outbox.Outbox(tmp_path / 'logs' / processing.OUTBOX_FILE_NAME)
+    box.set_issue_status([issue['id'] for issue in box.issues()], 'resolved')
+    box.close()
+    with make_processor(CARD_OUTBOX='yes') as processor:
+        assert processor.process_entry(e, tmp_path) == (True, 0)
+        assert processor.counts['flagged'] == 1
+    assert len(fake_trello.cards) == 2
+
+def test_memory_does_not_grow_with_the_batch(tmp_path, make_processor):
+    source_dir = tmp_path / 'source'
+    source_dir.mkdir()
+    n = 2000
+    for i in range(n):
+        (source_dir / f'{i}.txt').write_text('x')
+    entries = (processing.TableEntry(f'{i}.txt', '', 'Docs', '', '', '') for i in range(n))
+    processor = make_processor()
+    summary = batch.run_batch(entries, processor, source_dir)
+    assert summary['moved'] == n
+    assert processor.journal.records == {}
+    assert len(processor.journal.done) == n
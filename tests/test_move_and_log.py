@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from pathlib import Path
+import move_and_log
+import processing
+
+def test_error_message_names_nested_folders_by_their_own_name():
+    e = processing.TableEntry('sub/child', 'd', '', '', '', '')
+    source = Path('/data', 'sub', 'child')
+    message = move_and_log.error_message(e, {'d': 'Duplicate'}, source, short_paths=False, sep='/', is_dir=True)
+    assert message == 'Duplicate: /child/ in /data/sub/'
+    message = move_and_log.error_message(e._replace(name='sub/a.txt'), {'d': 'Duplicate'}, Path('/data/sub/a.txt'),
+                                         short_paths=False, sep='/', is_dir=False)
+    assert message == 'Duplicate: a.txt in /data/sub/'
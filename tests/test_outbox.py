@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import time
+import pytest
+import outbox
+import processing
+
+@pytest.fixture
+def box(tmp_path):
+    box = outbox.Outbox(tmp_path / 'card_outbox.db')
+    yield box
+    box.close()
+
+def test_put_is_idempotent_while_pending(box):
+    entry = processing.TableEntry('a.txt', 'd', '', '', '', '')
+    first = box.put('flag|a|d', 'list1', 'Duplicate: a.txt', '', '', issues=[('/src/a.txt', entry)])
+    assert box.put('flag|a|d', 'list1', 'Duplicate: a.txt', '', '') == first
+    assert box.count('pending') == 1
+    box.mark_sent(first, 'card1')
+    assert box.put('flag|a|d', 'list1', 'Duplicate: a.txt', '', '') != first
+    issues = box.issues()
+    assert [(issue['card_id'], issue['source'], issue['entry']) for issue in issues] == [('card1', '/src/a.txt', list(entry))]
+    box.set_issue_status([issues[0]['id']], 'resolved')
+    assert box.issues() == [] and len(box.issues('resolved')) == 1
+
+def test_put_rolls_back_card_without_its_issues(box):
+    with pytest.raises(TypeError):
+        box.put('flag|a|d', 'list1', 'name', '', '', issues=[('/src/a.txt', None)])
+    assert box.count('pending') == 0
+
+def test_sender_retries_and_fails(box):
+    box.put('ok', 'list1', 'ok', '', '', checklist=['one'])
+    box.put('flaky', 'list1', 'flaky', '', '')
+    box.put('rejected', 'list1', 'rejected', '', '')
+    attempts = {}
+    def send(card, save):
+        attempts[card['name']] = attempts.get(card['name'], 0) + 1
+        if card['name'] == 'rejected':
+            raise ValueError('rejected')
+        if card['name'] == 'flaky' and attempts['flaky'] == 1:
+            raise ConnectionError('try again')
+        save(items_sent=len(card['checklist']))
+        return 'id_' + card['name']
+    sender = outbox.OutboxSender(box, send, is_permanent=lambda error: isinstance(error, ValueError), workers=2,
+                                 poll_interval=0.05).start()
+    deadline = time.monotonic() + 5
+    while box.count('pending') and time.monotonic() < deadline:      #flaky is retried once its delay has passed
+        time.sleep(0.05)
+    assert sender.stop() == 0
+    assert attempts == {'ok': 1, 'flaky': 2, 'rejected': 1}
+    assert (box.count('sent'), box.count('failed')) == (2, 1)
+    assert {card['id'] for card in box.due(10)} == set()
+
+def test_stop_does_not_wait_for_cards_being_retried_later(box):
+    box.put('down', 'list1', 'down', '', '')
+    def send(card, save):
+        raise ConnectionError('Trello is down')
+    sender = outbox.OutboxSender(box, send, poll_interval=0.05).start()
+    deadline = time.monotonic() + 5
+    while box.due(1) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    started = time.monotonic()
+    assert sender.stop(timeout=30) == 1
+    assert time.monotonic() - started < 5
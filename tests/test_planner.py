@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from pathlib import Path
+import move_and_log
+import planner
+import processing
+
+def entry(name, flag='', cat1='', cat2=''):
+    return processing.TableEntry(name, flag, cat1, cat2, '', '')
+
+def test_make_plan(tmp_path):
+    cwd = tmp_path / 'cwd'
+    (cwd / 'folder').mkdir(parents=True)
+    for name in ('a.txt', 'b.txt', 'c.txt', 'flagged.txt'):
+        (cwd / name).write_text(name)
+    reorg = tmp_path / 'reorg'
+    (reorg / 'Docs').mkdir(parents=True)
+    (reorg / 'Docs' / 'b.txt').write_text('already there')
+    (cwd / 'Other').mkdir()
+    entries = [entry('a.txt', cat1='Docs'),
+               entry('b.txt', cat1='Docs'),
+               entry('missing.txt', cat1='Docs'),
+               entry('folder', cat1='New', cat2='Sub'),
+               entry('flagged.txt', flag='d'),
+               entry('gone.txt', flag='d')]
+    plan = planner.make_plan(entries, cwd, reorg, processing.destination_for)
+    assert [(item.source.name, item.action, item.problem, item.is_dir) for item in plan.items] == [
+        ('a.txt', 'move', None, False),
+        ('b.txt', 'skip', 'duplicate', False),
+        ('missing.txt', 'skip', 'missing_source', None),
+        ('folder', 'move', None, True),
+        ('flagged.txt', 'flag', None, False),
+        ('gone.txt', 'flag', 'missing_source', None)]
+    assert plan.items[0].same_device is True
+    assert plan.items[3].same_device is None        #its folder doesn't exist yet
+    assert plan.dirs_to_create == {reorg / 'New' / 'Sub'}
+    assert (plan.count('move'), plan.count('skip'), len(plan.problems())) == (2, 2, 3)
+    assert 'b.txt already exists at the destination' in plan.summary()
+
+def test_collision_within_batch(tmp_path):
+    for folder in ('one', 'two'):
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / 'same.txt').write_text(folder)
+    destination_for = lambda e, source, reorg: reorg / 'Docs' / 'same.txt'
+    plan = planner.make_plan([entry('one/same.txt', cat1='Docs'), entry('two/same.txt', cat1='Docs')],
+                             tmp_path, tmp_path / 'reorg', destination_for)
+    assert [item.problem for item in plan.items] == [None, 'collision']
+
+def test_directory_index(tmp_path):
+    (tmp_path / 'folder').mkdir()
+    (tmp_path / 'file.txt').write_text('x')
+    index = planner.DirectoryIndex()
+    assert index.is_dir(tmp_path / 'folder') is True
+    assert index.is_dir(tmp_path / 'file.txt') is False
+    assert index.is_dir(tmp_path / 'new.txt') is None
+    (tmp_path / 'new.txt').write_text('x')
+    assert not index.exists(tmp_path / 'new.txt')     #each folder is only listed once
+    index.add(tmp_path / 'new.txt')
+    assert index.exists(tmp_path / 'new.txt')
+    assert not index.dir_exists(tmp_path / 'missing')
+    assert index.device(tmp_path) == tmp_path.stat().st_dev
+
+def test_path_from_common_parent():
+    main = Path('/data/source/projects/a.txt')
+    compare = Path('/data/source/archive/a.txt')
+    assert move_and_log.path_from_common_parent(main, compare, -1) == Path('source/projects/a.txt')
+    assert move_and_log.path_from_common_parent(main, compare, 0) == main
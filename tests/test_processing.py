@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import pytest
+import journal
+import processing
+
+def test_failed_card_leaves_entry_pending(tmp_path, make_processor, fake_trello):
+    (tmp_path / 'a.txt').write_text('a')
+    e = processing.TableEntry('a.txt', 'd', '', '', '', '')
+    key = journal.flag_key(tmp_path / 'a.txt', 'd')
+    fake_trello.error_rate = 1.0
+    with make_processor() as processor:
+        assert processor.process_entry(e, tmp_path) == (False, 0)
+        assert processor.journal.last_op(key) == 'begin'
+        assert processor.counts['flagged'] == 0
+
+    # The next run sends the card while recovering
+    fake_trello.error_rate = 0.0
+    with make_processor() as processor:
+        processor.recover()
+        assert processor.journal.is_done(key)
+    assert len(fake_trello.cards) == 1
+
+def test_grouped_card_is_finished_rather_than_made_again(tmp_path, make_processor, fake_trello):
+    entries = [processing.TableEntry(name, 'd', '', '', '', '') for name in ('a.txt', 'b.txt', 'c.txt')]
+    for e in entries:
+        (tmp_path / e.name).write_text(e.name)
+    route = fake_trello.route
+    def failing_route(method, path, params):
+        checklists = list(fake_trello.checklists.values())
+        if path.endswith('/checkItems') and checklists and len(checklists[0]['checkItems']) == 1:
+            return 400, 'invalid value'
+        return route(method, path, params)
+    fake_trello.route = failing_route
+    with make_processor(CARD_GROUPING='flag') as processor:
+        for e in entries:
+            assert processor.process_entry(e, tmp_path) == (True, 0)
+    assert processor.journal.pending()      #the card failed after its first item
+
+    # The next run adds the remaining items to the same card
+    fake_trello.route = route
+    with make_processor(CARD_GROUPING='flag') as processor:
+        processor.recover()
+    assert processor.journal.pending() == []
+    assert len(fake_trello.cards) == 1
+    [checklist] = fake_trello.checklists.values()
+    assert [item['name'].split()[1] for item in checklist['checkItems']] == ['a.txt', 'b.txt', 'c.txt']       #'Duplicate: a.txt in ...'
+
+def test_move_by_rename(tmp_path, make_processor):
+    (tmp_path / 'folder').mkdir()
+    (tmp_path / 'folder' / 'a.txt').write_text('abc')
+    (tmp_path / 'b.txt').write_text('abcd')
+    with make_processor() as processor:
+        assert processor.process_entry(processing.TableEntry('folder', '', 'Docs', 'Old', '', ''), tmp_path) == (True, 0)
+        assert processor.process_entry(processing.TableEntry('b.txt', '', 'Docs', '', '', ''), tmp_path) == (True, 4)
+    assert (tmp_path / 'reorg' / 'Docs' / 'Old' / 'folder' / 'a.txt').read_text() == 'abc'
+    assert processor.counts['moved'] == 2
+    assert processor.bytes_moved == 4       #the renamed folder isn't walked to count its bytes
+
+def test_source_removed_after_planning_is_skipped(tmp_path, make_processor, settings):
+    (tmp_path / 'a.txt').write_text('a')
+    e = processing.TableEntry('a.txt', '', 'Docs', '', '', '')
+    [plan_item] = processing.make_plan([e], tmp_path, settings).items
+    assert plan_item.same_device is None        #the destination folder doesn't exist yet
+    (tmp_path / 'a.txt').unlink()
+    with make_processor() as processor:
+        assert processor.process_entry(e, tmp_path, plan_item) == (False, 0)
+        assert processor.journal.pending() == []        #skipped, so not recovered by the next run either
+    assert processor.counts['skipped'] == 1
+
+def test_close_after_failed_open(tmp_path, settings):
+    processor = processing.Processor(settings, {}, tmp_path / 'missing' / 'change.log', tmp_path / 'missing' / 'error.log',
+                                     journal_path=tmp_path / 'missing' / 'journal.jsonl')
+    with pytest.raises(OSError):
+        processor.open()
+    processor.close()
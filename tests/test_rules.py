@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from pathlib import Path
+import os
+import pytest
+import rules
+
+RULES = """
+[installers]
+name = *setup*
+extension = .exe, .msi
+ignore_case = yes
+cat1 = Software
+cat2 = Installers
+
+[copies]
+regex = .*( - Copy| \\(\\d+\\))(\\.[^.]*)?
+flag = d
+issue_message = Looks like a copy ; of another file
+
+[big old files]
+type = file
+min_size = 1KB
+older_than = 30d
+cat1 = Archive
+
+[folders]
+type = dir
+cat1 = Folders
+"""
+
+@pytest.fixture
+def ruleset(tmp_path):
+    rules_path = tmp_path / 'rules.ini'
+    rules_path.write_text(RULES, encoding='utf-8')
+    return rules.load_rules(rules_path)
+
+def test_parse_size_and_age():
+    assert rules.parse_size('10MB') == 10 * 1024**2
+    assert rules.parse_size('1.5 k') == 1536
+    assert rules.parse_size('0B') == 0
+    assert rules.parse_age('30d') == rules.parse_age('30') == 30 * 86400
+    assert rules.parse_age('2h') == 7200
+    with pytest.raises(rules.RulesError):
+        rules.parse_size('ten')
+    with pytest.raises(rules.RulesError):
+        rules.parse_age('1 month')
+
+def test_match_by_name(ruleset):
+    assert ruleset.match('Office_SETUP.MSI', False).name == 'installers'
+    assert ruleset.match('setup.zip', False) is None
+    copy = ruleset.match('report (2).pdf', False)
+    assert copy.name == 'copies'
+    assert copy.values == {'flag': 'd', 'issue_message': 'Looks like a copy'}
+    assert ruleset.match('Reports', True).name == 'folders'
+    assert ruleset.match('report.pdf', False) is None      #needs a stat, but there is no path
+
+def test_match_by_stat(tmp_path, ruleset):
+    old = tmp_path / 'old.bin'
+    old.write_bytes(b'x' * 2048)
+    os.utime(old, (0, 0))
+    small = tmp_path / 'small.bin'
+    small.write_bytes(b'x')
+    os.utime(small, (0, 0))
+    assert ruleset.match('old.bin', False, old).name == 'big old files'
+    assert ruleset.match('small.bin', False, small) is None
+    assert ruleset.match('old.bin', False, old, now=60.0) is None
+    assert dict(ruleset.classify([('old.bin', False, old), ('small.bin', False, small), ('x', True, tmp_path)])) == \
+        {0: ruleset.rules[2], 2: ruleset.rules[3]}
+
+def test_later_rule_matches_when_earlier_one_is_rejected(tmp_path):
+    ruleset = rules.RuleSet([rules.parse_rule('big', {'name': '*.log', 'min_size': '1MB', 'flag': 'b'}),
+                             rules.parse_rule('logs', {'extension': 'log', 'cat1': 'Logs'})])
+    log = tmp_path / 'app.log'
+    log.write_text('small')
+    assert ruleset.match('app.log', False, log).name == 'logs'
+
+def test_invalid_rules():
+    with pytest.raises(rules.RulesError):
+        rules.parse_rule('empty', {'name': '*.txt'})
+    with pytest.raises(rules.RulesError):
+        rules.parse_rule('typo', {'nmae': '*.txt', 'flag': 'd'})
+    with pytest.raises(rules.RulesError):
+        rules.parse_rule('bad regex', {'regex': '(', 'flag': 'd'})
+    with pytest.raises(rules.RulesError):
+        rules.parse_rule('late flags', {'regex': 'foo(?i)', 'flag': 'd'})
+    with pytest.raises(rules.RulesError):
+        rules.load_rules(Path('missing.ini'))
+
+def test_apply_rule(ruleset):
+    rule = ruleset.rules[0]
+    assert rules.apply_rule(['', '', '', '', ''], rule) == ['', 'Software', 'Installers', '', '']
+    assert rules.apply_rule(['', 'Mine', '', '', ''], rule) is None
+
+def test_regexes_with_groups_and_flags(tmp_path):
+    rules_path = tmp_path / 'rules.ini'
+    rules_path.write_text('[plain]\nname = *.tmp\nflag = t\n\n'
+                          '[repeated]\nregex = (\\w+)-\\1\\.txt\nflag = r\n\n'
+                          '[stem one]\nregex = (?P<stem>a+)\\.log\nflag = a\n\n'
+                          '[stem two]\nregex = (?P<stem>b+)\\.log\nflag = b\n\n'
+                          '[global flags]\nregex = (?i)foo.*\nflag = f\n', encoding='utf-8')
+    ruleset = rules.load_rules(rules_path)
+    assert ruleset.match('abc-abc.txt', False).name == 'repeated'
+    assert ruleset.match('abc-abd.txt', False) is None
+    assert ruleset.match('aa.log', False).name == 'stem one'
+    assert ruleset.match('bb.log', False).name == 'stem two'
+    assert ruleset.match('FOObar', False).name == 'global flags'
+    assert ruleset.match('x.tmp', False).name == 'plain'
+
+def test_first_rule_wins_across_combined_and_separate_rules():
+    ruleset = rules.RuleSet([rules.parse_rule('backreference', {'regex': r'(a)\1.*', 'flag': 'x'}),
+                             rules.parse_rule('plain', {'name': 'aa*', 'flag': 'y'})])
+    assert ruleset.match('aab', False).name == 'backreference'
+    assert ruleset.match('ab', False) is None
+    assert ruleset.match('aa', False).name == 'backreference'
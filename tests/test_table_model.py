@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from pathlib import Path
+import processing
+import table_model
+
+def names(rows):
+    return [row.cells[0] for row in rows]
+
+def make_model():
+    model = table_model.TableModel(len(processing.ENTRY_FIELDS))
+    docs, photos = model.add(['docs', 'Photos'], is_dir=True)
+    b, a, c = model.add(['b.txt', 'A.tif', 'c.doc'], is_dir=False)
+    model.add(['x.tif', 'y.txt'], is_dir=False, parent=docs)
+    model.set_stats({b.iid: (30, 3.0), a.iid: (10, 1.0), c.iid: None})
+    return model, docs
+
+def test_lazy_directories_and_visible_rows():
+    model, docs = make_model()
+    assert names(model.visible_rows()) == ['docs', 'Photos', 'b.txt', 'A.tif', 'c.doc']
+    assert model.visible_count() == 5
+    model.set_expanded(docs, True)
+    assert names(model.visible_rows()) == ['docs', 'x.tif', 'y.txt', 'Photos', 'b.txt', 'A.tif', 'c.doc']
+    assert model.visible_count() == 7
+    assert model.get('r2').children is None      #Photos hasn't been listed
+    assert model.relative_path(model.get('r6')) == Path('docs', 'x.tif')
+    assert names(model) == ['x.tif', 'y.txt', 'docs', 'Photos', 'b.txt', 'A.tif', 'c.doc']
+
+def test_remove_purges_caches():
+    model, docs = make_model()
+    model.set_expanded(docs, True)
+    model.sort(0, lambda row: row.cells[0].casefold())
+    model.remove(docs.iid)
+    assert names(model.visible_rows()) == ['Photos', 'A.tif', 'b.txt', 'c.doc']
+    assert model.visible_count() == 4
+    assert set(model.folded_cells) <= set(model.rows)
+    assert set(model.sort_keys[0]) == set(model.rows)
+    assert model.remove(docs.iid) is None
+
+def test_sort_keeps_directories_first_and_missing_keys_last():
+    model, docs = make_model()
+    size = lambda row: model.stats[row.iid][0] if model.stats.get(row.iid) is not None else None
+    model.sort('size', size)
+    assert names(model.top) == ['docs', 'Photos', 'A.tif', 'b.txt', 'c.doc']
+    model.sort('size', size, reverse=True)
+    assert names(model.top) == ['docs', 'Photos', 'b.txt', 'A.tif', 'c.doc']
+
+    model.set_cell('r4', 1, 'd')
+    flag = lambda row: row.cells[1].casefold() or None
+    model.sort(1, flag, reverse=True)
+    assert names(model.file_rows.values())[0] == 'A.tif'
+    model.set_cell('r4', 1, '')
+    model.set_cell('r5', 1, 'x')
+    model.sort(1, flag)
+    assert names(model.file_rows.values())[0] == 'c.doc'         #the changed keys were computed again
+
+def test_filter():
+    model, docs = make_model()
+    model.set_cell('r3', 2, 'Letters')
+    fields = processing.ENTRY_FIELDS
+    model.set_filter(table_model.make_filter('*.tif', fields))
+    assert names(model.visible_rows()) == ['docs', 'A.tif']      #docs holds x.tif
+    model.set_expanded(docs, True)
+    assert names(model.visible_rows()) == ['docs', 'x.tif', 'A.tif']
+    model.set_filter(table_model.make_filter('cat1:lett', fields))
+    assert names(model.visible_rows()) == ['b.txt']
+    model.set_filter(table_model.make_filter('cat1: txt', fields))
+    assert names(model.visible_rows()) == ['docs', 'y.txt']
+    model.set_filter(None)
+    assert model.visible_count() == 7
+
+def test_added_rows_respect_filter():
+    model, docs = make_model()
+    model.set_filter(table_model.make_filter('.doc', processing.ENTRY_FIELDS))
+    model.add(['new.doc', 'new.txt'], is_dir=False)
+    assert names(model.visible_rows()) == ['c.doc', 'new.doc']
+    assert model.visible_count() == 2
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import email.utils
+import socket
+import threading
+import time
+import pytest
+import trello
+
+def test_parse_retry_after():
+    assert trello.parse_retry_after(None) is None
+    assert trello.parse_retry_after('2.5') == 2.5
+    assert trello.parse_retry_after('-1') == 0.0
+    assert trello.parse_retry_after('soon') is None
+    in_ten_seconds = email.utils.formatdate(time.time() + 10, usegmt=True)
+    assert 8 <= trello.parse_retry_after(in_ten_seconds) <= 10
+    assert trello.parse_retry_after(email.utils.formatdate(time.time() - 60, usegmt=True)) == 0.0
+
+def test_token_bucket_throttles():
+    bucket = trello.TokenBucket(5, 0.5)
+    start = time.monotonic()
+    for _ in range(8):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.25     #3 tokens at 10 per second
+
+def test_retries_rate_limited_requests(fake_trello):
+    fake_trello.error_rate = 0.5
+    client = trello.TrelloClient('key', 'token', backoff_base=0.001)
+    try:
+        for _ in range(10):
+            assert client.request('GET', 'members/me/boards').status_code == 200
+    finally:
+        client.close()
+    assert fake_trello.stats['rate_limited'] > 0
+
+def test_waits_as_long_as_retry_after(fake_trello):
+    fake_trello.error_rate = 1.0
+    fake_trello.retry_after = 0.1
+    client = trello.TrelloClient('key', 'token', max_retries=2, backoff_base=0.001)
+    start = time.monotonic()
+    try:
+        response = client.request('GET', 'members/me/boards')
+    finally:
+        client.close()
+    assert response.status_code == 429      #left for the caller once the retries are used up
+    assert time.monotonic() - start >= 0.2
+    assert fake_trello.stats['requests'] == 3
+
+def test_connection_errors_raise_trello_error(monkeypatch):
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+    monkeypatch.setattr(trello, 'BASE_URL', f'http://127.0.0.1:{port}/1/')
+    client = trello.TrelloClient('key', 'token', max_retries=1, backoff_base=0.001, timeout=1)
+    try:
+        with pytest.raises(trello.TrelloError):
+            client.request('GET', 'members/me/boards')
+    finally:
+        client.close()
+
+def test_id_cache(tmp_path):
+    cache = trello.IDCache(tmp_path / 'ids.json', ttl=60)
+    cache.put('board:Board', 'board1')
+    cache.save()
+    assert trello.IDCache(tmp_path / 'ids.json').get('board:Board') == 'board1'
+    assert trello.IDCache(tmp_path / 'ids.json', ttl=-1).get('board:Board') is None
+    cache.invalidate('board:Board')
+    assert cache.get('board:Board') is None
+    assert trello.IDCache(tmp_path / 'ids.json').get('board:Board') == 'board1'      #until it is saved
+
+def test_id_cache_saves_from_many_threads(tmp_path):
+    cache = trello.IDCache(tmp_path / 'ids.json', ttl=60)
+    def work(n):
+        for i in range(50):
+            cache.put(f'member:{n}-{i}', str(i))
+            cache.invalidate(f'member:{n}-{i - 1}')
+            cache.save()
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(trello.IDCache(tmp_path / 'ids.json').entries) == 8
+    assert list(tmp_path.iterdir()) == [tmp_path / 'ids.json']
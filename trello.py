@@ -6,16 +6,224 @@ Created on Sat Mar 27 14:47:00 2021
 Functions for finding boards, lists, users, and for making cards in Trello
 """
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import email.utils
+import json
+import random
+import os
+import tempfile
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+import metrics
 
+# Trello allows 300 requests per 10 seconds for each API key and 100 requests
+# per 10 seconds for each token (ref: https://developer.atlassian.com/cloud/trello/guides/rest-api/rate-limits/)
+KEY_RATE_LIMIT = (300, 10.0)
+TOKEN_RATE_LIMIT = (100, 10.0)
+BASE_URL = "https://api.trello.com/1/"
+ID_CACHE_TTL = 7 * 24 * 3600       #seconds before a cached board/list/member ID is looked up again
+MAX_LOOKUP_WORKERS = 8
+MAX_CHECKLIST_ITEMS = 200           #Trello's limit on the number of items in a checklist
+MAX_ACTIONS = 1000                  #Trello's limit on the number of actions returned by one request
+
+class TokenBucket:
+    """Thread-safe token bucket that allows `capacity` requests per `period` seconds"""
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period       #tokens regained per second
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then consume it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class TrelloClient:
+    """Sends requests to the Trello REST API over a shared keep-alive session,
+    throttling them to stay under Trello's rate limits and retrying 429s, 
+    server errors, and dropped connections with jittered exponential backoff"""
+    _key_buckets = {}       #shared by all clients, because the per-key quota is shared by all tokens
+    _key_buckets_lock = threading.Lock()
+
+    def __init__(self, api_key, oath_token, max_retries=5, backoff_base=0.5, backoff_max=30.0, timeout=30.0):
+        self.api_key = api_key
+        self.oath_token = oath_token
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+
+        # One session per client, so the TCP+TLS connection is reused between calls
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # Rate limiters for the key (shared) and the token (per client)
+        with TrelloClient._key_buckets_lock:
+            if api_key not in TrelloClient._key_buckets:
+                TrelloClient._key_buckets[api_key] = TokenBucket(*KEY_RATE_LIMIT)
+            self.key_bucket = TrelloClient._key_buckets[api_key]
+        self.token_bucket = TokenBucket(*TOKEN_RATE_LIMIT)
+
+    def request(self, method, path, params=None, headers=None):
+        """Sends a request to BASE_URL + path (with extra headers, if given) and returns
+        the response. Raises TrelloError if the request still fails after max_retries retries"""
+        url = path if path.startswith("http") else BASE_URL + path.lstrip("/")
+        querystring = {"key": self.api_key, "token": self.oath_token}
+        querystring.update(params or {})
+
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                metrics.count('http_retries')
+            with metrics.span('trello.throttle'):
+                self.key_bucket.acquire()
+                self.token_bucket.acquire()
+            metrics.count('http_requests')
+            try:
+                with metrics.span('trello.http'):
+                    response = self.session.request(method, url, params=querystring, headers=headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                metrics.count('http_connection_errors')
+                if attempt == self.max_retries:
+                    raise TrelloError(f'Request failed: {method} {url}') from e
+                with metrics.span('trello.backoff'):
+                    time.sleep(self.backoff(attempt))
+                continue
+
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            metrics.count('http_rate_limited' if response.status_code == 429 else 'http_server_errors')
+            if attempt == self.max_retries:
+                return response     #let the caller decide what to do with the error response
+            
+            # Wait as long as the server asked, or back off exponentially
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            with metrics.span('trello.backoff'):
+                time.sleep(retry_after if retry_after is not None else self.backoff(attempt))
+
+    def backoff(self, attempt: int):
+        """Returns a delay in seconds with 'full jitter' (a random value between 0
+        and the exponential backoff for this attempt)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def close(self):
+        self.session.close()
+
+def parse_retry_after(value):
+    """Returns the number of seconds in a Retry-After header (either delta-seconds
+    or an HTTP date), or None if the header is missing or invalid"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_time.timestamp() - time.time())
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(api_key, oath_token):
+    """Returns the shared TrelloClient for the given credentials, creating it if necessary"""
+    with _clients_lock:
+        client = _clients.get((api_key, oath_token))
+        if client is None:
+            client = _clients[(api_key, oath_token)] = TrelloClient(api_key, oath_token)
+        return client
+
+class IDCache:
+    """On-disk cache of resolved Trello IDs, keyed by strings like 'board:<name>',
+    'list:<board_id>:<name>' and 'member:<username>'. Entries expire after ttl seconds"""
+    def __init__(self, cache_file_path: Path, ttl: float = ID_CACHE_TTL):
+        self.cache_file_path = cache_file_path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        try:
+            with cache_file_path.open() as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        self.changed = False
+
+    def get(self, key):
+        """Returns the cached ID for key, or None if it is missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+        return entry['id']
+
+    def put(self, key, id_):
+        with self.lock:
+            self.entries[key] = {'id': id_, 'time': time.time()}
+            self.changed = True
+
+    def invalidate(self, key=None):
+        """Remove key from the cache, or every entry if key is None. Only changes
+        the cache in memory; call save() to write it out"""
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+            self.changed = True
+
+    def save(self):
+        """Write the cache to disk if it has changed since it was loaded or last saved"""
+        with self.lock:
+            if not self.changed:
+                return
+            fd, tmp = tempfile.mkstemp(dir=self.cache_file_path.parent, prefix=self.cache_file_path.name, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.entries, f, indent=1)
+                os.replace(tmp, self.cache_file_path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            self.changed = False
+
+def cached_lookup(cache, key, lookup):
+    """Returns cache[key] if present, and otherwise calls lookup() and caches the
+    result. A failed lookup removes any stale entry for key"""
+    if cache is not None:
+        id_ = cache.get(key)
+        if id_ is not None:
+            return id_
+    try:
+        id_ = lookup()
+    except TrelloError:
+        if cache is not None:
+            cache.invalidate(key)
+        raise
+    if cache is not None:
+        cache.put(key, id_)
+    return id_
+
+@metrics.timed('trello.find_board')
 def find_board(board_name, api_key, oath_token):
     """Returns the ID that corresponds to the given board name"""
     print(f"Searching for board \'{board_name}\'... ", end="")
     
     #construct and send the request
-    url = "https://api.trello.com/1/members/me/boards/"
-    querystring = {"key": api_key, "token": oath_token}
-    response = requests.request("GET", url, params=querystring) #returns a JSON object with info on all the boards for the given Trello account
+    response = get_client(api_key, oath_token).request("GET", "members/me/boards/", params={"fields": "name,id"}) #returns a JSON object with the names and IDs of all the boards for the given Trello account
 
     #parse the response to see if the request was successful
     try: 
@@ -23,17 +231,16 @@ def find_board(board_name, api_key, oath_token):
         board_id = board_info["id"]         #board_id = response.json()[0]["id"] works if there are no other boards
         print("Found\n")
         return board_id
-    except StopIteration:
+    except (StopIteration, requests.exceptions.JSONDecodeError, TypeError):
         raise TrelloError(f'Board not found: {board_name}')
 
+@metrics.timed('trello.find_list')
 def find_list(board_id, list_name, api_key, oath_token):
     """Returns the ID that corresponds to a given list name and on a board with a given id"""
     print(f"Searching for list \'{list_name}\'... ", end="")
     
     #construct and send the request
-    url = "https://api.trello.com/1/boards/" + board_id + "/lists"
-    querystring = {"key": api_key, "token": oath_token}
-    response = requests.request("GET", url, params=querystring) #returns a JSON object with info on all the lists for the given board
+    response = get_client(api_key, oath_token).request("GET", "boards/" + board_id + "/lists", params={"fields": "name,id"}) #returns a JSON object with the names and IDs of all the lists for the given board
 
     #parse the response to see if the request was successful
     try:
@@ -41,48 +248,170 @@ def find_list(board_id, list_name, api_key, oath_token):
         list_id = list_info["id"]   #this will return an error if the response contains an error
         print("Found\n")
         return list_id
-    except StopIteration:
+    except (StopIteration, requests.exceptions.JSONDecodeError, TypeError):
         raise TrelloError(f'List not found: {list_name}')
+
+@metrics.timed('trello.find_member')
+def find_member(member, api_key, oath_token):
+    """Returns the ID that corresponds to a username"""
+    response = get_client(api_key, oath_token).request("GET", "members/" + member, params={"fields": "username,id"})
+    try:
+        return response.json()["id"]    #this will return an error if the response contains an error
+    except (requests.exceptions.JSONDecodeError, KeyError, TypeError):
+        raise TrelloError(f'Member not found: {member}')
     
-def find_members(members: list, api_key, oath_token):
-    """Returns a list of IDs corresponding to a list of usernames"""
-    member_ids = []         #list that will hold the member ids
-    
-    #Find the ID for each member in the list
-    for member in members:
-        print(f"Searching for member \'{member}\'... ", end="")
-        
-        #construct and send the request
-        url = "https://api.trello.com/1/members/" + member
-        querystring = {"key": api_key, "token": oath_token}
-        response = requests.request("GET", url, params=querystring) #returns a JSON object with info on all of the members specified
-        
-        #parse the response to see if the request was successful
+@metrics.timed('trello.find_members')
+def find_members(members: list, api_key, oath_token, cache=None):
+    """Returns a list of IDs corresponding to a list of usernames, in the same
+    order. The usernames are looked up concurrently, and any that aren't found
+    are left out"""
+    def lookup(member):
         try:
-            member_id = response.json()["id"]   #this will return an error if the response contains an error
-            member_ids.append(member_id)
-            print("Found")
-        except requests.exceptions.JSONDecodeError:
+            member_id = cached_lookup(cache, 'member:' + member, lambda: find_member(member, api_key, oath_token))
+        except TrelloError:
             print(f'Member not found: {member}')
-    return member_ids
+            return None
+        print(f"Found member \'{member}\'")
+        return member_id
+
+    with ThreadPoolExecutor(max_workers=min(MAX_LOOKUP_WORKERS, max(1, len(members)))) as executor:
+        member_ids = list(executor.map(lookup, members))
+    return [member_id for member_id in member_ids if member_id is not None]
+
+@metrics.timed('trello.resolve_ids')
+def resolve_ids(board_name, list_name, member_names: list, api_key, oath_token, cache=None):
+    """Returns (board_id, list_id, member_ids), using the cache where possible. The
+    members are looked up while the board and list are being resolved.
+    Raises TrelloError if the board or list can't be found"""
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            members_future = executor.submit(find_members, member_names, api_key, oath_token, cache)
+            board_id = cached_lookup(cache, 'board:' + board_name, 
+                                     lambda: find_board(board_name, api_key, oath_token))
+            list_id = cached_lookup(cache, f'list:{board_id}:{list_name}', 
+                                    lambda: find_list(board_id, list_name, api_key, oath_token))
+            member_ids = members_future.result()
+    finally:
+        if cache is not None:
+            cache.save()        #once, so that a failed lookup's invalidation is kept too
+    return board_id, list_id, member_ids
   
-def create_card(list_id, card_name, card_description, member_ids: list, api_key, oath_token):
-    """Makes a Trello card in the specified list, with a specified name and description"""
-    print(f"Creating card \'{card_name}\'... ", end="")
-    
-    #construct and send the request
-    url = "https://api.trello.com/1/cards/"
-    querystring = {"key": api_key, "token": oath_token, "name": card_name, "desc": card_description,
+@metrics.timed('trello.post_card')
+def post_card(list_id, card_name, card_description, member_ids: list, api_key, oath_token):
+    """Makes a Trello card in the specified list, with a specified name and description,
+    and returns its ID. Raises TrelloError if the card could not be created"""
+    querystring = {"name": card_name, "desc": card_description,
                    "pos": "top", "idList": list_id, "idMembers": member_ids}
-    response = requests.request("POST", url, params=querystring) #returns a JSON object with info on the newly-created card
-    
-    #parse the response to see if the request was successful
+    response = get_client(api_key, oath_token).request("POST", "cards/", params=querystring) #returns a JSON object with info on the newly-created card
+    return response_id(response, 'Card')
+
+@metrics.timed('trello.add_checklist')
+def add_checklist(card_id, checklist_name, api_key, oath_token):
+    """Adds an empty checklist to a card and returns its ID. Raises TrelloError if it could not be added"""
+    response = get_client(api_key, oath_token).request("POST", f"cards/{card_id}/checklists", params={"name": checklist_name})
+    return response_id(response, 'Checklist')
+
+@metrics.timed('trello.add_checklist_item')
+def add_checklist_item(checklist_id, item_name, api_key, oath_token):
+    """Adds an item to the end of a checklist and returns its ID. Raises TrelloError if it could not be added"""
+    response = get_client(api_key, oath_token).request("POST", f"checklists/{checklist_id}/checkItems",
+                                                       params={"name": item_name, "pos": "bottom"})
+    return response_id(response, 'Checklist item')
+
+def checklist_name(index: int, n_items: int):
+    """Name of the index-th checklist of a card with n_items items"""
+    if n_items <= MAX_CHECKLIST_ITEMS:
+        return 'Items'
+    first = index * MAX_CHECKLIST_ITEMS + 1
+    return f'Items {first}-{min(n_items, first + MAX_CHECKLIST_ITEMS - 1)}'
+
+def post_card_with_checklist(list_id, card_name, card_description, member_ids: list, items: list, api_key, oath_token, state=None, save=None):
+    """Makes a Trello card with items as checklist entries (in checklists of up to
+    MAX_CHECKLIST_ITEMS items) and returns its ID. Trello has no endpoint for adding
+    several items at once, so each item is a separate request.
+    - state, if given, is the progress of an earlier attempt as a dictionary with the
+      keys card_id, checklist_ids and items_sent
+    - save(**changes), if given, is called after every step with the changed progress,
+      so that an interrupted attempt can be resumed without making the card twice
+    Raises TrelloError if a step fails"""
+    state = state or {}
+    save = save or (lambda **changes: None)
+    card_id = state.get('card_id')
+    checklist_ids = list(state.get('checklist_ids') or [])
+    items_sent = state.get('items_sent') or 0
+
+    if card_id is None:
+        card_id = post_card(list_id, card_name, card_description, member_ids, api_key, oath_token)
+        save(card_id=card_id)
+    while items_sent < len(items):
+        index = items_sent // MAX_CHECKLIST_ITEMS
+        if index == len(checklist_ids):
+            checklist_ids.append(add_checklist(card_id, checklist_name(index, len(items)), api_key, oath_token))
+            save(checklist_ids=checklist_ids)
+        add_checklist_item(checklist_ids[index], items[items_sent], api_key, oath_token)
+        items_sent += 1
+        save(items_sent=items_sent)
+    return card_id
+
+def response_id(response, what: str):
+    """Returns the ID of the object created by a request, or raises TrelloError if it was rejected"""
     try:
-        card_id = response.json()["id"]     #this will return KeyError if the response contains an error
-        print("Done\n")
-        return card_id
+        return response.json()["id"]     #this will return KeyError if the response contains an error
+    except (requests.exceptions.JSONDecodeError, KeyError, TypeError):
+        raise TrelloError(f'{what} rejected with status {response.status_code}', status_code=response.status_code)
+
+@metrics.timed('trello.get_board_actions')
+def get_board_actions(board_id, action_filter, since, api_key, oath_token, before=None, etag=None, limit=MAX_ACTIONS):
+    """Returns (actions, etag) for up to limit actions on a board that match
+    action_filter (e.g. 'updateCard:closed,deleteCard'), newest first. since and
+    before are action IDs or ISO dates, and limit the actions to those after and
+    before them. If etag (from an earlier response) is given and nothing has
+    changed since, actions is None. Raises TrelloError if the request fails"""
+    params = {"filter": action_filter, "since": since, "limit": limit,
+              "fields": "type,date,data", "memberCreator": "false"}
+    if before is not None:
+        params["before"] = before
+    response = get_client(api_key, oath_token).request("GET", f"boards/{board_id}/actions", params=params,
+                                                       headers={"If-None-Match": etag} if etag else None)
+    if response.status_code == 304:
+        return None, etag
+    try:
+        actions = response.json()
     except requests.exceptions.JSONDecodeError:
+        actions = None
+    if response.status_code != 200 or not isinstance(actions, list):
+        raise TrelloError(f'Actions of board {board_id} could not be read (status {response.status_code})', status_code=response.status_code)
+    return actions, response.headers.get("ETag")
+
+@metrics.timed('trello.create_card')
+def create_card(list_id, card_name, card_description, member_ids: list, api_key, oath_token, cache=None, items=None, state=None, save=None):
+    """Makes a Trello card in the specified list, with a specified name and description,
+    and with items (if given) as checklist entries (state and save are passed on to
+    post_card_with_checklist, to resume an earlier attempt).
+    If the list or member IDs are rejected, the cached IDs are invalidated"""
+    print(f"Creating card \'{card_name}\'... ", end="")
+    try:
+        if items:
+            card_id = post_card_with_checklist(list_id, card_name, card_description, member_ids, items, api_key, oath_token,
+                                               state=state, save=save)
+        else:
+            card_id = post_card(list_id, card_name, card_description, member_ids, api_key, oath_token)
+    except TrelloError as e:
         print(f'Card could not be created: {card_name}. Continuing...\n')
+        if cache is not None and e.status_code in (400, 404):
+            cache.invalidate()      #the IDs are probably stale, so look them up again next time
+        return None
+    print("Done\n")
+    return card_id
+
+def is_permanent_error(error: Exception):
+    """Returns True if a request failed in a way that retrying won't fix (the request
+    itself was rejected), rather than because of the network or the server"""
+    return isinstance(error, TrelloError) and error.status_code is not None and \
+        400 <= error.status_code < 500 and error.status_code != 429
 
 class TrelloError(Exception):
-    pass
\ No newline at end of file
+    """status_code is the HTTP status of the failed response, or None if there was no response"""
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
\ No newline at end of file